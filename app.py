@@ -1,71 +1,366 @@
+import logging
 import os
 from werkzeug.utils import secure_filename
 from werkzeug.middleware.proxy_fix import ProxyFix
 import uuid
-from flask import Flask, render_template, request, redirect, url_for, flash, session, make_response
-from flask_session import Session
+import click
+from flask import (Blueprint, Flask, current_app, render_template, request, redirect, url_for, flash, session,
+                   make_response, jsonify)
+import csv
 import sqlite3
-from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps  # Needed for the login_required decorator
-from flask_moment import Moment
-from PIL import Image
-from datetime import datetime, timedelta  # For managing token expiration
-from dotenv import load_dotenv
-
-# Load environment variables from .env file
-load_dotenv()
-
-# Configure application
-app = Flask(__name__)
-# Apply ProxyFix to correctly handle URLs when deployed behind a proxy (Codespaces)
-app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_host=1, x_proto=1, x_port=1)
-
-# Initialize Flask-Moment
-moment = Moment(app)
-
-# SECRET_KEY from environment variable
-app.config["SECRET_KEY"] = os.environ.get(
-    "SECRET_KEY", "backup_key")
-
-# FLASK-SESSION
-app.config["SESSION_PERMANENT"] = False  # Sessions expire when browser closes
-app.config["SESSION_TYPE"] = "filesystem"  # Store sessions in files
-# Initialize the Flask-Session extension
-Session(app)
-
-app.config.update(
-    SESSION_COOKIE_HTTPONLY=True,
-    SESSION_COOKIE_SAMESITE="Lax",
-    SESSION_COOKIE_SECURE=False  # poné True si corrés detrás de HTTPS
-)
-
-UPLOAD_FOLDER = 'static/uploads'
-# Allowed image file extensions
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+import importlib
+import tempfile
+import db
+import migrate
+import importer
+import reset_tokens
+from assets import init_assets
+from compression import render_listing
+from session_store import init_session
+from passwords import PasswordHashBusy, hash_password, verify_password, needs_rehash, start_pool
+from timing import TimedConnection, init_timing
+from metrics import init_metrics
+from logs import fingerprint, init_logging
+from profiling import init_profiling
+from auth_cache import AuthCache, bump_auth_version
+from fragments import init_fragments
+from recipe_cache import get_recipe, init_recipe_cache, invalidate_recipe
+from changelog import init_change_log
+from maintenance import init_maintenance
+from images import allowed_file, crop_to_card
+from export import FORMATS, OWNER_FILTERS, recipe_filter, stream_export
+from fuzzy import TrigramIndex, fuzzy_recipes
+from favorite_state import favorite_ids, init_favorite_cache, set_favorite
+from conditional import add_validator, is_not_modified, listing_validator, not_modified, recipe_validator
+
+# Load environment variables from .env file (python-dotenv is only imported when there is one)
+ENV_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
+if os.path.exists(ENV_FILE):
+    from dotenv import load_dotenv
+    load_dotenv(ENV_FILE)
+
+logger = logging.getLogger(__name__)
+
+# Every route lives on this blueprint; create_app() registers it
+bp = Blueprint("main", __name__)
+
+# Imported on first use instead of at startup: Pillow only by the upload routes, Flask-Moment
+# by the first page render. wsgi.py imports them up front so forked workers share them.
+LAZY_MODULES = ("PIL.Image", "flask_moment")
+
+# In-process caches, emptied again in each forked worker (see init_worker)
+WORKER_CACHES = ("recipe_cache", "favorite_cache", "fragment_cache", "auth_cache")
+
+
+def create_app(config=None):
+    """Build the application.
+
+    Settings come from the environment (and .env); `config` overrides them, e.g.
+    create_app({"DATABASE": "test.db", "PASSWORD_HASH_WORKERS": 0}).
+    `flask run` finds this factory on its own; production runs wsgi:app under gunicorn.
+    """
+    app = Flask(__name__)
+    # Apply ProxyFix to correctly handle URLs when deployed behind a proxy (Codespaces)
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_host=1, x_proto=1, x_port=1)
+
+    # SECRET_KEY from environment variable
+    app.config["SECRET_KEY"] = os.environ.get(
+        "SECRET_KEY", "backup_key")
+
+    # DATABASE
+    # Startup creates/seeds the database and applies pending migrations (migrate.upgrade);
+    # once PRAGMA user_version is current that's a single read
+    app.config["DATABASE"] = os.environ.get("DATABASE", "recipes.db")
+    # "durable" (default, fsync on every commit), "balanced" or "read-heavy"; see db.PROFILES
+    app.config["DB_PROFILE"] = os.environ.get("DB_PROFILE", db.DEFAULT_PROFILE)
+    app.config["BOOTSTRAP_DB"] = os.environ.get("BOOTSTRAP_DB", "1") == "1"
+
+    # PASSWORD RESET
+    # Lifetime of a reset link in seconds. Expired tokens are swept by the maintenance thread
+    # every RESET_TOKEN_SWEEP_INTERVAL s.
+    app.config["RESET_TOKEN_TTL"] = int(os.environ.get("RESET_TOKEN_TTL", 300))
+    app.config["RESET_TOKEN_SWEEP_INTERVAL"] = int(os.environ.get("RESET_TOKEN_SWEEP_INTERVAL", 600))
+
+    # SESSIONS
+    app.config["SESSION_PERMANENT"] = False  # Sessions expire when browser closes
+    # "sqlite" (default), "cookie" (signed cookie, nothing stored server-side) or "filesystem" (Flask-Session)
+    app.config["SESSION_BACKEND"] = os.environ.get("SESSION_BACKEND", "sqlite")
+    app.config["SESSION_SQLITE_PATH"] = os.environ.get("SESSION_SQLITE_PATH", "sessions.db")
+
+    app.config.update(
+        SESSION_COOKIE_HTTPONLY=True,
+        SESSION_COOKIE_SAMESITE="Lax",
+        SESSION_COOKIE_SECURE=False  # poné True si corrés detrás de HTTPS
+    )
 
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 Megabytes
+    app.config['UPLOAD_FOLDER'] = 'static/uploads'
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 Megabytes
+
+    # STATIC ASSETS
+    # url_for('static', ...) emits content-hashed names (styles.<hash>.css) that are
+    # served with "immutable" caching, precompressed (.br/.gz) once `python assets.py`
+    # has been run as a build step.
+    # Behind nginx set STATIC_ACCEL_REDIRECT to an internal location (e.g. /_static),
+    # behind Apache/lighttpd set USE_X_SENDFILE=1 to let the proxy send the file.
+    app.config["STATIC_ACCEL_REDIRECT"] = os.environ.get("STATIC_ACCEL_REDIRECT")
+    app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE") == "1"
+
+    # STREAMED LISTINGS
+    # Opt-in: render the listing pages with Flask's streaming template API and gzip/brotli
+    # them on the fly. Pages under COMPRESS_MIN_SIZE bytes are sent uncompressed.
+    app.config["STREAM_LISTINGS"] = os.environ.get("STREAM_LISTINGS") == "1"
+    app.config["COMPRESS_MIN_SIZE"] = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+    app.config["COMPRESS_LEVEL"] = int(os.environ.get("COMPRESS_LEVEL", 6))
+
+    # PASSWORD HASHING
+    # Hashes run in a bounded process pool so a burst of logins can't starve page views.
+    # PASSWORD_HASH_WORKERS=0 hashes on the request thread instead.
+    # Changing PASSWORD_HASH_METHOD (e.g. "scrypt:65536:8:1" or "pbkdf2:sha256:1000000")
+    # upgrades each user's stored hash on their next successful login.
+    app.config["PASSWORD_HASH_METHOD"] = os.environ.get("PASSWORD_HASH_METHOD", "scrypt")
+    app.config["PASSWORD_HASH_WORKERS"] = int(os.environ.get("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+    app.config["PASSWORD_HASH_QUEUE"] = int(
+        os.environ.get("PASSWORD_HASH_QUEUE", 2 * app.config["PASSWORD_HASH_WORKERS"]))
+
+    # CONDITIONAL GET
+    # Listings and recipe pages carry an ETag built from recipes.version,
+    # catalog_version and users.favorites_version, so unchanged pages are answered with 304.
+    app.config["CONDITIONAL_GET"] = os.environ.get("CONDITIONAL_GET", "1") == "1"
+
+    # RECIPE CARD CACHE
+    # Listing pages concatenate per-recipe card HTML cached by (recipe id, version)
+    app.config["FRAGMENT_CACHE_BYTES"] = int(os.environ.get("FRAGMENT_CACHE_BYTES", 4 * 1024 * 1024))
+
+    # RECIPE CACHE
+    # recipe_detail and edit_recipe read assembled recipes (row + ingredients + categories)
+    # through an LRU bounded by RECIPE_CACHE_BYTES, checked against recipes.version on every
+    # read; every write path also invalidates its entry.
+    app.config["RECIPE_CACHE_BYTES"] = int(os.environ.get("RECIPE_CACHE_BYTES", 8 * 1024 * 1024))
+
+    # AUTH CACHE
+    # user id -> (username, auth_version); lets login_required notice revoked sessions
+    # without a query per request.
+    app.config["AUTH_CACHE_TTL"] = int(os.environ.get("AUTH_CACHE_TTL", 30))
+
+    # SQLITE MAINTENANCE
+    # A background thread per worker checkpoints the WAL once it grows past WAL_CHECKPOINT_BYTES
+    # (TRUNCATE past WAL_TRUNCATE_BYTES), keeps planner statistics fresh (PRAGMA optimize every
+    # OPTIMIZE_INTERVAL s, ANALYZE every ANALYZE_INTERVAL s) and runs incremental vacuum.
+    # MAINTENANCE=0 turns it off (run `python maintenance.py` from cron instead).
+    app.config["MAINTENANCE"] = os.environ.get("MAINTENANCE", "1") == "1"
+    app.config["MAINTENANCE_INTERVAL"] = int(os.environ.get("MAINTENANCE_INTERVAL", 30))
+    app.config["WAL_CHECKPOINT_BYTES"] = int(os.environ.get("WAL_CHECKPOINT_BYTES", 4 * 1024 * 1024))
+    app.config["WAL_TRUNCATE_BYTES"] = int(os.environ.get("WAL_TRUNCATE_BYTES", 64 * 1024 * 1024))
+    app.config["OPTIMIZE_INTERVAL"] = int(os.environ.get("OPTIMIZE_INTERVAL", 3600))
+    app.config["ANALYZE_INTERVAL"] = int(os.environ.get("ANALYZE_INTERVAL", 86400))
+
+    # BACKUPS
+    # With BACKUP_DIR set, the maintenance thread takes an online snapshot of the database and
+    # uploads every BACKUP_INTERVAL s and keeps the newest BACKUP_KEEP (see backup.py)
+    app.config["BACKUP_DIR"] = os.environ.get("BACKUP_DIR")
+    app.config["BACKUP_INTERVAL"] = int(os.environ.get("BACKUP_INTERVAL", 86400))
+    app.config["BACKUP_KEEP"] = int(os.environ.get("BACKUP_KEEP", 7))
+
+    # BULK IMPORT
+    # The /import page: recipes per transaction, and processes cropping/resizing the uploaded
+    # images (0: on the request thread). `python importer.py` uses one process per core.
+    app.config["IMPORT_BATCH_SIZE"] = int(os.environ.get("IMPORT_BATCH_SIZE", 1000))
+    app.config["IMPORT_IMAGE_WORKERS"] = int(os.environ.get("IMPORT_IMAGE_WORKERS", 0))
+
+    # FUZZY SEARCH
+    # When a search finds nothing, index() retries with the FUZZY_CANDIDATES vocabulary words
+    # most similar to each query word (trigram similarity of at least FUZZY_MIN_SIMILARITY)
+    # and shows up to FUZZY_LIMIT recipes, best match first. Only the FUZZY_MAX_RECIPES best
+    # matches are looked up in the database, before the owner and category filters.
+    app.config["FUZZY_SEARCH"] = os.environ.get("FUZZY_SEARCH", "1") == "1"
+    app.config["FUZZY_MIN_SIMILARITY"] = float(os.environ.get("FUZZY_MIN_SIMILARITY", 0.3))
+    app.config["FUZZY_CANDIDATES"] = int(os.environ.get("FUZZY_CANDIDATES", 5))
+    app.config["FUZZY_LIMIT"] = int(os.environ.get("FUZZY_LIMIT", 100))
+    app.config["FUZZY_MAX_RECIPES"] = int(os.environ.get("FUZZY_MAX_RECIPES", 1000))
+
+    # METRICS
+    # Prometheus text format at /metrics (see metrics.py). Scrapes must send
+    # "Authorization: Bearer <METRICS_TOKEN>"; without a token /metrics answers 403. Under
+    # gunicorn METRICS_DIR (set by gunicorn.conf.py) lets any worker answer with the totals
+    # of all of them.
+    app.config["METRICS"] = os.environ.get("METRICS", "1") == "1"
+    app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+    app.config["METRICS_DIR"] = os.environ.get("METRICS_DIR")
+
+    # LOGGING
+    # JSON lines on stderr, written by a background thread (see logs.py); LOG_FORMAT=text for
+    # plain lines. Repeats of one message past LOG_RATE_LIMIT per LOG_RATE_WINDOW s are
+    # dropped, and so is everything past LOG_QUEUE_SIZE queued records.
+    app.config["LOG_LEVEL"] = os.environ.get("LOG_LEVEL", "INFO").upper()
+    app.config["LOG_FORMAT"] = os.environ.get("LOG_FORMAT", "json")
+    app.config["LOG_QUEUE_SIZE"] = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+    app.config["LOG_RATE_LIMIT"] = int(os.environ.get("LOG_RATE_LIMIT", 20))
+    app.config["LOG_RATE_WINDOW"] = float(os.environ.get("LOG_RATE_WINDOW", 60))
+
+    # PROFILING
+    # Off by default. With PROFILING=1 a request is profiled when it sends "X-Profile: <PROFILE_TOKEN>"
+    # or at random for PROFILE_SAMPLE_RATE of requests (0.001 = one in a thousand); collapsed
+    # stacks go to PROFILE_DIR/<route>/, keeping at most PROFILE_MAX_FILES / PROFILE_MAX_BYTES.
+    app.config["PROFILING"] = os.environ.get("PROFILING", "0") == "1"
+    app.config["PROFILE_TOKEN"] = os.environ.get("PROFILE_TOKEN")
+    app.config["PROFILE_SAMPLE_RATE"] = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+    app.config["PROFILE_INTERVAL_MS"] = float(os.environ.get("PROFILE_INTERVAL_MS", 5))
+    app.config["PROFILE_DIR"] = os.environ.get("PROFILE_DIR", "profiles")
+    app.config["PROFILE_MAX_FILES"] = int(os.environ.get("PROFILE_MAX_FILES", 200))
+    app.config["PROFILE_MAX_BYTES"] = int(os.environ.get("PROFILE_MAX_BYTES", 50 * 1024 * 1024))
+
+    # MEMORY PROFILING
+    # Off by default; tracing slows allocations down. MEMORY_PROFILING=1 tracks per-route peak
+    # and retained allocations with tracemalloc and snapshots each worker every
+    # MEMORY_SNAPSHOT_INTERVAL s; /debug/memory shows both to "Authorization: Bearer <MEMORY_TOKEN>".
+    app.config["MEMORY_PROFILING"] = os.environ.get("MEMORY_PROFILING", "0") == "1"
+    app.config["MEMORY_TOKEN"] = os.environ.get("MEMORY_TOKEN")
+    app.config["MEMORY_TRACE_FRAMES"] = int(os.environ.get("MEMORY_TRACE_FRAMES", 5))
+    app.config["MEMORY_SNAPSHOT_INTERVAL"] = int(os.environ.get("MEMORY_SNAPSHOT_INTERVAL", 300))
+
+    if config:
+        app.config.update(config)
+
+    db.profile_settings(app.config["DB_PROFILE"])  # fail at startup on a misspelled profile
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    if app.config["METRICS"]:
+        init_metrics(app, WORKER_CACHES)  # first, so its timer starts before the other handlers
+    init_logging(app)
+    if app.config["BOOTSTRAP_DB"]:  # after init_logging, which writes out what it logs
+        migrate.upgrade(app.config["DATABASE"])
+    if app.config["PROFILING"]:
+        init_profiling(app)
+    if app.config["MEMORY_PROFILING"]:
+        from memory import init_memory_profiling  # tracemalloc only when it is used
+        init_memory_profiling(app)
+    init_moment(app)
+    init_session(app)
+    init_assets(app)
+    init_fragments(app)
+    init_recipe_cache(app)
+    # FAVORITES
+    # Per-user set of favorited recipe ids, so listings mark favorites without a query per card
+    init_favorite_cache(app)
+    app.extensions["auth_cache"] = AuthCache(ttl=app.config["AUTH_CACHE_TTL"])
+    app.extensions["trigram_index"] = TrigramIndex(min_similarity=app.config["FUZZY_MIN_SIMILARITY"],
+                                                   candidates=app.config["FUZZY_CANDIDATES"],
+                                                   max_recipes=app.config["FUZZY_MAX_RECIPES"])
+    init_invalidation(app)
+    init_maintenance(app)
+    # Server-Timing header with per-request "db" and "hash" durations
+    init_timing(app)
+
+    app.register_blueprint(bp)
+    app.register_error_handler(PasswordHashBusy, password_hash_busy)
+    return app
+
+
+def init_moment(app):
+    # Same as Moment(app), minus importing flask_moment before a template needs it
+    @app.context_processor
+    def moment_context():
+        moment = app.extensions.get("moment")
+        if moment is None:
+            from flask_moment import moment
+            app.extensions["moment"] = moment
+        return {"moment": moment}
+
+
+def preload_lazy_modules():
+    """Import LAZY_MODULES now (gunicorn master, before forking the workers)."""
+    for name in LAZY_MODULES:
+        importlib.import_module(name)
+
+
+def init_invalidation(app):
+    # CROSS-WORKER INVALIDATION
+    # Triggers append every change to the change_log table; at the start of each request this
+    # worker checks PRAGMA data_version and, if another connection wrote, drops the affected keys.
+    recipe_cache = app.extensions["recipe_cache"]
+    favorite_cache = app.extensions["favorite_cache"]
+    auth_cache = app.extensions["auth_cache"]
+    trigram_index = app.extensions["trigram_index"]
+    change_log = init_change_log(app, app.config["DATABASE"])
+    change_log.subscribe(("recipes", "ingredients", "recipe_categories"),
+                         lambda recipe_id, op: recipe_cache.invalidate(recipe_id))
+    # New words for fuzzy search
+    if app.config["FUZZY_SEARCH"]:
+        change_log.subscribe(("recipes", "ingredients"), trigram_index.invalidate)
+    # Category names are part of every cached recipe
+    change_log.subscribe(("categories",), lambda category_id, op: recipe_cache.clear())
+    change_log.subscribe(("users",), lambda user_id, op: auth_cache.invalidate(user_id))
+    change_log.subscribe(("favorites",), lambda user_id, op: favorite_cache.invalidate(user_id))
+    change_log.on_reset(recipe_cache.clear)
+    change_log.on_reset(auth_cache.clear)
+    change_log.on_reset(favorite_cache.clear)
+    change_log.on_reset(trigram_index.clear)
+
+
+def init_worker(app):
+    """Per-process setup, run by gunicorn in each worker right after the fork.
+
+    Anything the master built while preloading the app (cache contents, SQLite
+    connections, the hashing pool) belongs to the master, so start from scratch here and
+    open this worker's own change_log connection, hashing pool, log writer and maintenance
+    thread before the first request.
+    """
+    for name in WORKER_CACHES:
+        app.extensions[name].clear()
+    if "metrics" in app.extensions:
+        app.extensions["metrics"].clear()
+    with app.app_context():
+        start_pool()  # before this worker starts any thread of its own
+    app.extensions["logging"].start()
+    if app.config["FUZZY_SEARCH"]:
+        app.extensions["trigram_index"].clear()  # invalidations the master queued while preloading
+        app.extensions["trigram_index"].warm_up(app.config["DATABASE"])
+    with app.app_context():
+        app.extensions["change_log"].poll()
+        if app.config["MAINTENANCE"]:
+            app.extensions["maintenance"].ensure_started()
+
+
+def password_hash_busy(e):
+    # Too many logins in flight: reject fast and show the same form again
+    flash("The server is busy right now, please try again in a moment.", "warning")
+    # login, register, change_password and reset_password all render <endpoint>.html
+    template = request.endpoint.rpartition(".")[2]
+    return render_template(f"{template}.html", **(request.view_args or {})), 503, {"Retry-After": "2"}
 
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+def get_db_connection():
+    # columns by name row['username']; PRAGMAs from the DB_PROFILE storage profile (db.py)
+    # Statements feed the request's "db" timer and query count (Server-Timing, /metrics)
+    return db.connect(current_app.config["DATABASE"], current_app.config["DB_PROFILE"], check_same_thread=False,
+                      factory=TimedConnection)
 
-def allowed_file(filename):
-    # Check if there's a file extension and if it's in our ALLOWED_EXTENSIONS set
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def load_auth_state(user_id):
+    conn = get_db_connection()
+    row = conn.execute("SELECT username, auth_version FROM users WHERE id = ?", (user_id,)).fetchone()
+    conn.close()
+    return (row["username"], row["auth_version"]) if row else None
 
-# database path
-DATABASE = 'recipes.db'
 
+def find_login_user(cursor, username_or_email):
+    """Look up a user by email if the input looks like one, otherwise by username.
 
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE, check_same_thread=False)
-    # columns by name row['username']
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON")
-    conn.execute("PRAGMA journal_mode = WAL")
-    return conn
+    Each branch is a single case-insensitive index lookup (a WHERE username = ? OR email = ?
+    can fall back to a table scan on some SQLite versions).
+    """
+    username_or_email = username_or_email.strip()
+    user = None
+    if "@" in username_or_email:
+        user = cursor.execute(
+            "SELECT id, username, hash, auth_version FROM users WHERE email = ? COLLATE NOCASE",
+            (username_or_email,)).fetchone()
+    if user is None:
+        user = cursor.execute(
+            "SELECT id, username, hash, auth_version FROM users WHERE username = ? COLLATE NOCASE",
+            (username_or_email,)).fetchone()
+    return user
 
 # Decorator to ensure a user is logged in
 
@@ -79,12 +374,18 @@ def login_required(f):
     def decorated_function(*args, **kwargs):
         if session.get("user_id") is None:
             flash("You must be logged in to access this page.", "danger")
-            return redirect(url_for("login"))
+            return redirect(url_for("main.login"))
+        # Sessions are revoked by bumping users.auth_version (sessions from before it existed count as 1)
+        auth_state = current_app.extensions["auth_cache"].get(session["user_id"], load_auth_state)
+        if auth_state is None or auth_state[1] != session.get("auth_version", 1):
+            session.clear()
+            flash("Your session has expired. Please log in again.", "warning")
+            return redirect(url_for("main.login"))
         return f(*args, **kwargs)
     return decorated_function
 
 
-@app.route("/")
+@bp.route("/")
 @login_required
 def index():
     """Show list of recipes, with search and filter."""
@@ -94,6 +395,12 @@ def index():
     user_id = session["user_id"]
     system_user_id = 1
 
+    # Answer 304 when no recipe, category or favorite has changed since the client's copy
+    validator = listing_validator(cursor, user_id)
+    if is_not_modified(validator):
+        conn.close()
+        return not_modified(validator)
+
     # Get filter parameters from request.args
     # .get("q", "") provides empty string if 'q' not present
     query = request.args.get("q", "").strip()
@@ -102,68 +409,33 @@ def index():
 
     recipes = []
 
+    columns = """
+        r.id, r.title, r.description, r.instructions, r.prep_time, r.cook_time,
+        r.user_id, r.image_filename, r.version, u.username AS owner_username
+    """
+
     # Base SQL query parts
     sql_query_parts = [
-        """
-        SELECT
-            r.id, r.title, r.description, r.instructions, r.prep_time, r.cook_time,
-            r.user_id, r.image_filename, u.username AS owner_username
+        f"""
+        SELECT {columns}
         FROM recipes r
         JOIN users u ON r.user_id = u.id
         """
     ]
-    sql_params = []
-
-    # WHERE clauses for filtering
-    where_clauses = []
-
-    # Apply owner filter based on selection
-    if owner_filter == 'my_recipes':
-        where_clauses.append("r.user_id = ?")
-        sql_params.append(user_id)
-    elif owner_filter == 'default_recipes':
-        where_clauses.append("r.user_id = ?")
-        sql_params.append(system_user_id)
-    elif owner_filter == 'my_and_default':
-        where_clauses.append("(r.user_id = ? OR r.user_id = ?)")
-        sql_params.extend([user_id, system_user_id])
-    elif owner_filter == 'all_recipes':
-        # show all recipes (subject to other filters)
-        pass
-    else:
-        # Fallback to my_and_default if an unexpected owner_filter value is received
+
+    # Fall back to my_and_default if an unexpected owner_filter value is received
+    if owner_filter not in OWNER_FILTERS:
         flash("Invalid owner filter selected. Displaying 'My & Default Recipes'.", "warning")
-        where_clauses.append("(r.user_id = ? OR r.user_id = ?)")
-        sql_params.extend([user_id, system_user_id])
         owner_filter = 'my_and_default'  # Reset for template rendering
 
-    # Add search query filter if present
-    if query:
-        # Use LIKE for partial matching. '%query%' matches anywhere in the string.
-        # We search in title, description, and ingredient names.
-        where_clauses.append("""
-            (r.title LIKE ? OR r.description LIKE ? OR EXISTS (
-                SELECT 1 FROM ingredients i WHERE i.recipe_id = r.id AND i.name LIKE ?
-            ))
-        """)
-        # Add '%' for LIKE operator
-        sql_params.extend([f"%{query}%", f"%{query}%", f"%{query}%"])
-
-    # Add category filter if present
-    if category_id:
-        # Check if the category_id actually exists
-        valid_category = cursor.execute(
-            "SELECT id FROM categories WHERE id = ?", (category_id,)).fetchone()
-        if valid_category:
-            where_clauses.append("""
-                EXISTS (
-                    SELECT 1 FROM recipe_categories rc WHERE rc.recipe_id = r.id AND rc.category_id = ?
-                )
-            """)
-            sql_params.append(category_id)
-        else:
-            flash("Invalid category selected.", "danger")
-            category_id = None  # Reset invalid category_id for template rendering
+    # Check if the category_id actually exists
+    if category_id and not cursor.execute(
+            "SELECT id FROM categories WHERE id = ?", (category_id,)).fetchone():
+        flash("Invalid category selected.", "danger")
+        category_id = None  # Reset invalid category_id for template rendering
+
+    # WHERE clauses for the owner, search and category filters (shared with the export)
+    where_clauses, sql_params = recipe_filter(user_id, owner_filter, query, category_id, system_user_id)
 
     # Combine all WHERE clauses
     if where_clauses:
@@ -176,24 +448,40 @@ def index():
     # Execute the query
     recipes = cursor.execute(final_sql_query, sql_params).fetchall()
 
+    # Nothing matched the text as typed: try words spelled like it (fuzzy.py), best match first
+    fuzzy_terms = []
+    if query and not recipes and current_app.config["FUZZY_SEARCH"]:
+        matches = current_app.extensions["trigram_index"].suggest(cursor, query)
+        if matches:
+            where_clauses, sql_params = recipe_filter(user_id, owner_filter, "", category_id, system_user_id)
+            recipes = fuzzy_recipes(cursor, current_app.extensions["trigram_index"], columns, matches,
+                                    where_clauses, sql_params, limit=current_app.config["FUZZY_LIMIT"])
+            if recipes:
+                fuzzy_terms = [candidates[0][0] for candidates in matches]
+
     # Get all categories for the filter dropdown
     all_categories = cursor.execute("SELECT id, name FROM categories ORDER BY name").fetchall()
 
+    # Favorite flags for every card on the page, in one lookup
+    user_favorite_ids = favorite_ids(cursor, user_id)
+
     conn.close()
 
     # Pass all necessary data to the template
-    return render_template(
+    return add_validator(make_response(render_listing(
         "index.html",
         recipes=recipes,
+        favorite_ids=user_favorite_ids,
         query=query,  # Pass the search query back to pre-fill the search box
+        fuzzy_terms=fuzzy_terms,
         all_categories=all_categories,  # dropdown
         selected_category_id=category_id,
         owner_filter=owner_filter,
         system_user_id=system_user_id
-    )
+    )), validator)
 
 
-@app.route("/my_recipes")
+@bp.route("/my_recipes")
 @login_required
 def my_recipes():
     """Display a list of recipes created by the current user."""
@@ -202,10 +490,15 @@ def my_recipes():
     conn = get_db_connection()
     cursor = conn.cursor()
 
+    validator = listing_validator(cursor, user_id)
+    if is_not_modified(validator):
+        conn.close()
+        return not_modified(validator)
+
     # Fetch only recipes created by the current user
     cursor.execute("""
         SELECT r.id, r.title, r.description, r.prep_time, r.cook_time,
-               r.image_filename, r.user_id, u.username AS owner_username
+               r.image_filename, r.user_id, r.version, u.username AS owner_username
         FROM recipes r
         JOIN users u ON r.user_id = u.id
         WHERE r.user_id = ?
@@ -213,12 +506,91 @@ def my_recipes():
     """, (user_id,))
 
     my_owned_recipes = cursor.fetchall()
+    user_favorite_ids = favorite_ids(cursor, user_id)
     conn.close()
 
-    return render_template("my_recipes.html", recipes=my_owned_recipes, system_user_id=1)
+    return add_validator(make_response(
+        render_listing("my_recipes.html", recipes=my_owned_recipes, system_user_id=1,
+                       favorite_ids=user_favorite_ids)), validator)
 
 
-@app.route("/register", methods=["GET", "POST"])
+@bp.route("/export/<any(jsonl, csv):fmt>")
+@login_required
+def export_recipes(fmt):
+    """Download the recipes index() would list, with ingredients and categories, as JSONL or CSV.
+
+    Streamed in batches (see export.py), so memory stays flat however many recipes match.
+    """
+    query = request.args.get("q", "").strip()
+    category_id = request.args.get("category_id", type=int)
+    owner_filter = request.args.get("owner_filter", "my_and_default")
+    if owner_filter not in OWNER_FILTERS:
+        return jsonify(error=f"owner_filter must be one of {', '.join(OWNER_FILTERS)}"), 400
+
+    where_clauses, params = recipe_filter(session["user_id"], owner_filter, query, category_id)
+    # The generator closes the connection once the last batch has been sent; a body that is
+    # never iterated (HEAD, a client gone before the first byte) never runs its finally, so
+    # closing the response closes the connection as well
+    conn = get_db_connection()
+    try:
+        response = current_app.response_class(stream_export(conn, fmt, where_clauses, params),
+                                              mimetype=FORMATS[fmt])
+        response.headers["Content-Disposition"] = f"attachment; filename=recipes.{fmt}"
+        response.call_on_close(conn.close)
+    except BaseException:
+        conn.close()
+        raise
+    return response
+
+
+@bp.route("/import", methods=["GET", "POST"])
+@login_required
+def import_recipes():
+    """Bulk-add recipes from a JSONL or CSV file (e.g. an export), plus the images it names."""
+    if request.method == "GET":
+        return render_template("import_recipes.html")
+
+    data_file = request.files.get("recipes_file")
+    fmt = data_file.filename.rsplit(".", 1)[-1].lower() if data_file and data_file.filename else None
+    if fmt not in FORMATS:
+        flash("Choose a .jsonl or .csv file to import.", "danger")
+        return render_template("import_recipes.html")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, f"recipes.{fmt}")
+        data_file.save(path)
+        images_dir = os.path.join(workdir, "images")
+        os.makedirs(images_dir)
+        for image in request.files.getlist("images"):
+            if image.filename and allowed_file(image.filename):
+                # Records name images by file name; the directory is private and deleted afterwards
+                image.save(os.path.join(images_dir, os.path.basename(image.filename)))
+
+        conn = db.connect(current_app.config["DATABASE"], current_app.config["DB_PROFILE"],
+                          isolation_level=None)
+        try:
+            with open(path, newline="", encoding="utf-8") as stream:
+                report = importer.import_recipes(
+                    conn, importer.read_records(stream, fmt), session["user_id"], importer.source_key(path),
+                    images_dir=images_dir, upload_folder=current_app.config["UPLOAD_FOLDER"],
+                    batch=current_app.config["IMPORT_BATCH_SIZE"],
+                    workers=current_app.config["IMPORT_IMAGE_WORKERS"])
+        except (ValueError, csv.Error, sqlite3.Error) as e:
+            logger.warning("Import failed", extra={"user_id": session["user_id"], "error": str(e)})
+            flash(f"The import stopped: {e}. Recipes imported before that are kept; "
+                  "upload the same file again to continue.", "danger")
+            return render_template("import_recipes.html")
+        finally:
+            conn.close()
+
+    first, *rest = importer.summary(report).splitlines()
+    flash(first, "success" if not report["already_finished"] else "info")
+    for line in rest:
+        flash(line, "warning")
+    return redirect(url_for("main.my_recipes"))
+
+
+@bp.route("/register", methods=["GET", "POST"])
 def register():
     """Register user"""
     session.clear()
@@ -255,24 +627,33 @@ def register():
 
         try:
             # 3. Perform database-dependent validations
-            cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
+            cursor.execute("SELECT 1 FROM users WHERE username = ? COLLATE NOCASE", (username,))
             if cursor.fetchone():
                 flash("Username already exists", "danger")
                 return render_template("register.html")
 
-            cursor.execute("SELECT * FROM users WHERE email = ?", (email,))
+            cursor.execute("SELECT 1 FROM users WHERE email = ? COLLATE NOCASE", (email,))
             if cursor.fetchone():
                 flash("Email already registered", "danger")
                 return render_template("register.html")
 
             # 4. If all validations (form and database) pass, proceed with registration
-            hashed_password = generate_password_hash(password)
+            hashed_password = hash_password(password)
             cursor.execute("INSERT INTO users (username, hash, email) VALUES (?, ?, ?)",
                            (username, hashed_password, email))
             conn.commit()
             flash("Registration successful! Please log in.", "success")
-            return redirect(url_for("login"))
+            return redirect(url_for("main.login"))
 
+        except sqlite3.IntegrityError as e:
+            # A concurrent registration took the name or email after the checks above
+            # (the UNIQUE NOCASE indexes from migration 0007)
+            conn.rollback()
+            if "users.email" in str(e):
+                flash("Email already registered", "danger")
+            else:
+                flash("Username already exists", "danger")
+            return render_template("register.html")
         except sqlite3.Error as e:
             conn.rollback()
             flash(f"An unexpected error occurred during registration: {e}", "danger")
@@ -285,7 +666,7 @@ def register():
         return render_template("register.html")
 
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     """Log user in"""
     if request.method == "POST":
@@ -305,25 +686,37 @@ def login():
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        # Query database for username or email
-        cursor.execute("SELECT * FROM users WHERE username = ? OR email = ?",
-                       (username_or_email, username_or_email))
-        user = cursor.fetchone()
-        conn.close()
+        try:
+            # Query database for username or email
+            user = find_login_user(cursor, username_or_email)
 
-        # Check if username exists and password is correct
-        if user is None or not check_password_hash(user["hash"], password):
-            flash("Invalid username/email and/or password", "danger")
-            return render_template("login.html")
+            # Check if username exists and password is correct
+            if user is None or not verify_password(user["hash"], password):
+                flash("Invalid username/email and/or password", "danger")
+                return render_template("login.html")
+
+            # Transparently upgrade hashes made with older PASSWORD_HASH_METHOD parameters
+            if needs_rehash(user["hash"]):
+                try:
+                    upgraded_hash = hash_password(password)
+                    cursor.execute("UPDATE users SET hash = ? WHERE id = ?",
+                                   (upgraded_hash, user["id"]))
+                    conn.commit()
+                except (PasswordHashBusy, sqlite3.Error):
+                    # Not worth failing the login over, it will be retried next time
+                    pass
+        finally:
+            conn.close()
 
         # Remember which user has logged in
         session["user_id"] = user["id"]
         # Store username for display (e.g., "Hello, [username]!")
         session["username"] = user["username"]
+        session["auth_version"] = user["auth_version"]
 
         # Redirect user to home page
         flash(f"Welcome back, {user['username']}!", "success")
-        return redirect(url_for("index"))
+        return redirect(url_for("main.index"))
 
     else:  # GET request
         response = make_response(render_template("login.html"))
@@ -334,39 +727,25 @@ def login():
         return response
 
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     """Log user out"""
+    logger.debug("Logout", extra={"user_id": session.get("user_id")})
 
-    # --- Debug prints ---
-    print(f"\n--- LOGOUT DEBUG  ---")
-    print(f"Session user_id BEFORE removal: {session.get('user_id')}")
-    print(f"Session username BEFORE removal: {session.get('username')}")
-    # --- End Debug ---
-
-    # Instead of session.clear(), explicitly delete user_id and username
-    if "user_id" in session:
-        del session["user_id"]
-    if "username" in session:
-        del session["username"]
-
-    # --- Debug prints ---
-    print(f"Session user_id AFTER removal: {session.get('user_id')}")
-    print(f"Session username AFTER removal: {session.get('username')}")
-    print(f"Flash message (logout) set.")
-    # --- End Debug ---
+    # Everything goes, auth_version included, as on login and register
+    session.clear()
 
     flash("You have been logged out.", "info")
 
     # Add Cache-Control headers
-    response = make_response(redirect(url_for("login")))
+    response = make_response(redirect(url_for("main.login")))
     response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     response.headers["Pragma"] = "no-cache"
     response.headers["Expires"] = "0"
     return response
 
 
-@app.route("/add_recipe", methods=["GET", "POST"])
+@bp.route("/add_recipe", methods=["GET", "POST"])
 @login_required
 def add_recipe():
     """Allow user to add a new recipe."""
@@ -417,34 +796,15 @@ def add_recipe():
                 original_filename_secured = secure_filename(image_file.filename)
                 unique_filename = str(uuid.uuid4()) + '.' + \
                     original_filename_secured.rsplit('.', 1)[1].lower()
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+                filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)
 
                 image_file.save(filepath)
 
                 try:
-                    img = Image.open(filepath)
-                    original_width, original_height = img.size
-                    target_aspect = 4 / 3
-
-                    if original_width / original_height > target_aspect:
-                        new_width = int(original_height * target_aspect)
-                        left = (original_width - new_width) / 2
-                        top = 0
-                        right = (original_width + new_width) / 2
-                        bottom = original_height
-                    else:
-                        new_height = int(original_width / target_aspect)
-                        left = 0
-                        top = (original_height - new_height) / 2
-                        right = original_width
-                        bottom = (original_height + new_height) / 2
-
-                    img = img.crop((left, top, right, bottom))
-                    img = img.resize((600, 450), Image.Resampling.LANCZOS)
-                    img.save(filepath)
+                    crop_to_card(filepath)
                     image_filename = unique_filename
-                except Exception as e:
-                    print(f"Error processing image {filepath}: {e}")
+                except Exception:
+                    logger.warning("Image processing failed", exc_info=True, extra={"path": filepath})
                     flash("Error processing image. Please try another file.", "warning")
                     if os.path.exists(filepath):
                         os.remove(filepath)
@@ -503,12 +863,12 @@ def add_recipe():
 
             conn.commit()
             flash("Recipe added successfully!", "success")
-            return redirect(url_for("recipe_detail", recipe_id=recipe_id))
+            return redirect(url_for("main.recipe_detail", recipe_id=recipe_id))
 
         except sqlite3.Error as e:
             conn.rollback()
             flash(f"An error occurred: {e}", "danger")
-            print(f"Database error during add_recipe: {e}")
+            logger.error("Database error during add_recipe", extra={"error": str(e)})
             all_categories = cursor.execute(
                 "SELECT id, name FROM categories ORDER BY name").fetchall()
             conn.close()
@@ -531,7 +891,7 @@ def add_recipe():
                                ingredients=[{'name': '', 'quantity_unit': ''}])
 
 
-@app.route("/recipe/<int:recipe_id>")
+@bp.route("/recipe/<int:recipe_id>")
 @login_required
 def recipe_detail(recipe_id):
     """Display full details of a specific recipe."""
@@ -540,89 +900,53 @@ def recipe_detail(recipe_id):
 
     system_user_id = 1
 
-    recipe = cursor.execute(
-        """
-        SELECT r.id, r.title, r.description, r.instructions, r.prep_time, r.cook_time,
-               r.user_id, r.image_filename, u.username AS owner_username
-        FROM recipes r
-        JOIN users u ON r.user_id = u.id
-        WHERE r.id = ?
-        """,
-        (recipe_id,)
-    ).fetchone()
+    # One indexed lookup decides whether the four queries below can be skipped entirely
+    validator = recipe_validator(cursor, recipe_id, session["user_id"])
+    if is_not_modified(validator):
+        conn.close()
+        return not_modified(validator)
+
+    # Recipe with its ingredients and categories, from the recipe cache when possible
+    recipe = get_recipe(cursor, recipe_id, validator.version if validator else None)
 
     if recipe is None:
         flash("Recipe not found.", "danger")
         conn.close()
-        return redirect(url_for("index"))
-
-    recipe = dict(recipe)  # Convert to mutable dictionary
-
-    # Fetch ingredients for this recipe and ATTACH THEM TO THE RECIPE DICTIONARY
-    ingredients_list = cursor.execute(
-        "SELECT name, quantity_unit FROM ingredients WHERE recipe_id = ?",
-        (recipe_id,)
-    ).fetchall()
-    recipe['ingredients'] = ingredients_list
-
-    # same for categories
-    categories_list = cursor.execute(
-        """
-        SELECT c.id, c.name
-        FROM recipe_categories rc
-        JOIN categories c ON rc.category_id = c.id
-        WHERE rc.recipe_id = ?
-        ORDER BY c.name
-        """,
-        (recipe_id,)
-    ).fetchall()
-    recipe['categories'] = categories_list
+        return redirect(url_for("main.index"))
 
     user_id = session.get("user_id")
 
     is_favorited = False
     if user_id:  # Only check if a user is logged in
-        cursor.execute("SELECT 1 FROM favorites WHERE user_id = ? AND recipe_id = ?",
-                       (user_id, recipe_id))
-        if cursor.fetchone():  # If a row is returned, it means it's favorited
-            is_favorited = True
+        is_favorited = recipe_id in favorite_ids(cursor, user_id)
 
     conn.close()
 
-    # 'recipe' dictionary contains ingredients and categories
-    return render_template("recipe_detail.html",
-                           recipe=recipe,
-                           is_favorited=is_favorited,
-                           system_user_id=system_user_id)
+    # 'recipe' contains ingredients and categories
+    return add_validator(make_response(render_template("recipe_detail.html",
+                                                       recipe=recipe,
+                                                       is_favorited=is_favorited,
+                                                       system_user_id=system_user_id)), validator)
 
 
-@app.route("/edit_recipe/<int:recipe_id>", methods=["GET", "POST"])
+@bp.route("/edit_recipe/<int:recipe_id>", methods=["GET", "POST"])
 @login_required
 def edit_recipe(recipe_id):
     """Allow user to edit an existing recipe."""
     conn = get_db_connection()
     cursor = conn.cursor()
 
-    # Fetch the recipe by ID
-    recipe = cursor.execute(
-        """
-        SELECT r.id, r.title, r.description, r.instructions, r.prep_time, r.cook_time,
-               r.user_id, r.image_filename, u.username AS owner_username
-        FROM recipes r
-        JOIN users u ON r.user_id = u.id
-        WHERE r.id = ?
-        """,
-        (recipe_id,)
-    ).fetchone()
+    # Fetch the recipe by ID (with ingredients and categories, from the recipe cache when possible)
+    cached_recipe = get_recipe(cursor, recipe_id)
 
     # Check if recipe exists and if the current user owns it
-    if recipe is None or recipe["user_id"] != session["user_id"]:
+    if cached_recipe is None or cached_recipe.user_id != session["user_id"]:
         flash("Recipe not found or you don't have permission to edit it.", "danger")
         conn.close()
-        return redirect(url_for("index"))
+        return redirect(url_for("main.index"))
 
-    # Convert to mutable dictionary here, same as before above in recipe_detail.
-    recipe = dict(recipe)
+    # Mutable copy: the error paths below swap in the submitted ingredients
+    recipe = cached_recipe.as_dict()
 
     if request.method == "POST":
         # Get updated form data
@@ -642,19 +966,16 @@ def edit_recipe(recipe_id):
         # Scenario 1: User explicitly wants to delete the current image
         if delete_current_image:
             if recipe['image_filename']:  # If there's an existing file to delete
-                old_filepath = os.path.join(app.config['UPLOAD_FOLDER'], recipe['image_filename'])
+                old_filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], recipe['image_filename'])
                 if os.path.exists(old_filepath):
                     try:
                         os.remove(old_filepath)  # Delete the file from the filesystem
-                        # For debugging
-                        print(f"Successfully deleted old image file: {old_filepath}")
+                        logger.debug("Deleted old image", extra={"recipe_id": recipe_id, "path": old_filepath})
                     except OSError as e:
-                        print(f"Error deleting old image file {old_filepath}: {e}")
+                        logger.warning("Could not delete old image", extra={"path": old_filepath, "error": str(e)})
                         flash(f"Error deleting old image: {e}", "warning")
                 else:
-                    # For debugging
-                    print(
-                        f"Warning: Old image file not found at {old_filepath} (was expected for deletion).")
+                    logger.warning("Old image to delete not found", extra={"path": old_filepath})
             image_filename_to_db = None  # Set filename to NULL in DB
 
         # Scenario 2: User uploads a new image (only process if no explicit delete OR if a new file is provided)
@@ -665,58 +986,32 @@ def edit_recipe(recipe_id):
                 # (for example: delete_current_image was not checked, or was checked but filename was None)
                 if recipe['image_filename'] and not delete_current_image:
                     old_filepath = os.path.join(
-                        app.config['UPLOAD_FOLDER'], recipe['image_filename'])
+                        current_app.config['UPLOAD_FOLDER'], recipe['image_filename'])
                     if os.path.exists(old_filepath):
                         try:
                             os.remove(old_filepath)
-                            print(
-                                f"Successfully removed old image to replace with new: {old_filepath}")
+                            logger.debug("Removed image being replaced",
+                                         extra={"recipe_id": recipe_id, "path": old_filepath})
                         except OSError as e:
-                            print(f"Error removing old image for replacement {old_filepath}: {e}")
+                            logger.warning("Could not remove image being replaced",
+                                           extra={"path": old_filepath, "error": str(e)})
                             flash(f"Error replacing old image: {e}", "warning")
 
                 original_filename_secured = secure_filename(image_file.filename)
                 unique_filename = str(uuid.uuid4()) + '.' + \
                     original_filename_secured.rsplit('.', 1)[1].lower()
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+                filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)
 
                 image_file.save(filepath)  # Save the uploaded file initially
 
                 # --- IMAGE RESIZING LOGIC (SAME AS ADD_RECIPE) ---
                 try:
-                    img = Image.open(filepath)
-                    original_width, original_height = img.size
-                    target_aspect = 4 / 3
-
-                    # Calculate new dimensions to fit 4:3 and crop from center
-                    if original_width / original_height > target_aspect:
-                        # Image is wider than 4:3, crop width
-                        new_width = int(original_height * target_aspect)
-                        left = (original_width - new_width) / 2
-                        top = 0
-                        right = (original_width + new_width) / 2
-                        bottom = original_height
-                    else:
-                        # Image is taller than 4:3, crop height
-                        new_height = int(original_width / target_aspect)
-                        left = 0
-                        top = (original_height - new_height) / 2
-                        right = original_width
-                        bottom = (original_height + new_height) / 2
-
-                    # Crop the image to the 4:3 aspect ratio
-                    img = img.crop((left, top, right, bottom))
-
-                    # Resize to target dimensions (600x450)
-                    img = img.resize((600, 450), Image.Resampling.LANCZOS)
-
-                    # Save the processed image, overwriting the original uploaded file
-                    img.save(filepath)
-                    # For debugging
-                    print(f"Image processed and saved at 600x450 (4:3): {filepath}")
+                    # Crop to 4:3 and resize to 600x450, overwriting the uploaded file
+                    crop_to_card(filepath)
+                    logger.debug("Image processed", extra={"recipe_id": recipe_id, "path": filepath})
                     image_filename_to_db = unique_filename  # Only set filename if processing successful
-                except Exception as e:
-                    print(f"Error processing image {filepath}: {e}")
+                except Exception:
+                    logger.warning("Image processing failed", exc_info=True, extra={"path": filepath})
                     flash("Error processing image. Please try another file.", "warning")
                     # Delete the uploaded file if processing failed
                     if os.path.exists(filepath):
@@ -838,8 +1133,9 @@ def edit_recipe(recipe_id):
                             f"Invalid category ID '{category_id}' was selected and ignored.", "warning")
 
             conn.commit()
+            invalidate_recipe(recipe_id)
             flash("Recipe updated successfully!", "success")
-            return redirect(url_for("recipe_detail", recipe_id=recipe_id))
+            return redirect(url_for("main.recipe_detail", recipe_id=recipe_id))
 
         except sqlite3.Error as e:
             conn.rollback()
@@ -883,24 +1179,11 @@ def edit_recipe(recipe_id):
                 conn.close()
 
     else:  # GET request: Display the form with existing data
-        # Fetch existing ingredients and categories for pre-filling
-        ingredients = cursor.execute(
-            "SELECT name, quantity_unit FROM ingredients WHERE recipe_id = ?",
-            (recipe_id,)
-        ).fetchall()
-
         # Fetch all categories to populate the select dropdown
         all_categories = cursor.execute("SELECT id, name FROM categories ORDER BY name").fetchall()
 
-        # Fetch categories currently associated with this recipe to mark them as selected
-        selected_categories_current = cursor.execute(
-            "SELECT category_id FROM recipe_categories WHERE recipe_id = ?",
-            (recipe_id,)
-        ).fetchall()
-        selected_category_ids = [str(cat["category_id"]) for cat in selected_categories_current]
-
-        # Attach ingredients to the recipe dictionary so the template can access them as recipe.ingredients
-        recipe['ingredients'] = ingredients
+        # Categories currently associated with this recipe are marked as selected
+        selected_category_ids = [str(category.id) for category in cached_recipe.categories]
 
         conn.close()
 
@@ -911,7 +1194,7 @@ def edit_recipe(recipe_id):
                                editing=True)
 
 
-@app.route("/delete_recipe/<int:recipe_id>", methods=["POST"])
+@bp.route("/delete_recipe/<int:recipe_id>", methods=["POST"])
 @login_required
 def delete_recipe(recipe_id):
     """Allow user to delete their own recipe."""
@@ -927,19 +1210,19 @@ def delete_recipe(recipe_id):
         if recipe is None or recipe["user_id"] != session["user_id"]:
             flash("Recipe not found or you don't have permission to delete it.", "danger")
             conn.close()
-            return redirect(url_for("index"))
+            return redirect(url_for("main.index"))
 
         # Get the filename before the database record is deleted
         image_filename = recipe["image_filename"]
 
         # If an image exists, delete the physical file from the server
         if image_filename:
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], image_filename)
+            filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], image_filename)
             if os.path.exists(filepath):
                 try:
                     os.remove(filepath)
                 except OSError as e:
-                    print(f"Error deleting image file {filepath}: {e}")
+                    logger.warning("Could not delete image", extra={"path": filepath, "error": str(e)})
                     flash(f"Error deleting associated image file: {e}", "warning")
 
         # Delete all database entries associated with the recipe
@@ -949,21 +1232,22 @@ def delete_recipe(recipe_id):
         cursor.execute("DELETE FROM recipes WHERE id = ?", (recipe_id,))
 
         conn.commit()
+        invalidate_recipe(recipe_id)
         flash("Recipe deleted successfully!", "success")
-        return redirect(url_for("index"))
+        return redirect(url_for("main.index"))
 
     except sqlite3.Error as e:
         conn.rollback()
         flash(f"An error occurred while deleting the recipe: {e}", "danger")
-        print(f"Database error during delete: {e}")
-        return redirect(url_for("recipe_detail", recipe_id=recipe_id))
+        logger.error("Database error during delete", extra={"recipe_id": recipe_id, "error": str(e)})
+        return redirect(url_for("main.recipe_detail", recipe_id=recipe_id))
 
     finally:
         if conn:
             conn.close()
 
 
-@app.route("/change_password", methods=["GET", "POST"])
+@bp.route("/change_password", methods=["GET", "POST"])
 @login_required
 def change_password():
     """Allow user to change their password."""
@@ -998,52 +1282,52 @@ def change_password():
         # Get user's current hash from the database
         cursor.execute("SELECT hash FROM users WHERE id = ?", (session["user_id"],))
         user_data = cursor.fetchone()
+        # The hashing below may take a while (or be rejected), don't hold the connection meanwhile
+        conn.close()
 
         if user_data is None:  # it won't happen
-            conn.close()
             flash("User not found.", "danger")
             session.clear()
-            return redirect(url_for("login"))
+            return redirect(url_for("main.login"))
 
         current_hash = user_data["hash"]
 
         # Verify current password
-        if not check_password_hash(current_hash, current_password):
-            conn.close()
+        if not verify_password(current_hash, current_password):
             flash("Incorrect current password", "danger")
-            print(
-                f"DEBUG: Password Change Failed - Incorrect current password for user_id {session['user_id']}")
+            logger.info("Password change rejected: wrong current password", extra={"user_id": session["user_id"]})
             return render_template("change_password.html")
 
         # Hash the new password
-        new_hashed_password = generate_password_hash(new_password)
-        print(f"DEBUG: Password Change - New hashed password generated.")
+        new_hashed_password = hash_password(new_password)
 
         # Update the user's password in the database
+        conn = get_db_connection()
+        cursor = conn.cursor()
         try:
-            print(
-                f"DEBUG: Password Change - Attempting to UPDATE hash for user_id {session['user_id']}")
             cursor.execute("UPDATE users SET hash = ? WHERE id = ?",
                            (new_hashed_password, session["user_id"]))
+            # Log out every other session of this user, but keep this one
+            session["auth_version"] = bump_auth_version(cursor, session["user_id"])
             conn.commit()
-            print("DEBUG: Password Change - conn.commit() executed successfully.")
+            current_app.extensions["auth_cache"].invalidate(session["user_id"])
+            logger.info("Password changed", extra={"user_id": session["user_id"]})
             flash("Password changed successfully!", "success")
-            return redirect(url_for("index"))
+            return redirect(url_for("main.index"))
         except sqlite3.Error as e:
             conn.rollback()
-            print(f"DEBUG: Password Change - Database error during update: {e}")
+            logger.error("Database error during password change", extra={"user_id": session["user_id"], "error": str(e)})
             flash(f"An unexpected error occurred: {e}", "danger")
             return render_template("change_password.html")
         finally:
             if conn:
                 conn.close()
-                print("DEBUG: Password Change - Database connection closed.")
 
     else:  # GET request
         return render_template("change_password.html")
 
 
-@app.route("/forgot_password", methods=["GET", "POST"])
+@bp.route("/forgot_password", methods=["GET", "POST"])
 def forgot_password():
     """Allows user to request a password reset token."""
     if request.method == "POST":
@@ -1062,33 +1346,26 @@ def forgot_password():
 
         if user:
             user_id = user["id"]
-            # Generate a unique token
-            token = str(uuid.uuid4())
-            # Set token to expire in 5 minutes.
-            expires_at = datetime.now() + timedelta(minutes=5)
-            expires_at_str = expires_at.isoformat(sep=' ', timespec='seconds')  # Format for SQLite
 
             try:
-                # Store the token in the database
-                # Delete any existing tokens for this user to ensure only one active token
-                cursor.execute("DELETE FROM password_reset_tokens WHERE user_id = ?", (user_id,))
-                cursor.execute("INSERT INTO password_reset_tokens (user_id, token, expires_at) VALUES (?, ?, ?)",
-                               (user_id, token, expires_at_str))
+                # Only the token's hash is stored; it replaces any earlier token of this user
+                token, expires_at = reset_tokens.issue(conn, current_app.secret_key, user_id,
+                                                       ttl=current_app.config["RESET_TOKEN_TTL"])
                 conn.commit()
 
+                logger.info("Password reset requested",
+                            extra={"user_id": user_id, "token_ref": fingerprint(token), "expires_at": expires_at})
                 # --- SIMULATE EMAIL SENDING ---
-                print(f"\n--- PASSWORD RESET TOKEN (FOR DEVELOPMENT ONLY) ---")
-                print(f"User ID: {user_id}")
-                print(f"Token: {token}")
-                print(f"Expires at: {expires_at_str}")
-                # This is the link user would click
-                print(f"Link: {request.url_root}reset_password/{token}")
-                print(f"---------------------------------------------------\n")
+                # There is no mail server: in debug mode show the link the email would contain
+                # on the console. It never goes through the logs.
+                if current_app.debug:
+                    click.echo(f"Password reset link for user {user_id} (development only): "
+                               f"{request.url_root}reset_password/{token}", err=True)
                 # --- END SIMULATION ---
 
                 flash(
                     "If an account with that email exists, a password reset link has been sent to your email.", "info")
-                return redirect(url_for("login"))  # Redirect to login or a confirmation page
+                return redirect(url_for("main.login"))  # Redirect to login or a confirmation page
             except sqlite3.Error as e:
                 conn.rollback()
                 flash(f"An unexpected error occurred: {e}", "danger")
@@ -1098,7 +1375,7 @@ def forgot_password():
         else:
             # IMPORTANT!!! give a generic message to prevent user enumeration
             flash("If an account with that email exists, a password reset link has been sent to your email.", "info")
-            return redirect(url_for("login"))  # Redirect to login even if email not found
+            return redirect(url_for("main.login"))  # Redirect to login even if email not found
 
     else:  # GET request
         # --- Create a response object to add headers ---
@@ -1109,44 +1386,23 @@ def forgot_password():
         return response
 
 
-@app.route("/reset_password/<token>", methods=["GET", "POST"])
+@bp.route("/reset_password/<token>", methods=["GET", "POST"])
 def reset_password(token):
-    print(f"--- DEBUG: Entered reset_password route for token: {token} ---")
-    print(f"--- DEBUG: Request method: {request.method} ---")
-    print(f"--- DEBUG: Current user_id in session: {session.get('user_id')} ---")
-
-    if request.method == "GET":
-        print("--- DEBUG: Processing GET request for reset_password ---")
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute(
-            "SELECT user_id, expires_at FROM password_reset_tokens WHERE token = ?", (token,))
-        token_data = cursor.fetchone()
-        conn.close()
-
-        print(f"--- DEBUG: Token data from DB: {token_data} ---")
-        if not token_data:
-            print("--- DEBUG: Token NOT found in DB. ---")
-            flash("Invalid or expired password reset link. Please request a new one.", "danger")
-            return redirect(url_for("forgot_password"))
-
-        expires_at_dt = datetime.fromisoformat(token_data["expires_at"])
-        current_time = datetime.now()
-        print(f"--- DEBUG: Token expires at: {expires_at_dt} ---")
-        print(f"--- DEBUG: Current time: {current_time} ---")
+    conn = get_db_connection()
+    # One indexed lookup: unknown and expired tokens both come back as None. Done for the
+    # POST too, before anything is hashed: a made-up link must not cost a password hash
+    user_id = reset_tokens.lookup(conn, current_app.secret_key, token)
+    conn.close()
 
-        if expires_at_dt < current_time:
-            print("--- DEBUG: Token HAS expired. ---")
-            flash("Invalid or expired password reset link. Please request a new one.", "danger")
-            return redirect(url_for("forgot_password"))
+    if user_id is None:
+        logger.info("Password reset link invalid or expired", extra={"token_ref": fingerprint(token)})
+        flash("Invalid or expired password reset link. Please request a new one.", "danger")
+        return redirect(url_for("main.forgot_password"))
 
-        print("--- DEBUG: Token is VALID and NOT expired. Rendering reset_password.html ---")
+    if request.method == "GET":
         return render_template("reset_password.html", token=token)
 
     else:  # request.method == "POST"
-        print("--- DEBUG: Processing POST request for reset_password ---")
         new_password = request.form.get("new_password")
         confirmation = request.form.get("confirmation")
 
@@ -1162,33 +1418,31 @@ def reset_password(token):
             flash("Password must be at least 8 characters long.", "danger")
             return render_template("reset_password.html", token=token)
 
-        # Re-validate the token for the POST request
+        # Hash before using up the token, without holding a connection: if hashing is
+        # refused (busy) the link still works on the next try
+        hashed_password = hash_password(new_password)
+
         conn = get_db_connection()
         cursor = conn.cursor()
 
         try:
-            cursor.execute(
-                "SELECT user_id, expires_at FROM password_reset_tokens WHERE token = ?", (token,))
-            token_data = cursor.fetchone()
-
-            if not token_data or datetime.fromisoformat(token_data["expires_at"]) < datetime.now():
-                flash("Invalid or expired password reset link. Please request a new one.", "danger")
-                if token_data:
-                    cursor.execute("DELETE FROM password_reset_tokens WHERE token = ?", (token,))
+            # Re-validate and use up the token in one statement, so it works only once
+            user_id = reset_tokens.consume(cursor, current_app.secret_key, token)
+            if user_id is None:
                 conn.commit()
-                return redirect(url_for("forgot_password"))  # Redirect to request a new link
-
-            user_id = token_data["user_id"]
+                logger.info("Password reset link invalid or expired", extra={"token_ref": fingerprint(token)})
+                flash("Invalid or expired password reset link. Please request a new one.", "danger")
+                return redirect(url_for("main.forgot_password"))  # Redirect to request a new link
 
-            hashed_password = generate_password_hash(new_password)
             cursor.execute("UPDATE users SET hash = ? WHERE id = ?", (hashed_password, user_id))
-
-            # Delete the used password reset token from the database
-            cursor.execute("DELETE FROM password_reset_tokens WHERE token = ?", (token,))
+            # Anyone still logged in with the old password gets logged out
+            bump_auth_version(cursor, user_id)
             conn.commit()
+            current_app.extensions["auth_cache"].invalidate(user_id)
+            logger.info("Password reset", extra={"user_id": user_id})
 
             flash("Your password has been successfully reset. Please log in with your new password.", "success")
-            return redirect(url_for("login"))
+            return redirect(url_for("main.login"))
 
         except sqlite3.Error as e:
             conn.rollback()
@@ -1198,7 +1452,7 @@ def reset_password(token):
             conn.close()
 
 
-@app.route("/toggle_favorite", methods=["POST"])
+@bp.route("/toggle_favorite", methods=["POST"])
 @login_required
 def toggle_favorite():
     recipe_id = request.form.get("recipe_id")
@@ -1208,38 +1462,63 @@ def toggle_favorite():
         flash("Invalid recipe.", "error")
         return redirect(request.referrer or "/")  # Go back to the page user came from
 
+    # The card's form says which state it wants; without it (an older page) flip the current one
+    wanted = {"true": True, "false": False}.get(request.form.get("favorited"))
+
     conn = get_db_connection()
-    cursor = conn.cursor()
 
-    # Check if the recipe is already favorited by the user
-    cursor.execute("SELECT * FROM favorites WHERE user_id = ? AND recipe_id = ?",
-                   (user_id, recipe_id))
-    favorite = cursor.fetchone()
+    # Set or flip the favorite in one transaction (no SELECT first)
+    try:
+        favorited = set_favorite(conn, user_id, recipe_id, wanted)
+    except sqlite3.Error:
+        conn.close()
+        flash("Invalid recipe.", "error")
+        return redirect(request.referrer or "/")
+    conn.close()
 
-    if favorite:
-        # If already favorited, unfavorite it (delete from table)
-        cursor.execute("DELETE FROM favorites WHERE user_id = ? AND recipe_id = ?",
-                       (user_id, recipe_id))
-        conn.commit()
-        flash("Recipe removed from favorites!", "success")
-        redirect_to_favorites = True
-    else:
-        # If not favorited, favorite it (insert into table)
-        cursor.execute("INSERT INTO favorites (user_id, recipe_id) VALUES (?, ?)",
-                       (user_id, recipe_id))
-        conn.commit()
+    if favorited:
         flash("Recipe added to favorites!", "success")
         redirect_to_favorites = False
-
-    conn.close()
+    else:
+        flash("Recipe removed from favorites!", "success")
+        redirect_to_favorites = True
 
     if redirect_to_favorites:
-        return redirect(url_for('favorites'))
+        return redirect(url_for('main.favorites'))
     else:
         return redirect(request.referrer or "/")
 
 
-@app.route("/favorites")
+@bp.route("/api/favorites/<int:recipe_id>", methods=["POST"])
+@login_required
+def api_toggle_favorite(recipe_id):
+    """Favorite/unfavorite without a redirect, returns the new state as JSON.
+
+    A JSON body of {"favorited": true|false} sets the state (idempotent); without it the
+    current state is flipped.
+    """
+    wanted = (request.get_json(silent=True) or {}).get("favorited")
+    if wanted is not None and not isinstance(wanted, bool):
+        return jsonify(error="'favorited' must be true or false"), 400
+
+    conn = get_db_connection()
+    try:
+        # Checked up front so unfavoriting a missing recipe is a 404 too, not a no-op 200
+        if not conn.execute("SELECT 1 FROM recipes WHERE id = ?", (recipe_id,)).fetchone():
+            return jsonify(error="Recipe not found"), 404
+        favorited = set_favorite(conn, session["user_id"], recipe_id, wanted)
+    except sqlite3.IntegrityError:  # deleted in the meantime
+        return jsonify(error="Recipe not found"), 404
+    except sqlite3.Error:
+        logger.exception("Favorite toggle failed", extra={"recipe_id": recipe_id})
+        return jsonify(error="Could not update the favorite, please try again"), 503
+    finally:
+        conn.close()
+
+    return jsonify(recipe_id=recipe_id, favorited=favorited)
+
+
+@bp.route("/favorites")
 @login_required
 def favorites():
     """Display a list of recipes favorited by the current user."""
@@ -1248,13 +1527,18 @@ def favorites():
     conn = get_db_connection()
     cursor = conn.cursor()
 
+    validator = listing_validator(cursor, user_id)
+    if is_not_modified(validator):
+        conn.close()
+        return not_modified(validator)
+
     # Fetch recipes that the current user has favorited
     # I need to join them with 'recipes' table to get all recipe details
     # and join with the 'users' table to get the owner's username
     cursor.execute("""
         SELECT
             r.id, r.title, r.description, r.prep_time, r.cook_time, r.image_filename,
-            r.user_id, u.username AS owner_username,
+            r.user_id, r.version, u.username AS owner_username,
             CASE WHEN r.user_id = ? THEN 1 ELSE 0 END AS is_current_user_owner
         FROM favorites f
         JOIN recipes r ON f.recipe_id = r.id
@@ -1267,8 +1551,10 @@ def favorites():
     conn.close()
 
     # Pass system_user_id if needed for "By: (Default)"
-    return render_template("favorites.html", recipes=favorite_recipes, system_user_id=1)
+    return add_validator(make_response(
+        render_listing("favorites.html", recipes=favorite_recipes, system_user_id=1,
+                       favorite_ids=frozenset(recipe["id"] for recipe in favorite_recipes))), validator)
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,234 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+
+from flask import current_app, request, send_file
+from werkzeug.security import safe_join
+
+from lru import SizedLRU
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, .br files are simply not produced
+    brotli = None
+
+
+# Only text assets are worth precompressing (images are already compressed)
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.html', '.txt', '.json', '.map'}
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+HASH_LENGTH = 10
+
+# styles.3f2a1b9c0d.css -> stem "styles", hash "3f2a1b9c0d", ext ".css"
+FINGERPRINT_RE = re.compile(r'^(?P<stem>.+)\.(?P<hash>[0-9a-f]{%d})(?P<ext>\.[^./]+)$' % HASH_LENGTH)
+
+
+def file_digest(path):
+    """Short content hash used in fingerprinted filenames."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:HASH_LENGTH]
+
+
+def fingerprinted_name(filename, digest):
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}.{digest}{ext}"
+
+
+def _is_stale(source, target):
+    return not os.path.exists(target) or os.path.getmtime(target) < os.path.getmtime(source)
+
+
+def _write_atomically(target, data):
+    # Workers may precompress the same file at once; each writes its own temporary file and
+    # the rename makes sure a request only ever sees a complete .gz/.br
+    tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, target)
+
+
+def precompress(path):
+    """Write path.gz (and path.br when brotli is installed) next to the original if missing or stale."""
+    data = None
+
+    gz_path = path + '.gz'
+    if _is_stale(path, gz_path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        # mtime=0 keeps the output byte-for-byte reproducible between builds
+        _write_atomically(gz_path, gzip.compress(data, compresslevel=9, mtime=0))
+
+    if brotli is not None:
+        br_path = path + '.br'
+        if _is_stale(path, br_path):
+            if data is None:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            _write_atomically(br_path, brotli.compress(data, quality=11))
+
+
+class AssetManifest:
+    """Maps logical static filenames ('styles.css') to fingerprinted ones ('styles.<hash>.css').
+
+    Files under `exclude` (user uploads) are fingerprinted on first use and kept in a
+    SizedLRU of `lazy_cache_bytes`, since there is no end to them; the others stay in
+    plain dicts. With `precompress`, compressible files also get .gz/.br variants written
+    next to them (the build step, `python assets.py`); the app itself never writes to the
+    static folder.
+    """
+
+    def __init__(self, static_folder, exclude=(), precompress=False, lazy_cache_bytes=1024 * 1024):
+        self.static_folder = static_folder
+        # Directories build() skips, e.g. user uploads: they are fingerprinted on first use
+        self.exclude = {os.path.abspath(path) for path in exclude}
+        self.precompress = precompress
+        self._lock = threading.Lock()
+        self._by_logical = {}      # 'styles.css' -> ('styles.<hash>.css', mtime)
+        self._by_fingerprint = {}  # 'styles.<hash>.css' -> 'styles.css'
+        self._lazy = SizedLRU(lazy_cache_bytes)  # the same two maps for excluded files, keyed by direction
+
+    def _excluded(self, path):
+        path = os.path.abspath(path)
+        return any(path.startswith(directory + os.sep) for directory in self.exclude)
+
+    def build(self):
+        """Hash (and with `precompress`, compress) every file under the static folder, minus `exclude`."""
+        for root, dirs, files in os.walk(self.static_folder):
+            dirs[:] = [d for d in dirs
+                       if not d.startswith('.') and os.path.abspath(os.path.join(root, d)) not in self.exclude]
+            for name in files:
+                if name.startswith('.') or name.endswith(('.gz', '.br', '.tmp')):
+                    continue
+                relative = os.path.relpath(os.path.join(root, name), self.static_folder)
+                self.add(relative.replace(os.sep, '/'))
+        return self
+
+    def add(self, filename):
+        """Fingerprint a single file, returning its fingerprinted name (None if it doesn't exist)."""
+        path = safe_join(self.static_folder, filename)
+        if path is None or not os.path.isfile(path):
+            return None
+
+        mtime = os.path.getmtime(path)
+        fingerprint = fingerprinted_name(filename, file_digest(path))
+        if self.precompress and os.path.splitext(filename)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+            precompress(path)
+
+        if self._excluded(path):
+            size = 2 * (len(filename) + len(fingerprint)) + 200  # rough: two entries of short strings
+            self._lazy.put(("logical", filename), (fingerprint, mtime), size)
+            self._lazy.put(("fingerprint", fingerprint), filename, size)
+            return fingerprint
+        with self._lock:
+            previous = self._by_logical.get(filename)
+            if previous is not None:
+                self._by_fingerprint.pop(previous[0], None)
+            self._by_logical[filename] = (fingerprint, mtime)
+            self._by_fingerprint[fingerprint] = filename
+        return fingerprint
+
+    def url_name(self, filename, check_mtime=False):
+        """Name to put in the URL for a logical filename (falls back to the plain name)."""
+        entry = self._by_logical.get(filename) or self._lazy.get(("logical", filename))
+        if entry is not None and check_mtime:
+            path = safe_join(self.static_folder, filename)
+            if path is None or not os.path.isfile(path) or os.path.getmtime(path) != entry[1]:
+                entry = None
+        if entry is None:
+            # Files added after startup (e.g. new uploads) are fingerprinted on first use
+            return self.add(filename) or filename
+        return entry[0]
+
+    def items(self):
+        """(logical, fingerprinted) pairs currently known to the manifest."""
+        return [(logical, entry[0]) for logical, entry in sorted(self._by_logical.items())]
+
+    def resolve(self, filename):
+        """Map a requested fingerprinted name back to its logical name (None if not fingerprinted)."""
+        logical = self._by_fingerprint.get(filename) or self._lazy.get(("fingerprint", filename))
+        if logical is None:
+            match = FINGERPRINT_RE.match(filename)
+            # Another worker may have fingerprinted a file this one hasn't seen yet
+            if match and self.add(match['stem'] + match['ext']) == filename:
+                logical = match['stem'] + match['ext']
+        return logical
+
+
+def _negotiate_encoding(path):
+    """Pick the best precompressed variant of path that the client accepts."""
+    if os.path.splitext(path)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+        return None, path
+    accepted = request.accept_encodings
+    # Variants older than the file (edited since the last build step) are ignored
+    if accepted['br'] and not _is_stale(path, path + '.br'):
+        return 'br', path + '.br'
+    if accepted['gzip'] and not _is_stale(path, path + '.gz'):
+        return 'gzip', path + '.gz'
+    return None, path
+
+
+def send_static_asset(filename):
+    """Replacement for Flask's static view that understands fingerprinted names."""
+    manifest = current_app.extensions['assets']
+    logical = manifest.resolve(filename)
+    if logical is None:
+        # Plain (or outdated) name: default handler and default caching
+        return current_app.send_static_file(filename)
+
+    path = safe_join(manifest.static_folder, logical)
+    mimetype = mimetypes.guess_type(logical)[0] or 'application/octet-stream'
+    encoding, served_path = _negotiate_encoding(path)
+
+    accel_prefix = current_app.config.get('STATIC_ACCEL_REDIRECT')
+    if accel_prefix:
+        # Let the front proxy (nginx) send the file from an internal location
+        relative = os.path.relpath(served_path, manifest.static_folder).replace(os.sep, '/')
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + relative
+    else:
+        # send_file honours USE_X_SENDFILE (Apache / lighttpd) on its own
+        response = send_file(served_path, mimetype=mimetype, conditional=True,
+                             download_name=os.path.basename(logical))
+
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if os.path.splitext(path)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+        response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+
+def init_assets(app):
+    """Build the manifest and route url_for('static', ...) through fingerprinted names.
+
+    Only hashes: the .gz/.br variants come from the build step (`python assets.py`), so
+    the app starts fine from a read-only static folder.
+    """
+    # Uploads can run into the thousands; hashing them all would make every start slower
+    manifest = AssetManifest(app.static_folder, exclude=[app.config['UPLOAD_FOLDER']]).build()
+    app.extensions['assets'] = manifest
+
+    @app.url_defaults
+    def fingerprint_static_url(endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            # In debug mode pick up edits to styles.css / script.js without a restart
+            values['filename'] = manifest.url_name(values['filename'], check_mtime=app.debug)
+
+    app.view_functions['static'] = send_static_asset
+    return manifest
+
+
+if __name__ == '__main__':
+    # Build step: fingerprint and precompress everything ahead of deployment
+    static_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    manifest = AssetManifest(static_folder, exclude=[os.path.join(static_folder, 'uploads')],
+                             precompress=True).build()
+    for logical, fingerprint in manifest.items():
+        print(f"{logical} -> {fingerprint}")
+    if brotli is None:
+        print("brotli not installed: only .gz variants were written.")
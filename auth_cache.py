@@ -0,0 +1,65 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class AuthCache:
+    """Small TTL cache of user id -> (username, auth_version) used by login_required.
+
+    Bumping users.auth_version revokes every session of that user: this worker sees it
+    immediately (invalidate()), other workers within `ttl` seconds.
+    """
+
+    def __init__(self, ttl=30, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # user_id -> (username, auth_version, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, load):
+        """Return (username, auth_version) for user_id, or None if the user no longer exists.
+
+        `load(user_id)` is only called on a miss or once the entry is older than the TTL.
+        """
+        now = time.monotonic()
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[2] > now:
+            self.hits += 1
+            return entry[0], entry[1]
+
+        self.misses += 1
+        loaded = load(user_id)
+        if loaded is None:
+            self.invalidate(user_id)
+            return None
+        with self._lock:
+            self._entries[user_id] = (loaded[0], loaded[1], now + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return loaded
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def bump_auth_version(cursor, user_id):
+    """Invalidate every existing session of user_id (caller commits)."""
+    cursor.execute("UPDATE users SET auth_version = auth_version + 1 WHERE id = ?", (user_id,))
+    return cursor.execute("SELECT auth_version FROM users WHERE id = ?", (user_id,)).fetchone()[0]
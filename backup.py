@@ -0,0 +1,279 @@
+"""Online backups of recipes.db and static/uploads.
+
+Usage:
+    python backup.py create [backup_dir]             (default: backups/)
+    python backup.py verify <snapshot_dir>
+    python backup.py restore <snapshot_dir> [database] [uploads_dir]
+
+The database is copied with SQLite's backup API a few pages at a time, so the app keeps
+reading and writing while it runs (copying the file itself can catch a half-written
+state next to the -wal). Uploads are stored once per content hash under objects/, so a
+new snapshot only copies images that changed since the last one.
+
+    backups/
+        objects/ab/ab12...        uploaded images, by sha256
+        snapshots/20240101T120000Z/
+            recipes.db
+            manifest.json         hashes and sizes of everything restore needs
+
+The app runs `create` on its own every BACKUP_INTERVAL seconds when BACKUP_DIR is set
+(see maintenance.py).
+"""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import time
+
+import schema
+
+UPLOADS_DIR = os.path.join("static", "uploads")
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class _Restarted(Exception):
+    pass
+
+
+def backup_database(source, destination, pages=256, sleep=0.005, max_restarts=3):
+    """Copy `source` to `destination` with Connection.backup, `pages` pages per step.
+
+    Each step holds a read lock on the source; between steps the lock is released for
+    `sleep` seconds. A write from another connection between steps makes SQLite restart
+    the copy, so on a busy database the copy could go on forever: after `max_restarts`
+    it starts over as a single step, which in WAL mode reads one consistent snapshot
+    without blocking writers. Returns timing stats; lock_seconds is the time spent
+    inside steps.
+    """
+    stats = {"restarts": 0}
+    steps = []
+
+    def progress(status, remaining, total):
+        now = time.perf_counter()
+        steps.append(now - last[0])
+        last[0] = now + sleep  # the next step starts after the sleep
+        if remaining > last[1]:
+            stats["restarts"] += 1
+            if stats["restarts"] > max_restarts:
+                raise _Restarted()
+        last[1] = remaining
+
+    started = time.perf_counter()
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(destination)
+    try:
+        last = [time.perf_counter(), float("inf")]
+        try:
+            src.backup(dst, pages=pages, progress=progress, sleep=sleep)
+            stats["mode"] = f"{pages} pages per step"
+        except _Restarted:
+            last = [time.perf_counter(), float("inf")]
+            src.backup(dst, pages=-1, progress=progress)
+            stats["mode"] = "single step"
+        page_size = dst.execute("PRAGMA page_size").fetchone()[0]
+        page_count = dst.execute("PRAGMA page_count").fetchone()[0]
+        user_version = dst.execute("PRAGMA user_version").fetchone()[0]
+        # A standalone copy: no -wal next to it
+        dst.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        dst.close()
+        src.close()
+    return {
+        "seconds": time.perf_counter() - started,
+        "lock_seconds": sum(steps),
+        "max_step_seconds": max(steps, default=0.0),
+        "steps": len(steps),
+        "page_size": page_size,
+        "page_count": page_count,
+        "user_version": user_version,
+        **stats,
+    }
+
+
+def integrity_check(database):
+    conn = sqlite3.connect(f"file:{database}?mode=ro", uri=True)
+    try:
+        return [row[0] for row in conn.execute("PRAGMA integrity_check")]
+    finally:
+        conn.close()
+
+
+def snapshot_uploads(uploads_dir, objects_dir, previous=None):
+    """Store new or changed uploads under objects/ and return {relative path: entry}.
+
+    Files whose size and mtime match the previous manifest reuse its hash instead of
+    being read again.
+    """
+    previous = previous or {}
+    uploads = {}
+    copied_bytes = 0
+    for dirpath, _, filenames in os.walk(uploads_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            relpath = os.path.relpath(path, uploads_dir)
+            stat = os.stat(path)
+            entry = previous.get(relpath)
+            if not (entry and entry["bytes"] == stat.st_size and entry["mtime"] == stat.st_mtime):
+                entry = {"sha256": file_sha256(path), "bytes": stat.st_size, "mtime": stat.st_mtime}
+            target = os.path.join(objects_dir, entry["sha256"][:2], entry["sha256"])
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copy2(path, target + ".tmp")
+                os.replace(target + ".tmp", target)
+                copied_bytes += stat.st_size
+            uploads[relpath] = entry
+    return uploads, copied_bytes
+
+
+def latest_manifest(backup_dir):
+    snapshots_dir = os.path.join(backup_dir, "snapshots")
+    if not os.path.isdir(snapshots_dir):
+        return None
+    for name in sorted(os.listdir(snapshots_dir), reverse=True):
+        path = os.path.join(snapshots_dir, name, "manifest.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+    return None
+
+
+def create_snapshot(backup_dir, database=schema.DATABASE, uploads_dir=UPLOADS_DIR, pages=256, keep=None):
+    """Back up the database and uploads into a new snapshot; returns its manifest."""
+    created_at = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    snapshot_dir = os.path.join(backup_dir, "snapshots", created_at)
+    objects_dir = os.path.join(backup_dir, "objects")
+    os.makedirs(snapshot_dir)
+
+    previous = latest_manifest(backup_dir)
+    db_path = os.path.join(snapshot_dir, os.path.basename(database))
+    db_stats = backup_database(database, db_path, pages=pages)
+    integrity = integrity_check(db_path)
+    if integrity != ["ok"]:
+        raise RuntimeError(f"Backup of {database} failed integrity_check: {integrity[:5]}")
+
+    started = time.perf_counter()
+    uploads, copied_bytes = snapshot_uploads(uploads_dir, objects_dir,
+                                             previous["uploads"] if previous else None)
+    uploads_seconds = time.perf_counter() - started
+
+    db_bytes = os.path.getsize(db_path)
+    manifest = {
+        "created_at": created_at,
+        "database": {
+            "file": os.path.basename(db_path),
+            "source": database,
+            "sha256": file_sha256(db_path),
+            "bytes": db_bytes,
+            "integrity_check": "ok",
+            **db_stats,
+        },
+        "uploads_dir": uploads_dir,
+        "uploads": uploads,
+        "stats": {
+            "database_mb_per_s": db_bytes / 1e6 / db_stats["seconds"] if db_stats["seconds"] else None,
+            "uploads_files": len(uploads),
+            "uploads_copied_bytes": copied_bytes,
+            "uploads_seconds": uploads_seconds,
+        },
+    }
+    with open(os.path.join(snapshot_dir, "manifest.json.tmp"), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(os.path.join(snapshot_dir, "manifest.json.tmp"), os.path.join(snapshot_dir, "manifest.json"))
+
+    if keep:
+        prune(backup_dir, keep)
+    return manifest
+
+
+def prune(backup_dir, keep):
+    """Keep the newest `keep` snapshots and the objects they still reference."""
+    snapshots_dir = os.path.join(backup_dir, "snapshots")
+    names = sorted(os.listdir(snapshots_dir))
+    for name in names[:-keep]:
+        shutil.rmtree(os.path.join(snapshots_dir, name))
+    referenced = set()
+    for name in names[-keep:]:
+        path = os.path.join(snapshots_dir, name, "manifest.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                referenced.update(entry["sha256"] for entry in json.load(f)["uploads"].values())
+    objects_dir = os.path.join(backup_dir, "objects")
+    for dirpath, _, filenames in os.walk(objects_dir):
+        for filename in filenames:
+            if filename not in referenced:
+                os.remove(os.path.join(dirpath, filename))
+
+
+def verify_snapshot(snapshot_dir):
+    """List of problems with a snapshot (empty if it can be restored)."""
+    with open(os.path.join(snapshot_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+    objects_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(snapshot_dir))), "objects")
+    problems = []
+    db_path = os.path.join(snapshot_dir, manifest["database"]["file"])
+    if file_sha256(db_path) != manifest["database"]["sha256"]:
+        problems.append(f"{db_path}: checksum mismatch")
+    elif integrity_check(db_path) != ["ok"]:
+        problems.append(f"{db_path}: integrity_check failed")
+    for relpath, entry in manifest["uploads"].items():
+        target = os.path.join(objects_dir, entry["sha256"][:2], entry["sha256"])
+        if not os.path.exists(target):
+            problems.append(f"{relpath}: missing object {entry['sha256']}")
+        elif file_sha256(target) != entry["sha256"]:
+            problems.append(f"{relpath}: object {entry['sha256']} is corrupt")
+    return problems
+
+
+def restore_snapshot(snapshot_dir, database=schema.DATABASE, uploads_dir=UPLOADS_DIR):
+    """Put a verified snapshot back in place. Stop the app first."""
+    problems = verify_snapshot(snapshot_dir)
+    if problems:
+        raise RuntimeError("Snapshot failed verification:\n" + "\n".join(problems))
+    with open(os.path.join(snapshot_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+    objects_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(snapshot_dir))), "objects")
+
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(database + suffix):
+            os.remove(database + suffix)
+    shutil.copy2(os.path.join(snapshot_dir, manifest["database"]["file"]), database + ".restore")
+    os.replace(database + ".restore", database)
+    for relpath, entry in manifest["uploads"].items():
+        path = os.path.join(uploads_dir, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copy2(os.path.join(objects_dir, entry["sha256"][:2], entry["sha256"]), path)
+    return manifest
+
+
+def summary(manifest):
+    database, stats = manifest["database"], manifest["stats"]
+    return (f"Snapshot {manifest['created_at']}: database {database['bytes'] / 1e6:.1f} MB in "
+            f"{database['seconds']:.2f}s ({stats['database_mb_per_s'] or 0:.1f} MB/s, "
+            f"{database['mode']}, {database['steps']} steps, {database['restarts']} restarts, "
+            f"read lock held {database['lock_seconds'] * 1000:.0f} ms total, "
+            f"{database['max_step_seconds'] * 1000:.1f} ms max); uploads {stats['uploads_files']} files, "
+            f"{stats['uploads_copied_bytes'] / 1e6:.1f} MB new in {stats['uploads_seconds']:.2f}s")
+
+
+if __name__ == "__main__":
+    command, args = (sys.argv[1], sys.argv[2:]) if len(sys.argv) > 1 else ("create", [])
+    if command == "create":
+        print(summary(create_snapshot(args[0] if args else "backups")))
+    elif command == "verify" and args:
+        problems = verify_snapshot(args[0])
+        print("\n".join(problems) if problems else "OK")
+        sys.exit(1 if problems else 0)
+    elif command == "restore" and args:
+        restore_snapshot(*args)
+        print(f"Restored {args[0]}")
+    else:
+        sys.exit(__doc__)
@@ -0,0 +1,102 @@
+"""Memory and throughput of the streaming export (export.py) on a large synthetic database.
+
+Usage: python benchmarks/export_memory.py [recipes] [--format jsonl|csv] [--dir DIR]
+
+Builds a database with `recipes` recipes (default 1,000,000), three ingredients and one
+category each, then exports all of it and samples the process RSS after every tenth of
+the records. Memory is flat when the last sample is about the first one: the export
+only ever holds one batch. Exits with status 1 if RSS grows by more than --max-growth MB.
+"""
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db  # noqa: E402
+import export  # noqa: E402
+import migrate  # noqa: E402
+
+
+def rss_mb():
+    # Current RSS from /proc where there is one, else the peak (ru_maxrss is KB on Linux)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def build(database, count):
+    migrate.upgrade(database)
+    conn = db.connect(database, "balanced")
+    with conn:
+        user_id = conn.execute("INSERT INTO users (username, hash, email) VALUES ('bench', 'x', 'bench@example.com')"
+                               ).lastrowid
+        category_ids = [row[0] for row in conn.execute("SELECT id FROM categories")]
+        first_id = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM recipes").fetchone()[0]
+        for start in range(0, count, 10000):
+            ids = range(first_id + start, first_id + min(start + 10000, count))
+            conn.executemany("INSERT INTO recipes (id, user_id, title, description, instructions, prep_time, "
+                             "cook_time) VALUES (?, ?, ?, 'A synthetic recipe', 'Mix and cook.', '5 mins', '10 mins')",
+                             ((i, user_id, f"Recipe {i}") for i in ids))
+            conn.executemany("INSERT INTO ingredients (recipe_id, name, quantity_unit) VALUES (?, ?, '1 cup')",
+                             ((i, name) for i in ids for name in ("Flour", "Water", "Salt")))
+            conn.executemany("INSERT INTO recipe_categories (recipe_id, category_id) VALUES (?, ?)",
+                             ((i, category_ids[i % len(category_ids)]) for i in ids))
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("recipes", nargs="?", type=int, default=1_000_000)
+    parser.add_argument("--format", choices=export.FORMATS, default="jsonl")
+    parser.add_argument("--dir", help="where to create the database (default: a temporary directory)")
+    parser.add_argument("--max-growth", type=float, default=20, help="allowed RSS growth in MB (default 20)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as workdir:
+        database = os.path.join(workdir, "recipes.db")
+        started = time.perf_counter()
+        build(database, args.recipes)
+        print(f"built {args.recipes:,} recipes in {time.perf_counter() - started:.1f}s")
+
+        conn = db.connect(database)
+        total = conn.execute("SELECT COUNT(*) FROM recipes").fetchone()[0]
+        step = max(total // 10, 1)
+        records = exported_bytes = 0
+        samples = []
+        started = time.perf_counter()
+
+        def counted(rows):
+            nonlocal records
+            for row in rows:
+                records += 1
+                if records % step == 0:
+                    samples.append((records, rss_mb()))
+                yield row
+
+        for chunk in export.export_chunks(counted(export.iter_recipes(conn)), args.format):
+            exported_bytes += len(chunk)
+        elapsed = time.perf_counter() - started
+        conn.close()
+
+    print(f"exported {records:,} recipes, {exported_bytes / 1e6:.0f} MB of {args.format} in {elapsed:.1f}s "
+          f"({records / elapsed:,.0f} recipes/s)\n")
+    for count, rss in samples:
+        print(f"  {count:>10,} records  RSS {rss:7.1f} MB")
+    growth = samples[-1][1] - samples[0][1] if samples else 0.0
+    print(f"\nRSS growth after the first tenth: {growth:+.1f} MB (max {args.max_growth:.0f} MB)")
+    if records != total or growth > args.max_growth:
+        print("FAIL")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""Latency of the fuzzy search (fuzzy.py) on a large synthetic catalog.
+
+Usage: python benchmarks/fuzzy_search.py [recipes] [--vocabulary N] [--dir DIR]
+
+Builds a database with `recipes` recipes (default 200,000) whose titles and ingredients
+are drawn from N made-up words (default 30,000), builds the trigram index, then searches
+for misspellings of random words (one letter dropped, doubled, swapped or replaced) the
+way index() does when the exact search found nothing: suggest() plus fuzzy_recipes() with
+index()'s columns and owner filter. Reports the build time, the index size, how often
+the intended word was suggested first, and the latency of the whole fuzzy search. Exits
+with status 1 if the 99th percentile takes longer than --max-ms.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db  # noqa: E402
+import fuzzy  # noqa: E402
+import migrate  # noqa: E402
+from export import recipe_filter  # noqa: E402
+
+# index()'s SELECT list
+COLUMNS = """
+    r.id, r.title, r.description, r.instructions, r.prep_time, r.cook_time,
+    r.user_id, r.image_filename, r.version, u.username AS owner_username
+"""
+
+CONSONANTS = "bcdfghklmnprstvz"
+VOWELS = "aeiou"
+
+
+def make_vocabulary(count, rng):
+    vocabulary = set()
+    while len(vocabulary) < count:
+        vocabulary.add("".join(rng.choice(CONSONANTS) + rng.choice(VOWELS) for _ in range(rng.randint(2, 5))))
+    return sorted(vocabulary)
+
+
+def misspell(word, rng):
+    i = rng.randrange(1, len(word) - 1)
+    edit = rng.choice(("drop", "double", "swap", "replace"))
+    if edit == "drop":
+        return word[:i] + word[i + 1:]
+    if edit == "double":
+        return word[:i] + word[i] + word[i:]
+    if edit == "swap":
+        return word[:i - 1] + word[i] + word[i - 1] + word[i + 1:]
+    return word[:i] + rng.choice(VOWELS if word[i] in VOWELS else CONSONANTS) + word[i + 1:]
+
+
+def build(database, count, vocabulary, rng):
+    migrate.upgrade(database)
+    conn = db.connect(database, "balanced")
+    ingredient_names = [" ".join(rng.sample(vocabulary, 2)) for _ in range(len(vocabulary) // 5)]
+    with conn:
+        user_id = conn.execute("INSERT INTO users (username, hash, email) VALUES ('bench', 'x', 'bench@example.com')"
+                               ).lastrowid
+        first_id = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM recipes").fetchone()[0]
+        for start in range(0, count, 10000):
+            ids = range(first_id + start, first_id + min(start + 10000, count))
+            conn.executemany("INSERT INTO recipes (id, user_id, title, description, instructions) "
+                             "VALUES (?, ?, ?, '', 'Cook.')",
+                             ((i, user_id, " ".join(rng.sample(vocabulary, 3)).title()) for i in ids))
+            conn.executemany("INSERT INTO ingredients (recipe_id, name, quantity_unit) VALUES (?, ?, '1 cup')",
+                             ((i, rng.choice(ingredient_names)) for i in ids for _ in range(3)))
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("recipes", nargs="?", type=int, default=200_000)
+    parser.add_argument("--vocabulary", type=int, default=30_000)
+    parser.add_argument("--lookups", type=int, default=500)
+    parser.add_argument("--dir", help="where to create the database (default: a temporary directory)")
+    parser.add_argument("--max-ms", type=float, default=10, help="allowed p99 search time (default 10 ms)")
+    args = parser.parse_args()
+    rng = random.Random(42)
+    vocabulary = make_vocabulary(args.vocabulary, rng)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as workdir:
+        database = os.path.join(workdir, "recipes.db")
+        started = time.perf_counter()
+        build(database, args.recipes, vocabulary, rng)
+        print(f"built {args.recipes:,} recipes from {len(vocabulary):,} words in {time.perf_counter() - started:.1f}s")
+
+        conn = db.connect(database)
+        user_id = conn.execute("SELECT id FROM users WHERE username = 'bench'").fetchone()[0]
+        where_clauses, params = recipe_filter(user_id)
+        index = fuzzy.TrigramIndex()
+        started = time.perf_counter()
+        index.refresh(conn)
+        build_seconds = time.perf_counter() - started
+
+        postings = sum(len(posting) for posting in index.postings.values())
+        recipe_ids = sum(len(recipes) for recipes in index.recipes)
+        print(f"trigram index: {len(index.terms):,} terms, {len(index.postings):,} trigrams, "
+              f"{(postings + recipe_ids) * 4 / 1e6:.1f} MB of postings, built in {build_seconds:.2f}s")
+
+        timings = []
+        first = found = 0
+        for word in rng.sample([word for word in vocabulary if len(word) >= 6], args.lookups):
+            typo = misspell(word, rng)
+            started = time.perf_counter()
+            matches = index.suggest(conn, typo)
+            recipes = fuzzy.fuzzy_recipes(conn, index, COLUMNS, matches, where_clauses, params) if matches else []
+            timings.append((time.perf_counter() - started) * 1000)
+            first += bool(matches) and matches[0][0][0] == word
+            found += bool(recipes)
+        conn.close()
+
+    timings.sort()
+    p99 = timings[int(len(timings) * 0.99) - 1]
+    print(f"{args.lookups} misspelled searches: intended word first {first / args.lookups:.0%}, "
+          f"recipes found {found / args.lookups:.0%}, "
+          f"median {statistics.median(timings):.2f} ms, p99 {p99:.2f} ms, max {timings[-1]:.2f} ms "
+          f"(max {args.max_ms:.0f} ms)")
+    if p99 > args.max_ms:
+        print("FAIL")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
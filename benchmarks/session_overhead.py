@@ -0,0 +1,100 @@
+"""Per-request session overhead for each SESSION_BACKEND.
+
+Usage: python benchmarks/session_overhead.py [requests]
+
+Each backend is mounted on a bare Flask app so the numbers measure the session
+layer only (open + save), not templates or recipe queries.
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, flash, session  # noqa: E402
+
+from session_store import SESSION_BACKENDS, init_session  # noqa: E402
+
+
+def make_app(backend, workdir):
+    app = Flask(__name__)
+    app.config.update(
+        SECRET_KEY="benchmark",
+        SESSION_BACKEND=backend,
+        SESSION_PERMANENT=False,
+        SESSION_SQLITE_PATH=os.path.join(workdir, "sessions.db"),
+        SESSION_FILE_DIR=os.path.join(workdir, "flask_session"),
+    )
+    init_session(app)
+
+    @app.route("/login")
+    def login():
+        session["user_id"] = 42
+        session["username"] = "benchmark"
+        return ""
+
+    @app.route("/read")
+    def read():
+        # Typical page view: the session is only read
+        return str(session.get("user_id"))
+
+    @app.route("/flash")
+    def write():
+        # Typical form post: a flash message forces a write
+        flash("Saved!", "success")
+        return ""
+
+    @app.route("/consume")
+    def consume():
+        session.pop("_flashes", None)
+        return ""
+
+    return app
+
+
+def bench(app, n):
+    client = app.test_client()
+    client.get("/login")
+    results = {}
+
+    start = time.perf_counter()
+    for _ in range(n):
+        client.get("/read")
+    results["read"] = (time.perf_counter() - start) / n
+
+    start = time.perf_counter()
+    for _ in range(n):
+        client.get("/flash")
+        client.get("/consume")
+    results["write"] = (time.perf_counter() - start) / (2 * n)
+    return results
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    # Baseline without any session access, to subtract Flask's own request overhead
+    baseline_app = Flask(__name__)
+    baseline_app.route("/read")(lambda: "")
+    client = baseline_app.test_client()
+    start = time.perf_counter()
+    for _ in range(n):
+        client.get("/read")
+    baseline = (time.perf_counter() - start) / n
+
+    print(f"{n} requests per scenario, bare request overhead {baseline * 1e6:.0f} us\n")
+    print(f"{'backend':<12}{'read (us)':>12}{'write (us)':>12}")
+    for backend in SESSION_BACKENDS:
+        with tempfile.TemporaryDirectory() as workdir:
+            try:
+                results = bench(make_app(backend, workdir), n)
+            except ImportError as e:
+                print(f"{backend:<12}skipped ({e})")
+                continue
+        print(f"{backend:<12}{(results['read'] - baseline) * 1e6:>12.0f}"
+              f"{(results['write'] - baseline) * 1e6:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Route throughput and fsync count for each SQLite storage profile (db.PROFILES).
+
+Usage: python benchmarks/storage_profiles.py [iterations] [--dir DIR]
+
+For every profile a fresh database is created and the same route suite is run through
+the test client: listing, search, my recipes, favorites and recipe pages (reads), and
+adding, editing and favoriting recipes (writes). fsync/fdatasync calls are counted
+with strace when it is installed, in a second run so tracing doesn't skew the timings.
+
+Run it on the disk the app will use (--dir): on tmpfs an fsync costs nothing and the
+profiles look alike.
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db  # noqa: E402
+
+READ_ROUTES = ("/", "/?owner_filter=all_recipes&query=e", "/my_recipes", "/favorites", "/recipe/{recipe_id}")
+
+
+def run_suite(profile, workdir, iterations):
+    """Run the route suite in this process; returns counts and timings."""
+    import migrate
+    from app import create_app
+
+    database = os.path.join(workdir, "recipes.db")
+    migrate.upgrade(database)
+    app = create_app({
+        "DATABASE": database,
+        "DB_PROFILE": profile,
+        "SESSION_SQLITE_PATH": os.path.join(workdir, "sessions.db"),
+        "UPLOAD_FOLDER": os.path.join(workdir, "uploads"),
+        "PASSWORD_HASH_WORKERS": 0,
+        "PASSWORD_HASH_METHOD": "pbkdf2:sha256:1000",  # the hash isn't what's being measured
+        "CONDITIONAL_GET": False,
+        "MAINTENANCE": False,
+    })
+    client = app.test_client()
+    client.post("/register", data={"username": "bench", "email": "bench@example.com",
+                                   "password": "benchmark1", "confirmation": "benchmark1"})
+    client.post("/login", data={"username_or_email": "bench", "password": "benchmark1"})
+
+    recipe = {"title": "Benchmark stew", "description": "d", "instructions": "i", "prep_time": "5 mins",
+              "cook_time": "10 mins", "ingredient_name_0": "Salt", "ingredient_qty_0": "1 tsp", "categories": ["1"]}
+    response = client.post("/add_recipe", data=recipe)
+    recipe_id = int(response.location.rsplit("/", 1)[1])
+
+    reads = writes = 0
+    read_time = write_time = 0.0
+    for i in range(iterations):
+        start = time.perf_counter()
+        for route in READ_ROUTES:
+            client.get(route.format(recipe_id=recipe_id))
+        read_time += time.perf_counter() - start
+        reads += len(READ_ROUTES)
+
+        start = time.perf_counter()
+        client.post("/add_recipe", data=dict(recipe, title=f"Benchmark stew {i}"))
+        client.post(f"/edit_recipe/{recipe_id}", data=dict(recipe, title=f"Benchmark stew v{i}"))
+        client.post(f"/api/favorites/{recipe_id}", json={})
+        write_time += time.perf_counter() - start
+        writes += 3
+    return {"reads": reads, "read_time": read_time, "writes": writes, "write_time": write_time}
+
+
+def child(args):
+    with tempfile.TemporaryDirectory(dir=args.dir) as workdir:
+        print(json.dumps(run_suite(args.profile, workdir, args.iterations)))
+
+
+def run_child(profile, args, strace=None):
+    command = [sys.executable, os.path.abspath(__file__), str(args.iterations), "--child", profile]
+    if args.dir:
+        command += ["--dir", args.dir]
+    env = dict(os.environ, DB_PROFILE=profile)
+    if strace:
+        command = [strace, "-f", "-c", "-e", "trace=fsync,fdatasync"] + command
+    result = subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    results = json.loads(result.stdout.strip().splitlines()[-1])
+    if strace:
+        # strace -c summary rows: % time, seconds, usecs/call, calls, [errors,] syscall
+        results["fsyncs"] = sum(int(match.group(1)) for match in
+                                re.finditer(r"^\s*[\d.]+\s+[\d.]+\s+\d+\s+(\d+)\s+(?:\d+\s+)?f(?:data)?sync$",
+                                            result.stderr, re.MULTILINE))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("iterations", nargs="?", type=int, default=100)
+    parser.add_argument("--dir", help="where to create the databases (default: the project directory)")
+    parser.add_argument("--child", dest="profile", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.dir is None:
+        args.dir = ROOT
+    if args.profile:
+        return child(args)
+
+    strace = shutil.which("strace")
+    print(f"{args.iterations} iterations of {len(READ_ROUTES)} reads + 3 writes, databases in {args.dir}\n")
+    print(f"{'profile':<12}{'reads/s':>10}{'writes/s':>10}{'fsyncs':>10}{'fsyncs/write':>14}")
+    for profile in db.PROFILES:
+        results = run_child(profile, args)
+        fsyncs = run_child(profile, args, strace)["fsyncs"] if strace else None
+        per_write = f"{fsyncs / results['writes']:.2f}" if fsyncs is not None else "n/a"
+        print(f"{profile:<12}{results['reads'] / results['read_time']:>10.0f}"
+              f"{results['writes'] / results['write_time']:>10.0f}"
+              f"{fsyncs if fsyncs is not None else 'n/a':>10}{per_write:>14}")
+    if not strace:
+        print("\nfsync counts need strace (e.g. apt install strace)")
+
+
+if __name__ == "__main__":
+    main()
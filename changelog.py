@@ -0,0 +1,118 @@
+import os
+import sqlite3
+import threading
+
+import schema
+
+
+class ChangeLog:
+    """Per-worker reader of the change_log table (see schema.create_change_log_triggers).
+
+    At the start of each request the worker asks SQLite whether anyone committed since it
+    last looked (PRAGMA data_version, no table access). Only then does it read the new
+    change_log rows and hand each one to the handlers subscribed to its entity, so every
+    worker's in-process caches drop exactly the keys another worker changed.
+    """
+
+    def __init__(self, database, keep=10000):
+        self.database = database
+        self.keep = keep  # rows kept in change_log for slow workers to catch up with
+        self._handlers = {}  # entity -> [handler(entity_id, op)]
+        self._reset_handlers = []
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._data_version = None
+        self.last_seq = 0
+        self._next_prune = 0
+
+    def subscribe(self, entities, handler):
+        for entity in entities:
+            self._handlers.setdefault(entity, []).append(handler)
+
+    def on_reset(self, handler):
+        """Called when rows were missed (log pruned past us): drop everything."""
+        self._reset_handlers.append(handler)
+
+    def _connect(self):
+        # One connection per process; a forked worker must not reuse its parent's
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.database, check_same_thread=False)
+            self._pid = os.getpid()
+            self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            self.last_seq = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0]
+            self._next_prune = self.last_seq + self.keep
+        return self._conn
+
+    def poll(self):
+        """Apply changes committed by other connections since the last poll."""
+        with self._lock:
+            conn = self._connect()
+            data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return
+            self._data_version = data_version
+
+            # SELECT *: through_id (migration 0008) may not exist yet
+            rows = conn.execute("SELECT * FROM change_log WHERE seq > ? ORDER BY seq",
+                                (self.last_seq,)).fetchall()
+            if not rows:
+                return
+            if rows[0][0] != self.last_seq + 1:
+                for handler in self._reset_handlers:
+                    handler()
+            else:
+                for seq, entity, entity_id, op, *through_id in rows:
+                    # A bulk import logs a whole batch as one row: entity_id .. through_id
+                    last_id = through_id[0] if through_id and through_id[0] is not None else entity_id
+                    for handler in self._handlers.get(entity, ()):
+                        for key in range(entity_id, last_id + 1):
+                            handler(key, op)
+            self.last_seq = rows[-1][0]
+            if self.last_seq >= self._next_prune:
+                self._prune(conn)
+
+    def _prune(self, conn):
+        # Once every `keep` changes, drop everything older than the last `keep` rows
+        self._next_prune = self.last_seq + self.keep
+        try:
+            conn.execute("DELETE FROM change_log WHERE seq <= ?", (self.last_seq - self.keep,))
+            conn.commit()
+        except sqlite3.OperationalError:
+            conn.rollback()  # database busy, some worker will prune next time
+
+
+def ensure_change_log(database):
+    """Create change_log and its triggers in a database that predates them.
+
+    bootstrap() creates them for new databases; this covers one that was created before
+    them and is opened without bootstrapping (BOOTSTRAP_DB=0). Without the table every
+    request would fail in poll(). When it exists this is one read of sqlite_master.
+    """
+    conn = sqlite3.connect(database, timeout=30, isolation_level=None)
+    try:
+        exists = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'change_log'"
+        if conn.execute(exists).fetchone():
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if not conn.execute(exists).fetchone():  # another worker may have just done it
+                schema.create_change_log_triggers(conn.cursor())
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+
+
+def init_change_log(app, database):
+    ensure_change_log(database)
+    change_log = ChangeLog(database, keep=app.config.get("CHANGE_LOG_KEEP", 10000))
+    app.extensions["change_log"] = change_log
+
+    @app.before_request
+    def poll_change_log():
+        change_log.poll()
+
+    return change_log
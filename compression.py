@@ -0,0 +1,118 @@
+import zlib
+
+from flask import current_app, get_flashed_messages, render_template, request, stream_template
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is used instead
+    brotli = None
+
+
+# Coalesce Jinja's many tiny chunks before compressing and flushing them to the client
+FLUSH_SIZE = 8 * 1024
+
+
+class _GzipStream:
+    def __init__(self, level):
+        # wbits=16+MAX_WBITS writes a gzip header/trailer instead of a raw zlib stream
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        # Z_SYNC_FLUSH lets the browser start parsing what it has received so far
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class _BrotliStream:
+    def __init__(self, level):
+        # Brotli quality runs 0-11; high qualities are far too slow for dynamic pages
+        self._compressor = brotli.Compressor(quality=min(level, 5))
+
+    def compress(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+def choose_encoding():
+    """Best dynamic content encoding the client accepts, or None."""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def _coalesce(chunks, size=FLUSH_SIZE):
+    buffer = []
+    buffered = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            yield b''.join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def _compressed(head, chunks, compressor):
+    yield compressor.compress(head)
+    for chunk in _coalesce(chunks):
+        yield compressor.compress(chunk)
+    yield compressor.finish()
+
+
+def render_listing(template_name, **context):
+    """render_template() for the large listing pages.
+
+    With STREAM_LISTINGS enabled the template is rendered with Flask's streaming API and
+    compressed on the fly, so the first bytes leave before the whole page has been rendered.
+    Pages smaller than COMPRESS_MIN_SIZE are sent as a normal, uncompressed response.
+    """
+    if not current_app.config.get("STREAM_LISTINGS"):
+        return render_template(template_name, **context)
+
+    # Flashes are popped from the session while the layout renders. Read them now so the
+    # session is updated before the headers (and the session cookie) go out.
+    get_flashed_messages(with_categories=True)
+
+    chunks = (chunk.encode('utf-8') for chunk in stream_template(template_name, **context))
+
+    # Render up to the threshold before deciding whether compression is worth it
+    min_size = current_app.config.get("COMPRESS_MIN_SIZE", 1024)
+    head = []
+    head_size = 0
+    for chunk in chunks:
+        head.append(chunk)
+        head_size += len(chunk)
+        if head_size >= min_size:
+            break
+    else:
+        # The whole page fit under the threshold
+        return current_app.response_class(b''.join(head), mimetype='text/html')
+
+    encoding = choose_encoding()
+    level = current_app.config.get("COMPRESS_LEVEL", 6)
+    if encoding == 'br':
+        body = _compressed(b''.join(head), chunks, _BrotliStream(level))
+    elif encoding == 'gzip':
+        body = _compressed(b''.join(head), chunks, _GzipStream(level))
+    else:
+        body = _coalesce(_prepend(head, chunks))
+
+    response = current_app.response_class(body, mimetype='text/html')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def _prepend(head, chunks):
+    yield from head
+    yield from chunks
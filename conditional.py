@@ -0,0 +1,93 @@
+import hashlib
+
+from flask import current_app, request, session
+from flask.globals import request_ctx
+
+
+class Validator:
+    """ETag for one response, built from the version columns.
+
+    There is no Last-Modified: a timestamp can't tell two viewers (or two changes within
+    the same second) apart, so If-Modified-Since alone would get another user's page.
+    """
+
+    __slots__ = ("etag", "version")
+
+    def __init__(self, parts, version):
+        self.etag = hashlib.sha1("|".join(str(part) for part in parts).encode()).hexdigest()[:20]
+        self.version = version  # recipes.version / catalog_version.version the ETag was built from
+
+
+def _viewer_parts():
+    # The layout shows who is logged in, so that is part of every page's identity
+    return (session.get("user_id"), session.get("username"), session.get("auth_version", 1))
+
+
+def recipe_validator(cursor, recipe_id, user_id):
+    """Validator for recipe_detail: the recipe's version plus the viewer's favorites version."""
+    row = cursor.execute(
+        """
+        SELECT r.version, u.favorites_version
+        FROM recipes r, users u
+        WHERE r.id = ? AND u.id = ?
+        """,
+        (recipe_id, user_id)
+    ).fetchone()
+    if row is None:
+        return None
+    return Validator(("recipe", recipe_id, row[0], row[1]) + _viewer_parts(), row[0])
+
+
+def listing_validator(cursor, user_id):
+    """Validator for the listing pages: the catalog version plus the viewer's favorites version.
+
+    The query string is part of the ETag, so each filter/search combination gets its own.
+    """
+    row = cursor.execute(
+        """
+        SELECT c.version, u.favorites_version
+        FROM catalog_version c, users u
+        WHERE c.id = 1 AND u.id = ?
+        """,
+        (user_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    return Validator((request.endpoint, request.query_string.decode(), row[0], row[1]) + _viewer_parts(), row[0])
+
+
+def _has_flashes():
+    # Flashed for this request and not shown yet (still in the session), or already read by
+    # the template (get_flashed_messages keeps them on the request context). Unlike
+    # get_flashed_messages() this doesn't take them out of the session, so a message
+    # flashed later in the view is still shown.
+    return bool(session.get("_flashes") or request_ctx.flashes)
+
+
+def is_not_modified(validator):
+    """True if the client's cached copy (If-None-Match) is still current."""
+    if validator is None or not current_app.config.get("CONDITIONAL_GET", True):
+        return False
+    # Pending flash messages will change the page, so it must be rendered
+    if _has_flashes():
+        return False
+    return bool(request.if_none_match) and request.if_none_match.contains_weak(validator.etag)
+
+
+def not_modified(validator):
+    return add_validator(current_app.response_class(status=304), validator)
+
+
+def add_validator(response, validator):
+    """Attach the ETag and ask the browser to revalidate on every view."""
+    if validator is None or not current_app.config.get("CONDITIONAL_GET", True):
+        return response
+    # A page carrying a one-off flash (e.g. "Invalid owner filter") must not be replayed
+    # from the browser cache by a later 304
+    if _has_flashes():
+        return response
+    # Weak: the markup can differ in insignificant ways (e.g. the footer's timestamp)
+    response.set_etag(validator.etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,55 @@
+import os
+import sqlite3
+
+# Named SQLite storage profiles: DB_PROFILE picks one for the app, schema.py and migrations.
+# `python benchmarks/storage_profiles.py` compares them on the app's own routes.
+PROFILES = {
+    # SQLite's defaults: every commit is fsynced before it returns, nothing is lost on power failure
+    "durable": {
+        "synchronous": "FULL",
+        "cache_size": -2000,  # KiB (negative = size, not pages)
+        "mmap_size": 0,
+        "temp_store": "DEFAULT",
+        "busy_timeout": 5000,  # ms
+    },
+    # In WAL mode NORMAL only fsyncs at checkpoints: a power failure can lose the last few
+    # commits but never corrupts the database. Sorts and temp B-trees stay in memory.
+    "balanced": {
+        "synchronous": "NORMAL",
+        "cache_size": -8000,
+        "mmap_size": 64 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+    # Reads go through mmap, so they come from the OS page cache shared by every worker
+    # and connection (each connection's own cache_size is gone once the request closes it)
+    "read-heavy": {
+        "synchronous": "NORMAL",
+        "cache_size": -16000,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "busy_timeout": 10000,
+    },
+}
+DEFAULT_PROFILE = "durable"
+
+
+def profile_settings(profile=None):
+    """PRAGMA values of `profile` (default: $DB_PROFILE, else DEFAULT_PROFILE)."""
+    name = profile or os.environ.get("DB_PROFILE", DEFAULT_PROFILE)
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise ValueError(f"Unknown DB_PROFILE {name!r}, expected one of {', '.join(PROFILES)}") from None
+
+
+def connect(database, profile=None, **kwargs):
+    """Open a connection with rows by name, foreign keys, WAL and the profile's PRAGMAs."""
+    settings = profile_settings(profile)
+    conn = sqlite3.connect(database, **kwargs)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA journal_mode = WAL")
+    for pragma, value in settings.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    return conn
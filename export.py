@@ -0,0 +1,211 @@
+"""Streaming export of recipes with their ingredients and categories, as JSONL or CSV.
+
+Usage:
+    python export.py [--format jsonl|csv] [--user USERNAME] [--owner-filter FILTER]
+                     [--q TEXT] [--category-id ID] [--batch N] [--database PATH] > recipes.jsonl
+
+The app serves the same thing at /export/jsonl and /export/csv, taking index()'s query
+arguments (owner_filter, q, category_id).
+
+Recipes are read in batches of `batch` rows in id order (keyset pagination, so each
+batch is a short read and a late batch costs the same as an early one). For every batch
+two more queries fetch the ingredients and categories of those ids, also in recipe_id
+order, and the three are merge-joined: no per-recipe queries, and at most one batch of
+rows in memory however large the export is. A batch's ids go into an IN list, so
+BATCH_SIZE stays under SQLite's default limit of 999 bound parameters. Batches are
+separate reads: a recipe changed while a long export runs shows up in whichever state
+its batch saw.
+"""
+import csv
+import io
+import json
+import sys
+
+import db
+import schema
+
+FORMATS = {"jsonl": "application/x-ndjson", "csv": "text/csv"}
+
+# The owner filters of the index page, see recipe_filter()
+OWNER_FILTERS = ("my_and_default", "my_recipes", "default_recipes", "all_recipes")
+
+CSV_FIELDS = ("id", "title", "owner", "description", "instructions", "prep_time", "cook_time",
+              "image_filename", "categories", "ingredients")
+
+CSV_LIST_SEPARATOR = "; "
+
+BATCH_SIZE = 500
+
+
+def recipe_filter(user_id, owner_filter="my_and_default", query="", category_id=None, system_user_id=1):
+    """WHERE clauses and parameters for index()'s filters, on recipes aliased as r.
+
+    owner_filter must be one of OWNER_FILTERS; a category_id is assumed to exist.
+    """
+    where_clauses = []
+    params = []
+
+    if owner_filter == 'my_recipes':
+        where_clauses.append("r.user_id = ?")
+        params.append(user_id)
+    elif owner_filter == 'default_recipes':
+        where_clauses.append("r.user_id = ?")
+        params.append(system_user_id)
+    elif owner_filter == 'my_and_default':
+        where_clauses.append("(r.user_id = ? OR r.user_id = ?)")
+        params.extend([user_id, system_user_id])
+    elif owner_filter != 'all_recipes':
+        raise ValueError(f"Unknown owner filter {owner_filter!r}")
+
+    if query:
+        # Partial match in the title, description or any ingredient name
+        where_clauses.append("""
+            (r.title LIKE ? OR r.description LIKE ? OR EXISTS (
+                SELECT 1 FROM ingredients i WHERE i.recipe_id = r.id AND i.name LIKE ?
+            ))
+        """)
+        params.extend([f"%{query}%", f"%{query}%", f"%{query}%"])
+
+    if category_id:
+        where_clauses.append("""
+            EXISTS (
+                SELECT 1 FROM recipe_categories rc WHERE rc.recipe_id = r.id AND rc.category_id = ?
+            )
+        """)
+        params.append(category_id)
+
+    return where_clauses, params
+
+
+def _grouped(rows, recipe_id, position):
+    """Pop the rows for `recipe_id` off the front of `rows` (sorted by recipe_id)."""
+    group = []
+    while position[0] < len(rows) and rows[position[0]][0] <= recipe_id:
+        row = rows[position[0]]
+        if row[0] == recipe_id:
+            group.append(row)
+        position[0] += 1
+    return group
+
+
+def iter_recipes(conn, where_clauses=(), params=(), batch=BATCH_SIZE):
+    """Yield one dict per matching recipe, in id order, with ingredients and categories."""
+    where = "".join(f" AND {clause}" for clause in where_clauses)
+    last_id = 0
+    while True:
+        recipes = conn.execute(f"""
+            SELECT r.id, r.title, u.username AS owner, r.description, r.instructions,
+                   r.prep_time, r.cook_time, r.image_filename
+            FROM recipes r
+            JOIN users u ON r.user_id = u.id
+            WHERE r.id > ?{where}
+            ORDER BY r.id
+            LIMIT ?
+        """, [last_id, *params, batch]).fetchall()
+        if not recipes:
+            return
+        ids = [row["id"] for row in recipes]
+        marks = ", ".join("?" * len(ids))
+
+        # Both ordered by recipe_id like the batch itself, so one pass merges them
+        ingredients = conn.execute(f"""
+            SELECT recipe_id, name, quantity_unit
+            FROM ingredients
+            WHERE recipe_id IN ({marks})
+            ORDER BY recipe_id, id
+        """, ids).fetchall()
+        categories = conn.execute(f"""
+            SELECT rc.recipe_id, c.name
+            FROM recipe_categories rc
+            JOIN categories c ON c.id = rc.category_id
+            WHERE rc.recipe_id IN ({marks})
+            ORDER BY rc.recipe_id, c.name
+        """, ids).fetchall()
+
+        ingredient_pos, category_pos = [0], [0]
+        for recipe in recipes:
+            record = dict(recipe)
+            record["categories"] = [row[1] for row in _grouped(categories, recipe["id"], category_pos)]
+            record["ingredients"] = [{"name": row[1], "quantity_unit": row[2]}
+                                     for row in _grouped(ingredients, recipe["id"], ingredient_pos)]
+            yield record
+        last_id = recipes[-1]["id"]
+        if len(recipes) < batch:
+            return
+
+
+def _csv_row(record):
+    # List cells read back by importer.py: "Dinner; Italian" and "Salt: 1 tsp; Pepper"
+    return dict(record,
+                categories=CSV_LIST_SEPARATOR.join(record["categories"]),
+                ingredients=CSV_LIST_SEPARATOR.join(
+                    f"{item['name']}: {item['quantity_unit']}" if item["quantity_unit"] else item["name"]
+                    for item in record["ingredients"]))
+
+
+def export_chunks(records, fmt, chunk_records=BATCH_SIZE):
+    """Encode records as `fmt`, yielding a bytes chunk every `chunk_records` records."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r}")
+    buffer = io.StringIO()
+    writer = None
+    if fmt == "csv":
+        writer = csv.DictWriter(buffer, CSV_FIELDS)
+        writer.writeheader()
+    count = 0
+    for record in records:
+        if writer:
+            writer.writerow(_csv_row(record))
+        else:
+            buffer.write(json.dumps(record, ensure_ascii=False))
+            buffer.write("\n")
+        count += 1
+        if count % chunk_records == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def stream_export(conn, fmt, where_clauses=(), params=(), batch=BATCH_SIZE):
+    """Response body for an export; closes `conn` when done (or when the client goes away)."""
+    try:
+        yield from export_chunks(iter_recipes(conn, where_clauses, params, batch), fmt, batch)
+    finally:
+        conn.close()
+
+
+def main():
+    import argparse  # only the command line needs it; keeps `import app` cheap
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--format", choices=FORMATS, default="jsonl")
+    parser.add_argument("--user", help="username whose view to export (default: every recipe)")
+    parser.add_argument("--owner-filter", choices=OWNER_FILTERS)
+    parser.add_argument("--q", default="", help="search text, as on the index page")
+    parser.add_argument("--category-id", type=int)
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE)
+    parser.add_argument("--database", default=schema.DATABASE)
+    args = parser.parse_args()
+
+    conn = db.connect(args.database)
+    user_id = None
+    if args.user:
+        row = conn.execute("SELECT id FROM users WHERE username = ? COLLATE NOCASE", (args.user,)).fetchone()
+        if row is None:
+            sys.exit(f"No user named {args.user!r}")
+        user_id = row["id"]
+    owner_filter = args.owner_filter or ("my_and_default" if user_id else "all_recipes")
+    if user_id is None and owner_filter in ("my_and_default", "my_recipes"):
+        sys.exit(f"--owner-filter {owner_filter} needs --user")
+    where_clauses, params = recipe_filter(user_id, owner_filter, args.q, args.category_id)
+
+    out = sys.stdout.buffer
+    for chunk in stream_export(conn, args.format, where_clauses, params, args.batch):
+        out.write(chunk)
+    out.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+from flask import current_app, session
+from markupsafe import Markup, escape
+
+from lru import SizedLRU
+
+
+# Rendered in place of the per-viewer bits, then split on, so the cached card has holes for them
+OWNER_SLOT = "\x00owner\x00"
+FAVORITE_SLOT = "\x00favorite\x00"
+
+
+class FragmentCache(SizedLRU):
+    """In-process LRU of rendered HTML fragments, bounded by total size in bytes."""
+
+    def put(self, key, parts):
+        super().put(key, parts, sum(len(part.encode("utf-8")) for part in parts))
+
+
+def _owner_line(recipe, user_id, system_user_id):
+    # The only per-viewer part of a card
+    if recipe["user_id"] == user_id:
+        return '<p class="recipe-owner">By: You!</p>'
+    if recipe["user_id"] == system_user_id:
+        return f'<p class="recipe-owner">By: {escape(recipe["owner_username"])} (Default)</p>'
+    return f'<p class="recipe-owner">By: {escape(recipe["owner_username"])}</p>'
+
+
+def _favorite_button(favorited):
+    # The hidden input holds the state a click asks for, so a resubmitted form sets it again
+    # instead of flipping it back (toggle_favorite / api_toggle_favorite)
+    if favorited:
+        return ('<input type="hidden" name="favorited" value="false">'
+                '<button type="submit" class="favorite-toggle favorited" aria-pressed="true" '
+                'title="Remove from favorites">&#9733; Favorited</button>')
+    return ('<input type="hidden" name="favorited" value="true">'
+            '<button type="submit" class="favorite-toggle" aria-pressed="false" '
+            'title="Add to favorites">&#9734; Favorite</button>')
+
+
+def _card_parts(cache, template, recipe):
+    key = (recipe["id"], recipe["version"])
+    parts = cache.get(key)
+    if parts is None:
+        html = template.render(recipe=recipe, owner_slot=Markup(OWNER_SLOT),
+                               favorite_slot=Markup(FAVORITE_SLOT))
+        head, rest = html.split(OWNER_SLOT, 1)
+        parts = (head,) + tuple(rest.split(FAVORITE_SLOT, 1))
+        cache.put(key, parts)
+    return parts
+
+
+def render_recipe_cards(recipes, system_user_id=1, favorite_ids=frozenset()):
+    """HTML for a grid of recipe cards, mostly concatenated from the fragment cache.
+
+    Cards are keyed by (recipe id, version), so any edit to a recipe, its ingredients or
+    its categories (see schema.create_version_triggers) renders a fresh card.
+    `favorite_ids` is the viewer's set of favorited recipe ids (favorite_state.favorite_ids).
+    """
+    cache = current_app.extensions["fragment_cache"]
+    template = current_app.jinja_env.get_template("_recipe_card.html")
+    user_id = session.get("user_id")
+
+    html = []
+    for recipe in recipes:
+        head, middle, tail = _card_parts(cache, template, recipe)
+        html.append(head)
+        html.append(_owner_line(recipe, user_id, system_user_id))
+        html.append(middle)
+        html.append(_favorite_button(recipe["id"] in favorite_ids))
+        html.append(tail)
+    return Markup("".join(html))
+
+
+def init_fragments(app):
+    app.extensions["fragment_cache"] = FragmentCache(app.config.get("FRAGMENT_CACHE_BYTES", 4 * 1024 * 1024))
+    app.jinja_env.globals["render_recipe_cards"] = render_recipe_cards
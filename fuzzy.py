@@ -0,0 +1,236 @@
+"""Typo-tolerant search: "guacamloe" finds guacamole.
+
+Each worker keeps a trigram index over the search vocabulary: the words of every recipe
+title and ingredient name, lower-cased. Every word is split into trigrams the way
+PostgreSQL's pg_trgm does ("  cat " -> "  c", " ca", "cat", "at "), and each trigram maps
+to an array('I') of the ids of the words that contain it. A misspelled word is
+looked up by counting, over the posting arrays of its own trigrams, how many trigrams
+each vocabulary word shares with it (Counter.update on an array runs in C). The count
+gives the Jaccard similarity |shared| / |union|; words below `min_similarity` are
+dropped and only the best `candidates` are kept. The vocabulary is small next to the
+recipes (a few tens of thousands of words for a million recipes), so a lookup takes
+a few milliseconds whatever the catalog size.
+
+Each word also maps to an array('I') of the ids of the recipes that contain it, so the
+candidates turn into recipe ids without touching the recipes table: per query word, the
+union of its candidates' recipes, scored by the best candidate each one contains; across
+words, the intersection, scored by the sum. Only the best `max_recipes` ids are fetched
+(fuzzy_recipes: one primary key lookup each, plus the owner and category filters), so a
+fuzzy search costs the same on 1,000 or 1,000,000 recipes. The flip side: when the
+filters rule out all of those, the search shows nothing even if lower-scored recipes
+would have passed. index() only does this when the exact search found nothing.
+
+Each worker builds the index in the background when it starts (one pass over the titles
+and the ingredients, a second or two per 200,000 recipes; a search that arrives first
+waits for it) and keeps it current through the change_log: changed recipes are re-read
+on the next search, including the ones changed while the index was being built. A
+re-read recipe is added to the arrays of its new words; removing it from those of its
+old words would mean scanning them all, so instead its current words are kept in
+`changed` and checked at search time. That set only grows until the next rebuild (a
+change_log reset, or the worker being recycled after max_requests).
+"""
+import array
+import heapq
+import json
+import re
+import sqlite3
+import threading
+from collections import Counter
+from operator import itemgetter
+
+WORD = re.compile(r"[^\W\d_]{3,}")  # runs of 3+ letters
+
+
+def trigrams(word):
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def words(text):
+    return WORD.findall(text.lower())
+
+
+class TrigramIndex:
+    def __init__(self, min_similarity=0.3, candidates=5, max_words=3, max_recipes=1000, refresh_batch=500):
+        self.min_similarity = min_similarity
+        self.candidates = candidates
+        self.max_words = max_words
+        self.max_recipes = max_recipes
+        self.refresh_batch = refresh_batch
+        self._lock = threading.Lock()
+        self._pending = set()
+        self.clear()
+
+    def clear(self):
+        """Forget everything; the next search rebuilds from the database."""
+        with self._lock:
+            self.built = False
+            self.terms = []
+            self.term_ids = {}
+            self.postings = {}  # trigram -> array('I') of term ids, ascending
+            self.sizes = array.array("B")  # number of distinct trigrams per term id
+            self.recipes = []  # term id -> array('I') of the ids of the recipes containing it
+            self.changed = {}  # recipe id -> frozenset of its words, for recipes re-read since the build
+            self._pending.clear()
+
+    def invalidate(self, recipe_id, op=None):
+        """change_log handler: re-read this recipe's words before the next search.
+
+        Also while the index is being built: the build may have read the recipe before
+        the change, so it is re-read right after.
+        """
+        self._pending.add(recipe_id)
+
+    def _add_term(self, term):
+        term_id = self.term_ids.get(term)
+        if term_id is not None:
+            return term_id
+        term_id = len(self.terms)
+        self.terms.append(term)
+        self.term_ids[term] = term_id
+        self.recipes.append(array.array("I"))
+        grams = trigrams(term)
+        self.sizes.append(min(len(grams), 255))
+        for gram in grams:
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = array.array("I")
+            posting.append(term_id)
+        return term_id
+
+    def _build(self, conn):
+        recipes = self.recipes
+        for recipe_id, title in conn.execute("SELECT id, title FROM recipes"):
+            for term in words(title):
+                recipes[self._add_term(term)].append(recipe_id)
+        # Ingredient names repeat a lot: split each one once
+        term_ids = {}
+        for recipe_id, name in conn.execute("SELECT recipe_id, name FROM ingredients"):
+            ids = term_ids.get(name)
+            if ids is None:
+                ids = term_ids[name] = [self._add_term(term) for term in words(name)]
+            for term_id in ids:
+                recipes[term_id].append(recipe_id)
+        self.built = True
+
+    def refresh(self, conn):
+        """Build the index if needed, then re-read the recipes changed since the last search."""
+        with self._lock:
+            if not self.built:
+                self._build(conn)
+            while self._pending:
+                ids = [self._pending.pop() for _ in range(min(len(self._pending), self.refresh_batch))]
+                current = {recipe_id: set() for recipe_id in ids}
+                marks = ", ".join("?" * len(ids))
+                for recipe_id, text in conn.execute(
+                        f"SELECT id, title FROM recipes WHERE id IN ({marks}) "
+                        f"UNION ALL SELECT recipe_id, name FROM ingredients WHERE recipe_id IN ({marks})",
+                        ids * 2):
+                    current[recipe_id].update(words(text))
+                for recipe_id, terms in current.items():
+                    known = self.changed.get(recipe_id, ())
+                    for term in terms:
+                        if term not in known:
+                            self.recipes[self._add_term(term)].append(recipe_id)
+                    self.changed[recipe_id] = frozenset(terms)  # empty once the recipe is deleted
+
+    def warm_up(self, database):
+        """Build the index in a background thread, so the first fuzzy search doesn't wait."""
+        def build():
+            conn = sqlite3.connect(database)
+            try:
+                self.refresh(conn)
+            finally:
+                conn.close()
+        threading.Thread(target=build, name="trigram-index", daemon=True).start()
+
+    def similar(self, word):
+        """Up to `candidates` (term, similarity) pairs for one word, most similar first."""
+        term_id = self.term_ids.get(word)
+        if term_id is not None:
+            return [(word, 1.0)]
+        grams = trigrams(word)
+        shared = Counter()
+        for gram in grams:
+            posting = self.postings.get(gram)
+            if posting is not None:
+                shared.update(posting)
+        # |shared| / |union| >= min_similarity needs |shared| >= min_similarity * len(grams)
+        least = self.min_similarity * len(grams)
+        sizes = self.sizes
+        scored = ((count / (len(grams) + sizes[term_id] - count), term_id)
+                  for term_id, count in shared.items() if count >= least)
+        return [(self.terms[term_id], similarity)
+                for similarity, term_id in heapq.nlargest(self.candidates, scored)
+                if similarity >= self.min_similarity]
+
+    def suggest(self, conn, query):
+        """[[(term, similarity), ...] per query word], or None if some word has no match."""
+        query_words = words(query)[:self.max_words]
+        if not query_words:
+            return None
+        self.refresh(conn)
+        with self._lock:
+            matches = [self.similar(word) for word in query_words]
+        return matches if all(matches) else None
+
+    def _word_scores(self, candidates):
+        # recipe id -> similarity of the best candidate it contains; dict.fromkeys runs in C,
+        # and going from the worst candidate to the best leaves the best one's similarity
+        scores = {}
+        for term, similarity in reversed(candidates):
+            scores.update(dict.fromkeys(self.recipes[self.term_ids[term]], similarity))
+        # Re-read recipes may have lost the word since they were put in its array
+        for recipe_id in scores.keys() & self.changed.keys():
+            terms = self.changed[recipe_id]
+            similarity = next((similarity for term, similarity in candidates if term in terms), None)
+            if similarity is None:
+                del scores[recipe_id]
+            else:
+                scores[recipe_id] = similarity
+        return scores
+
+    def recipe_scores(self, matches):
+        """Up to `max_recipes` (recipe id, score) pairs for suggest()'s matches, best first.
+
+        A recipe must contain a candidate of every query word; its score is the sum, over
+        the words, of the similarity of the best candidate it contains.
+        """
+        with self._lock:
+            scores = None
+            for candidates in matches:
+                word_scores = self._word_scores(candidates)
+                if scores is None:
+                    scores = word_scores
+                else:
+                    if len(word_scores) < len(scores):
+                        scores, word_scores = word_scores, scores
+                    scores = {recipe_id: score + word_scores[recipe_id]
+                              for recipe_id, score in scores.items() if recipe_id in word_scores}
+                if not scores:
+                    return []
+        return heapq.nlargest(self.max_recipes, scores.items(), key=itemgetter(1))
+
+
+def fuzzy_recipes(cursor, index, columns, matches, where_clauses=(), params=(), limit=100):
+    """Recipes matching a candidate of every query word, best first.
+
+    `columns` is the SELECT list (on recipes r joined with users u); `where_clauses` and
+    `params` are the other filters from recipe_filter(). The recipe ids and their scores
+    come from the index (TrigramIndex.recipe_scores) as a JSON object, and each recipe is
+    fetched by its primary key; CROSS JOIN keeps SQLite from scanning recipes instead.
+    """
+    scores = index.recipe_scores(matches)
+    if not scores:
+        return []
+    where = f"WHERE {' AND '.join(where_clauses)}" if where_clauses else ""
+    sql = f"""
+        SELECT {columns}
+        FROM json_each(?) AS s
+        CROSS JOIN recipes r ON r.id = CAST(s.key AS INTEGER)
+        JOIN users u ON r.user_id = u.id
+        {where}
+        ORDER BY s.value DESC, r.title
+        LIMIT ?
+    """
+    return cursor.execute(sql, [json.dumps(dict(scores)), *params, limit]).fetchall()
@@ -0,0 +1,81 @@
+"""gunicorn settings: gunicorn -c gunicorn.conf.py wsgi:app
+
+Every value can be overridden from the environment (or on the command line).
+"""
+import multiprocessing
+import os
+import tempfile
+
+from gunicorn.glogging import Logger
+
+cores = multiprocessing.cpu_count()
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+
+# Requests mostly wait on SQLite and the disk, so 2 * cores + 1 processes (gunicorn's
+# usual rule) plus a few threads each; WEB_CONCURRENCY is the usual knob on PaaS hosts
+workers = int(os.environ.get("WEB_CONCURRENCY", cores * 2 + 1))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
+# Each worker has its own password hashing pool. PASSWORD_HASH_BUDGET (default: the number
+# of cores) is split between them, but every worker needs at least one hashing process:
+# with the default worker count that is one each, so up to `workers` hashes (about twice
+# the cores) can run at once. Hashes are short and each worker rejects logins past its
+# PASSWORD_HASH_QUEUE, so the oversubscription is bounded; to hash on fewer cores, lower
+# WEB_CONCURRENCY rather than the budget.
+hash_budget = int(os.environ.get("PASSWORD_HASH_BUDGET", cores))
+os.environ.setdefault("PASSWORD_HASH_WORKERS", str(max(1, hash_budget // workers)))
+
+# Workers leave their metrics here so /metrics can add them up (metrics.py); a new
+# directory per master, so a restart starts the counters from zero
+os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), f"recipe-organizer-metrics-{os.getpid()}"))
+
+# Import the app (and run create_tables) once in the master, then fork
+preload_app = True
+
+# Recycle workers now and then so slow leaks can't pile up; the jitter keeps them from
+# all restarting at once
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 1000))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 100))
+
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = "-"
+errorlog = "-"
+
+
+class RedactingLogger(Logger):
+    """gunicorn's logger, minus reset tokens in the access log.
+
+    gunicorn writes the access log itself, past the app's RedactFilter (logs.py), and the
+    request line of /reset_password/<token> (and the Referer of every request made from
+    that page) would otherwise carry the token in plain text.
+    """
+
+    def atoms(self, resp, req, environ, request_time):
+        from logs import redact
+        return {key: redact(value) if isinstance(value, str) else value
+                for key, value in super().atoms(resp, req, environ, request_time).items()}
+
+
+logger_class = RedactingLogger
+
+
+def post_fork(server, worker):
+    # Fresh caches, change_log connection and hashing pool for this worker
+    from app import init_worker
+    init_worker(worker.app.wsgi())
+
+
+def worker_exit(server, worker):
+    from passwords import shutdown_pool
+    shutdown_pool()
+    # Last totals of this worker; the next scrape folds them into dead.json
+    metrics = worker.app.wsgi().extensions.get("metrics")
+    if metrics and metrics.directory:
+        metrics.write()
+    # Write out queued log records before the process goes away
+    worker.app.wsgi().extensions["logging"].stop()
@@ -0,0 +1,41 @@
+import os
+
+from timing import timed
+
+# Allowed image file extensions
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+
+# Recipe images are cropped to this aspect ratio around the center, then resized
+CARD_SIZE = (600, 450)
+
+
+def crop_to_card(source, destination=None):
+    """Crop the image at `source` to 4:3 and resize it to CARD_SIZE, saving to `destination`.
+
+    Overwrites `source` when no destination is given. A top-level function so an import
+    can run it in a process pool (see importer.py). Pillow is imported on first use.
+    """
+    from PIL import Image
+    with timed("image"), Image.open(source) as img:
+        original_width, original_height = img.size
+        target_aspect = CARD_SIZE[0] / CARD_SIZE[1]
+
+        # Calculate new dimensions to fit 4:3 and crop from center
+        if original_width / original_height > target_aspect:
+            # Image is wider than 4:3, crop width
+            new_width = int(original_height * target_aspect)
+            box = ((original_width - new_width) / 2, 0, (original_width + new_width) / 2, original_height)
+        else:
+            # Image is taller than 4:3, crop height
+            new_height = int(original_width / target_aspect)
+            box = (0, (original_height - new_height) / 2, original_width, (original_height + new_height) / 2)
+
+        card = img.crop(box).resize(CARD_SIZE, Image.Resampling.LANCZOS)
+        card.save(destination or source)
+    return os.path.basename(destination or source)
+
+
+def allowed_file(filename):
+    # Check if there's a file extension and if it's in our ALLOWED_EXTENSIONS set
+    return '.' in filename and \
+           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
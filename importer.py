@@ -0,0 +1,391 @@
+"""Bulk import of recipes from JSONL or CSV, e.g. a file written by export.py.
+
+Usage:
+    python importer.py FILE --user USERNAME [--images DIR] [--format jsonl|csv]
+                       [--batch N] [--workers N] [--database PATH] [--uploads DIR] [--restart]
+
+The app takes the same files on the /import page.
+
+One streaming pass reads, validates and normalizes the records: title and instructions
+are required, text is stripped, and categories are matched by name or id through a map
+loaded once up front. An image named by a record's `image_filename` (or `image`) is
+looked up by file name in the image directory and cropped and resized in a process pool
+while the following records are read. Every `batch` valid recipes go in as one
+transaction of executemany() inserts, together with the import's checkpoint row
+(migration 0005): running the same file again for the same user resumes after the last
+committed batch, and a finished import is not repeated. The per-row version and
+change_log triggers stand down during a batch (migration 0008); it bumps the catalog
+version and logs its recipe ids once.
+"""
+import csv
+import hashlib
+import json
+import os
+import sys
+import time
+import uuid
+from collections import Counter, deque
+
+import db
+import schema
+from export import CSV_LIST_SEPARATOR, FORMATS
+from images import allowed_file, crop_to_card
+
+UPLOADS_DIR = os.path.join("static", "uploads")
+
+BATCH_SIZE = 1000
+
+# How many rejected records the report lists (all of them are counted)
+MAX_ERRORS = 20
+
+
+def source_key(path):
+    """sha256 of the input file, which identifies an import for its checkpoint."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_records(stream, fmt):
+    """Yield the raw records of a text stream: JSON lines as strings, CSV rows as dicts."""
+    if fmt == "csv":
+        for row in csv.DictReader(stream):
+            for field in ("categories", "ingredients"):
+                row[field] = [item for item in (row.get(field) or "").split(CSV_LIST_SEPARATOR.strip())
+                              if item.strip()]
+            yield row
+    elif fmt == "jsonl":
+        for line in stream:
+            if line.strip():
+                yield line
+    else:
+        raise ValueError(f"Unknown import format {fmt!r}")
+
+
+def category_map(conn):
+    """{lowercased name or str(id): id} for every category, from one query."""
+    categories = {}
+    for category_id, name in conn.execute("SELECT id, name FROM categories"):
+        categories[str(category_id)] = category_id
+        categories[name.lower()] = category_id
+    return categories
+
+
+def normalize(raw, categories):
+    """Validated recipe from one raw record; raises ValueError with the reason."""
+    if isinstance(raw, str):
+        try:
+            raw = json.loads(raw)
+        except ValueError:
+            raise ValueError("not valid JSON") from None
+    if not isinstance(raw, dict):
+        raise ValueError("not a JSON object")
+
+    def text(key):
+        value = raw.get(key)
+        return "" if value is None else str(value).strip()
+
+    title, instructions = text("title"), text("instructions")
+    if not title or not instructions:
+        raise ValueError("title and instructions are required")
+
+    def items(key):
+        # A string would be split into one item per character
+        value = raw.get(key)
+        if value is None:
+            return []
+        if not isinstance(value, list):
+            raise ValueError(f"{key} must be a list")
+        return value
+
+    category_ids, unknown = [], []
+    for value in items("categories"):
+        category_id = categories.get(str(value).strip().lower())
+        if category_id is None:
+            unknown.append(str(value).strip())
+        elif category_id not in category_ids:
+            category_ids.append(category_id)
+
+    ingredients = []
+    for item in items("ingredients"):
+        if isinstance(item, dict):
+            name, quantity_unit = item.get("name"), item.get("quantity_unit")
+        else:
+            name, _, quantity_unit = str(item).partition(":")
+        name = str(name or "").strip()
+        if name:
+            ingredients.append((name, str(quantity_unit or "").strip()))
+
+    return {
+        "title": title,
+        "description": text("description"),
+        "instructions": instructions,
+        "prep_time": text("prep_time"),
+        "cook_time": text("cook_time"),
+        "categories": category_ids,
+        "unknown_categories": unknown,
+        "ingredients": ingredients,
+        "image": text("image_filename") or text("image"),
+    }
+
+
+def process_image(source, upload_folder):
+    """Crop and resize `source` into a new uniquely named file in upload_folder; returns its name."""
+    extension = source.rsplit(".", 1)[1].lower()
+    return crop_to_card(source, os.path.join(upload_folder, f"{uuid.uuid4()}.{extension}"))
+
+
+class _Inline:
+    """Stands in for a future when images are processed without a pool."""
+
+    def __init__(self, fn, *args):
+        try:
+            self._result, self._error = fn(*args), None
+        except Exception as e:
+            self._result, self._error = None, e
+
+    def result(self):
+        if self._error:
+            raise self._error
+        return self._result
+
+
+def _next_recipe_id(conn):
+    # recipes is AUTOINCREMENT: never reuse an id, even one of a deleted recipe
+    return conn.execute("""
+        SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'recipes'), 0),
+                   COALESCE((SELECT MAX(id) FROM recipes), 0)) + 1
+    """).fetchone()[0]
+
+
+def import_recipes(conn, records, user_id, source, images_dir=None, upload_folder=UPLOADS_DIR,
+                   batch=BATCH_SIZE, workers=0, restart=False, progress=None):
+    """Import `records` (from read_records) as recipes owned by `user_id`; returns a report dict.
+
+    `conn` must be in autocommit mode (isolation_level=None): each batch is its own
+    BEGIN IMMEDIATE ... COMMIT. `source` identifies the input for the checkpoint (see
+    source_key). `workers` > 0 processes images in that many processes. `progress` is
+    called with the report after every committed batch.
+    """
+    started = time.perf_counter()
+    report = {"records_read": 0, "recipes_imported": 0, "invalid": 0, "errors": [],
+              "unknown_categories": Counter(), "images_processed": 0, "images_failed": 0,
+              "images_missing": 0, "resumed_at": 0, "already_finished": False}
+    categories = category_map(conn)
+
+    if restart:
+        conn.execute("DELETE FROM import_checkpoints WHERE source = ? AND user_id = ?", (source, user_id))
+    checkpoint = conn.execute(
+        "SELECT records_read, recipes_imported, finished FROM import_checkpoints WHERE source = ? AND user_id = ?",
+        (source, user_id)).fetchone()
+    if checkpoint and checkpoint[2]:
+        report.update(records_read=checkpoint[0], already_finished=True)
+        return _finish(report, started)
+    skip = checkpoint[0] if checkpoint else 0
+    report["resumed_at"] = skip
+    imported_before = checkpoint[1] if checkpoint else 0
+
+    executor = None
+    if workers:
+        from concurrent.futures import ProcessPoolExecutor  # multiprocessing is slow to import
+        executor = ProcessPoolExecutor(max_workers=workers)
+
+    def submit(path):
+        if executor:
+            return executor.submit(process_image, path, upload_folder)
+        return _Inline(process_image, path, upload_folder)
+
+    def discard(pending, saved_images=()):
+        """Delete the images of a batch that won't be committed: nothing points at them."""
+        filenames = list(saved_images)
+        for recipe in pending:
+            future = recipe.pop("image_future", None)
+            if future is not None:
+                try:
+                    filenames.append(future.result())
+                except BaseException:  # failed or cancelled: no file
+                    pass
+        for filename in filenames:
+            try:
+                os.remove(os.path.join(upload_folder, filename))
+            except OSError:
+                pass
+
+    def flush(pending, position, finished=False):
+        """Wait for the batch's images, then insert it and move the checkpoint, atomically."""
+        saved_images = []
+        try:
+            for recipe in pending:
+                future = recipe.pop("image_future", None)
+                recipe["image_filename"] = None
+                if future is not None:
+                    try:
+                        recipe["image_filename"] = future.result()
+                        saved_images.append(recipe["image_filename"])
+                        report["images_processed"] += 1
+                    except Exception:
+                        report["images_failed"] += 1
+            conn.execute("BEGIN IMMEDIATE")
+            # Silences the per-row triggers until the DELETE below (migration 0008)
+            conn.execute("INSERT INTO bulk_writes (id) VALUES (1)")
+            if pending:
+                version, updated_at = conn.execute(
+                    "UPDATE catalog_version SET version = version + 1, "
+                    "updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = 1 RETURNING version, updated_at"
+                ).fetchone()
+            first_id = _next_recipe_id(conn)
+            for offset, recipe in enumerate(pending):
+                recipe["id"] = first_id + offset
+            conn.executemany(
+                "INSERT INTO recipes (id, title, description, instructions, prep_time, cook_time, user_id, "
+                "image_filename, version, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(r["id"], r["title"], r["description"], r["instructions"], r["prep_time"], r["cook_time"],
+                  user_id, r["image_filename"], version, updated_at) for r in pending])
+            conn.executemany(
+                "INSERT INTO ingredients (recipe_id, name, quantity_unit) VALUES (?, ?, ?)",
+                [(r["id"], name, quantity_unit) for r in pending for name, quantity_unit in r["ingredients"]])
+            conn.executemany(
+                "INSERT INTO recipe_categories (recipe_id, category_id) VALUES (?, ?)",
+                [(r["id"], category_id) for r in pending for category_id in r["categories"]])
+            if pending:
+                conn.execute("INSERT INTO change_log (entity, entity_id, op, through_id) "
+                             "VALUES ('recipes', ?, 'insert', ?)", (first_id, first_id + len(pending) - 1))
+            conn.execute("DELETE FROM bulk_writes")
+            conn.execute("""
+                INSERT INTO import_checkpoints (source, user_id, records_read, recipes_imported, finished, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (source, user_id) DO UPDATE SET records_read = excluded.records_read,
+                    recipes_imported = excluded.recipes_imported, finished = excluded.finished,
+                    updated_at = excluded.updated_at
+            """, (source, user_id, position, imported_before + report["recipes_imported"] + len(pending),
+                  int(finished), int(time.time())))
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            discard(pending, saved_images)
+            raise
+        report["recipes_imported"] += len(pending)
+        report["records_read"] = position
+        if progress:
+            progress(_finish(dict(report), started))
+
+    # Two batches in flight: one filling up while the previous one's images finish
+    batches = deque()
+    current = []
+    position = 0
+    try:
+        for position, raw in enumerate(records, 1):
+            if position <= skip:
+                continue
+            try:
+                recipe = normalize(raw, categories)
+            except ValueError as e:
+                report["invalid"] += 1
+                if len(report["errors"]) < MAX_ERRORS:
+                    report["errors"].append(f"record {position}: {e}")
+                continue
+            report["unknown_categories"].update(recipe.pop("unknown_categories"))
+
+            image = recipe.pop("image")
+            if image and images_dir:
+                path = os.path.join(images_dir, os.path.basename(image))
+                if allowed_file(path) and os.path.isfile(path):
+                    recipe["image_future"] = submit(path)
+                else:
+                    report["images_missing"] += 1
+
+            current.append(recipe)
+            if len(current) >= batch:
+                batches.append((current, position))
+                current = []
+                if len(batches) > 1:
+                    flush(*batches.popleft())
+
+        while batches:
+            flush(*batches.popleft())
+        # Also marks the checkpoint finished when the last batch was already full
+        flush(current, max(position, skip), finished=True)
+    except BaseException:
+        # The batches still in flight won't be committed; their images may already be written
+        if executor:
+            executor.shutdown(cancel_futures=True)
+        for pending, _ in batches:
+            discard(pending)
+        discard(current)
+        raise
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+    return _finish(report, started)
+
+
+def _finish(report, started):
+    seconds = time.perf_counter() - started
+    report["seconds"] = seconds
+    report["recipes_per_s"] = report["recipes_imported"] / seconds if seconds else 0.0
+    report["images_per_s"] = report["images_processed"] / seconds if seconds else 0.0
+    return report
+
+
+def summary(report):
+    if report["already_finished"]:
+        return f"This file was already imported ({report['records_read']} records)"
+    lines = [f"Imported {report['recipes_imported']} recipes from {report['records_read'] - report['resumed_at']} "
+             f"records in {report['seconds']:.1f}s ({report['recipes_per_s']:.0f} recipes/s, "
+             f"{report['images_processed']} images at {report['images_per_s']:.1f}/s)"]
+    if report["resumed_at"]:
+        lines.append(f"Resumed after record {report['resumed_at']}")
+    if report["invalid"]:
+        lines.append(f"{report['invalid']} invalid records skipped: " + "; ".join(report["errors"]))
+    if report["unknown_categories"]:
+        lines.append("Unknown categories ignored: " + ", ".join(
+            f"{name} ({count})" for name, count in report["unknown_categories"].most_common(10)))
+    if report["images_failed"] or report["images_missing"]:
+        lines.append(f"Images: {report['images_failed']} could not be processed, "
+                     f"{report['images_missing']} not found")
+    return "\n".join(lines)
+
+
+def main():
+    import argparse  # only the command line needs it; keeps `import app` cheap
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("file")
+    parser.add_argument("--user", required=True, help="username that will own the recipes")
+    parser.add_argument("--images", help="directory with the images the records name")
+    parser.add_argument("--format", choices=FORMATS, help="default: from the file extension")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="image processes (default: one per core, 0: none)")
+    parser.add_argument("--database", default=schema.DATABASE)
+    parser.add_argument("--uploads", default=UPLOADS_DIR)
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint of an earlier run")
+    args = parser.parse_args()
+    fmt = args.format or ("csv" if args.file.lower().endswith(".csv") else "jsonl")
+
+    conn = db.connect(args.database, isolation_level=None)
+    row = conn.execute("SELECT id FROM users WHERE username = ? COLLATE NOCASE", (args.user,)).fetchone()
+    if row is None:
+        sys.exit(f"No user named {args.user!r}")
+    os.makedirs(args.uploads, exist_ok=True)
+
+    def progress(report):
+        print(f"  {report['records_read']:>10} records  {report['recipes_imported']:>10} imported  "
+              f"{report['recipes_per_s']:>8.0f} recipes/s", file=sys.stderr)
+
+    with open(args.file, newline="", encoding="utf-8") as stream:
+        report = import_recipes(conn, read_records(stream, fmt), row["id"], source_key(args.file),
+                                images_dir=args.images, upload_folder=args.uploads, batch=args.batch,
+                                workers=args.workers, restart=args.restart, progress=progress)
+    conn.close()
+    print(summary(report))
+    if report["already_finished"]:
+        print("Run with --restart to import it again")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""Index checker: do the app's queries scan, and would one of our candidate indexes help?
+
+Usage: python index_advisor.py [database]
+
+Runs EXPLAIN QUERY PLAN for the query shapes the app issues (QUERY_SHAPES) and flags
+full table scans and temporary B-trees (an ORDER BY / GROUP BY / DISTINCT sorted at
+query time). Then, on an empty in-memory copy of the schema and its sqlite_stat1
+statistics (no rows, so a large database costs no memory), it adds each index in
+CANDIDATE_INDEXES on its own and reports which of those problems it removes. It only
+tries that hand-written list; it doesn't derive new indexes from the plans, so a scan
+that no candidate removes needs a new candidate (or a rewritten query). Indexes worth
+keeping go into a migration (see migrate.py).
+
+The database is opened read-only and must exist. Keep QUERY_SHAPES in step with the SQL
+in app.py and the helper modules.
+"""
+import sqlite3
+import sys
+
+import schema
+
+# (description, sql, parameters). Parameters only need the right types.
+QUERY_SHAPES = [
+    ("index: all recipes",
+     "SELECT r.id, r.title, u.username FROM recipes r JOIN users u ON r.user_id = u.id "
+     "ORDER BY r.title ASC", ()),
+    ("index: my and default recipes",
+     "SELECT r.id, r.title, u.username FROM recipes r JOIN users u ON r.user_id = u.id "
+     "WHERE (r.user_id = ? OR r.user_id = ?) ORDER BY r.title ASC", (2, 1)),
+    ("index: category filter",
+     "SELECT r.id, r.title FROM recipes r JOIN users u ON r.user_id = u.id WHERE (r.user_id = ? OR r.user_id = ?) "
+     "AND EXISTS (SELECT 1 FROM recipe_categories rc WHERE rc.recipe_id = r.id AND rc.category_id = ?) "
+     "ORDER BY r.title ASC", (2, 1, 3)),
+    ("my_recipes",
+     "SELECT r.id, r.title, u.username FROM recipes r JOIN users u ON r.user_id = u.id "
+     "WHERE r.user_id = ? ORDER BY r.title", (2,)),
+    ("favorites",
+     "SELECT r.id, r.title, u.username FROM favorites f JOIN recipes r ON f.recipe_id = r.id "
+     "JOIN users u ON r.user_id = u.id WHERE f.user_id = ? ORDER BY r.title", (2,)),
+    ("favorite_state.favorite_ids",
+     "SELECT recipe_id FROM favorites WHERE user_id = ?", (2,)),
+    ("recipe_cache.load_recipe: categories",
+     "SELECT c.id, c.name FROM recipe_categories rc JOIN categories c ON rc.category_id = c.id "
+     "WHERE rc.recipe_id = ? ORDER BY c.name", (1,)),
+    ("recipe_cache.load_recipe: ingredients",
+     "SELECT name, quantity_unit FROM ingredients WHERE recipe_id = ?", (1,)),
+    ("export.iter_recipes: batch",
+     "SELECT r.id, r.title, u.username FROM recipes r JOIN users u ON r.user_id = u.id "
+     "WHERE r.id > ? AND (r.user_id = ? OR r.user_id = ?) ORDER BY r.id LIMIT ?", (0, 2, 1, 500)),
+    ("export.iter_recipes: ingredients",
+     "SELECT recipe_id, name, quantity_unit FROM ingredients WHERE recipe_id IN (?, ?, ?) "
+     "ORDER BY recipe_id, id", (1, 2, 3)),
+    ("category list",
+     "SELECT id, name FROM categories ORDER BY name", ()),
+    ("login by email",
+     "SELECT id, username, hash, auth_version FROM users WHERE email = ? COLLATE NOCASE", ("a@b.c",)),
+    ("login by username",
+     "SELECT id, username, hash, auth_version FROM users WHERE username = ? COLLATE NOCASE", ("a",)),
+    # delete_recipe deletes the children itself; ON DELETE CASCADE runs the same lookups
+    ("delete_recipe: favorites",
+     "DELETE FROM favorites WHERE recipe_id = ?", (1,)),
+    ("delete_recipe: recipe_categories",
+     "DELETE FROM recipe_categories WHERE recipe_id = ?", (1,)),
+    ("forgot_password: replace token",
+     "INSERT INTO password_reset_tokens (user_id, token_hash, expires_at) VALUES (?, ?, ?) "
+     "ON CONFLICT (user_id) DO UPDATE SET token_hash = excluded.token_hash, expires_at = excluded.expires_at",
+     (2, b"h", 0)),
+    ("reset_password: token lookup",
+     "SELECT user_id FROM password_reset_tokens WHERE token_hash = ? AND expires_at > ?", (b"h", 0)),
+    ("expired token sweep",
+     "DELETE FROM password_reset_tokens WHERE id IN ("
+     "SELECT id FROM password_reset_tokens WHERE expires_at <= ? ORDER BY expires_at LIMIT ?)", (0, 500)),
+]
+
+CANDIDATE_INDEXES = [
+    ("idx_favorites_recipe_id", "CREATE INDEX idx_favorites_recipe_id ON favorites(recipe_id)"),
+    ("idx_recipes_user_id_title", "CREATE INDEX idx_recipes_user_id_title ON recipes(user_id, title)"),
+    ("idx_recipes_title", "CREATE INDEX idx_recipes_title ON recipes(title)"),
+    ("idx_password_reset_tokens_expires_at",
+     "CREATE INDEX idx_password_reset_tokens_expires_at ON password_reset_tokens(expires_at)"),
+]
+
+
+def problems(conn, sql, params):
+    """Full scans and temp B-trees in the plan, e.g. ["SCAN favorites"]."""
+    found = []
+    for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+        detail = row[3]
+        if detail.startswith("SCAN "):
+            # "SCAN r USING INDEX ..." still reads every row: keep just "SCAN r"
+            found.append(" ".join(detail.split()[:2]))
+        elif "TEMP B-TREE" in detail:
+            found.append(detail)
+    return found
+
+
+def existing_indexes(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+
+def copy_schema(database):
+    """An in-memory database with `database`'s schema and planner statistics, but no rows.
+
+    EXPLAIN QUERY PLAN only needs the schema and sqlite_stat1, so the data itself (however
+    big) is never read.
+    """
+    # Read-only: a mistyped path must not leave an empty database behind
+    source = sqlite3.connect(f"file:{database}?mode=ro", uri=True)
+    conn = sqlite3.connect(":memory:")
+    try:
+        order = {"table": 0, "index": 1, "view": 2, "trigger": 3}
+        objects = source.execute(
+            "SELECT type, sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'").fetchall()
+        for _, sql in sorted(objects, key=lambda row: order[row[0]]):
+            conn.execute(sql)
+        has_stats = source.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'").fetchone()
+        if has_stats:
+            conn.execute("ANALYZE")  # creates an empty sqlite_stat1
+            conn.execute("DELETE FROM sqlite_stat1")
+            conn.executemany("INSERT INTO sqlite_stat1 (tbl, idx, stat) VALUES (?, ?, ?)",
+                             source.execute("SELECT tbl, idx, stat FROM sqlite_stat1"))
+            conn.commit()
+            conn.execute("ANALYZE sqlite_schema")  # load the copied statistics
+    finally:
+        source.close()
+    return conn
+
+
+def advise(database=schema.DATABASE):
+    """Print the report; returns {candidate name: [(query, problem removed)]}."""
+    conn = copy_schema(database)
+
+    present = existing_indexes(conn)
+    baseline = {name: problems(conn, sql, params) for name, sql, params in QUERY_SHAPES}
+
+    print("Current plans:")
+    for name, found in baseline.items():
+        for problem in found:
+            print(f"  {name:<40} {problem}")
+
+    removed = {}
+    for index_name, create_sql in CANDIDATE_INDEXES:
+        if index_name in present:
+            continue
+        conn.execute(create_sql)
+        removed[index_name] = [(name, problem)
+                               for name, sql, params in QUERY_SHAPES
+                               for problem in sorted(set(baseline[name]) - set(problems(conn, sql, params)))]
+        conn.execute(f"DROP INDEX {index_name}")
+    conn.close()
+
+    print("\nCandidate indexes:")
+    for index_name, create_sql in CANDIDATE_INDEXES:
+        if index_name in present:
+            print(f"  {index_name}: already exists")
+        elif removed[index_name]:
+            print(f"  {index_name}: recommended")
+            for name, problem in removed[index_name]:
+                print(f"      removes {problem!r} from {name}")
+        else:
+            print(f"  {index_name}: no effect, skip")
+    return removed
+
+
+if __name__ == "__main__":
+    database = sys.argv[1] if len(sys.argv) > 1 else schema.DATABASE
+    try:
+        advise(database)
+    except sqlite3.OperationalError as e:
+        # Missing file, or not a database the app has created (e.g. "no such table: recipes")
+        sys.exit(f"{database}: {e}; run migrate.py or start the app once to create it")
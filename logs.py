@@ -0,0 +1,230 @@
+"""Structured logging: JSON lines with request ids, written from a background thread.
+
+Modules log through the standard library (`logger = logging.getLogger(__name__)`), with
+fields passed as `extra`:
+
+    logger.info("Recipe image replaced", extra={"recipe_id": recipe_id})
+
+init_logging() puts one handler on the root logger. It only queues the record, so a
+request never waits on stdout/stderr; a QueueListener thread formats and writes it.
+When the queue is full (LOG_QUEUE_SIZE) records are dropped and counted rather than
+blocking the request. On their way into the queue, records get:
+
+- the request id (from an incoming X-Request-ID header, or a new one; also sent back in
+  the response's X-Request-ID header),
+- rate limiting: at most LOG_RATE_LIMIT records per LOG_RATE_WINDOW seconds with the same
+  logger, level and message template; the first record after a quiet window reports how
+  many were suppressed,
+- redaction: fields named like secrets (token, password, ...) and reset links in the
+  message are replaced with [redacted]. Use fingerprint() to log a reference to a
+  secret that can be matched up without revealing it.
+
+LOG_FORMAT=text prints the same records as plain lines for development.
+"""
+import atexit
+import hashlib
+import json
+import logging
+import logging.handlers
+import queue
+import re
+import sys
+import threading
+import time
+import uuid
+
+from flask import g, has_request_context, request
+
+REDACTED = "[redacted]"
+SENSITIVE_FIELDS = {"token", "password", "new_password", "hash", "secret", "reset_link", "authorization", "cookie"}
+SENSITIVE_PATTERNS = (re.compile(r"(reset_password/)[^\s/?\"']+"), re.compile(r"(token=)[^\s&\"']+"))
+REQUEST_ID = re.compile(r"[A-Za-z0-9._-]{1,64}")
+
+# Attributes every LogRecord has; anything else on a record came in through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def fingerprint(value):
+    """Short, stable reference to a secret (sha256 prefix) that is safe to log."""
+    return hashlib.sha256(str(value).encode()).hexdigest()[:12]
+
+
+def redact(text):
+    """`text` with reset links and token= parameters replaced by [redacted]."""
+    for pattern in SENSITIVE_PATTERNS:
+        text = pattern.sub(rf"\g<1>{REDACTED}", text)
+    return text
+
+
+def fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = g.get("request_id") if has_request_context() else None
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Let through `limit` records per `window` seconds per (logger, level, template)."""
+
+    def __init__(self, limit=20, window=60):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.suppressed_total = 0
+        self._windows = {}  # key -> [window start, records let through, records suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            state = self._windows.get(key)
+            if state is None or now - state[0] >= self.window:
+                if len(self._windows) > 10000:  # templates are finite; this is only a backstop
+                    self._windows.clear()
+                if state and state[2]:
+                    record.suppressed = state[2]
+                self._windows[key] = [now, 1, 0]
+                return True
+            if state[1] < self.limit:
+                state[1] += 1
+                return True
+            state[2] += 1
+            self.suppressed_total += 1
+            return False
+
+
+class RedactFilter(logging.Filter):
+    def filter(self, record):
+        try:
+            message = record.getMessage()
+        except Exception:  # bad arguments; let the handler report it
+            return True
+        record.msg, record.args = redact(message), None
+        for key in fields(record):
+            if key.lower() in SENSITIVE_FIELDS:
+                setattr(record, key, REDACTED)
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops (and counts) records when the queue is full."""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Keep the traceback in its own field instead of appending it to the message
+        record = logging.makeLogRecord(vars(record))
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(fields(record))
+        if entry.get("request_id") is None:
+            entry.pop("request_id", None)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        extra = fields(record)
+        request_id = extra.pop("request_id", None)
+        line = (f"{self.formatTime(record)} {record.levelname} {record.name}"
+                f"{f' [{request_id}]' if request_id else ''}: {record.getMessage()}")
+        if extra:
+            line += " " + " ".join(f"{key}={value!r}" for key, value in extra.items())
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+_installed = None
+
+
+class AsyncLogging:
+    def __init__(self, level="INFO", fmt="json", queue_size=10000, rate_limit=20, rate_window=60, stream=None):
+        self.queue_size = queue_size
+        self.handler = DroppingQueueHandler(queue.Queue(queue_size))
+        self.handler.addFilter(RequestIdFilter())
+        self.rate_limit = RateLimitFilter(rate_limit, rate_window)
+        self.handler.addFilter(self.rate_limit)
+        self.handler.addFilter(RedactFilter())
+        self.output = logging.StreamHandler(stream or sys.stderr)
+        self.output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+        self.level = level
+        self.listener = None
+        atexit.register(self.stop)
+
+    def install(self):
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            if isinstance(handler, DroppingQueueHandler):
+                root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(self.level)
+
+    def start(self):
+        """Start this process's writer thread (a forked worker doesn't inherit it)."""
+        # The parent's queue may have been forked mid-put; start over with an empty one
+        self.handler.queue = queue.Queue(self.queue_size)
+        self.listener = logging.handlers.QueueListener(self.handler.queue, self.output)
+        self.listener.start()
+
+    def stop(self):
+        """Write out what is queued and stop the writer thread."""
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+            self.output.flush()
+
+
+def init_logging(app):
+    global _installed
+    if _installed:  # an earlier app in this process (tests, scripts) hands over the root logger
+        _installed.stop()
+    async_logging = AsyncLogging(level=app.config["LOG_LEVEL"], fmt=app.config["LOG_FORMAT"],
+                                 queue_size=app.config["LOG_QUEUE_SIZE"],
+                                 rate_limit=app.config["LOG_RATE_LIMIT"], rate_window=app.config["LOG_RATE_WINDOW"])
+    async_logging.install()
+    async_logging.start()
+    _installed = async_logging
+    app.extensions["logging"] = async_logging
+
+    @app.before_request
+    def assign_request_id():
+        incoming = request.headers.get("X-Request-ID", "")
+        g.request_id = incoming if REQUEST_ID.fullmatch(incoming) else uuid.uuid4().hex[:16]
+
+    @app.after_request
+    def send_request_id(response):
+        if "request_id" in g:
+            response.headers["X-Request-ID"] = g.request_id
+        return response
+
+    if "metrics" in app.extensions:
+        app.extensions["metrics"].collectors.append(lambda: [
+            ("log_records_dropped_total", (), async_logging.handler.dropped),
+            ("log_records_suppressed_total", (), async_logging.rate_limit.suppressed_total),
+        ])
+    return async_logging
@@ -0,0 +1,259 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import reset_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class Maintenance:
+    """Background SQLite upkeep, one thread per worker process.
+
+    Every `interval` seconds the thread checks whether a task is due:
+
+    - checkpoint: when the -wal file is over `checkpoint_bytes`, PRAGMA wal_checkpoint(PASSIVE)
+      (never waits for anyone); over `truncate_bytes`, wal_checkpoint(TRUNCATE) to also
+      shrink the file back to zero once the readers let go of it.
+    - optimize: PRAGMA optimize, so the planner's statistics follow the data.
+    - analyze: a full ANALYZE (bounded by analysis_limit), and right away if the database
+      has no sqlite_stat1 yet.
+    - vacuum: PRAGMA incremental_vacuum in small steps when many pages are free. Only does
+      something on databases created with auto_vacuum = INCREMENTAL (see schema.bootstrap).
+    - reset_tokens: delete expired password reset tokens, a batch per statement (see
+      reset_tokens.sweep_expired), so the write lock is only held briefly at a time.
+    - backup: an online snapshot of the database and uploads into `backup_dir` (backup.py),
+      keeping the newest `backup_keep`. Off unless backup_dir is set. Runs in a thread of
+      its own, outside the connection lock (see run_pending).
+
+    Each task is leased through its row in the maintenance table (migration 0003): a
+    worker runs it only if its UPDATE moved last_run forward, so with N workers a task
+    still runs once per period. The outcome is stored in the same row and in `stats`.
+    """
+
+    def __init__(self, database, interval=30, checkpoint_bytes=4 * 1024 * 1024,
+                 truncate_bytes=64 * 1024 * 1024, optimize_interval=3600, analyze_interval=86400,
+                 vacuum_interval=3600, vacuum_free_pages=1024, vacuum_step=256, reset_token_sweep_interval=600,
+                 backup_dir=None, backup_interval=86400, backup_keep=7, uploads_dir="static/uploads"):
+        self.database = database
+        self.interval = interval
+        self.checkpoint_bytes = checkpoint_bytes
+        self.truncate_bytes = truncate_bytes
+        self.periods = {"checkpoint": interval, "optimize": optimize_interval,
+                        "analyze": analyze_interval, "vacuum": vacuum_interval,
+                        "reset_tokens": reset_token_sweep_interval, "backup": backup_interval}
+        self.vacuum_free_pages = vacuum_free_pages
+        self.vacuum_step = vacuum_step
+        self.backup_dir = backup_dir
+        self.backup_keep = backup_keep
+        self.uploads_dir = uploads_dir
+        self.stats = {}  # task -> {"runs", "last_ms", "last_result"}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()  # the connection is shared with report() callers
+        self._stop = threading.Event()
+        self._thread = None
+        self._backup_thread = None
+        self._pid = None
+        self._conn = None
+
+    def ensure_started(self):
+        """Start this process's thread (a forked worker doesn't inherit its parent's)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._conn = None
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="sqlite-maintenance", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _connect(self):
+        if self._conn is None:
+            # Autocommit: the lease UPDATEs and the PRAGMAs each stand alone
+            self._conn = sqlite3.connect(self.database, timeout=10, isolation_level=None,
+                                         check_same_thread=False)
+        return self._conn
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_pending(background_backup=True)
+            except Exception:
+                # Whatever went wrong (a locked database, a malformed backup manifest, ...),
+                # keep the thread alive: ensure_started() won't start another one in this process
+                logger.exception("SQLite maintenance failed")
+
+    def wal_bytes(self):
+        try:
+            return os.path.getsize(self.database + "-wal")
+        except OSError:
+            return 0
+
+    def page_counts(self):
+        conn = self._connect()
+        return {
+            "page_size": conn.execute("PRAGMA page_size").fetchone()[0],
+            "page_count": conn.execute("PRAGMA page_count").fetchone()[0],
+            "freelist_count": conn.execute("PRAGMA freelist_count").fetchone()[0],
+        }
+
+    def _claim(self, task, period):
+        now = int(time.time())
+        claimed = self._connect().execute(
+            "UPDATE maintenance SET last_run = ? WHERE task = ? AND last_run <= ?",
+            (now, task, now - period)).rowcount
+        return claimed == 1
+
+    def _record(self, task, started, result):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        stats = self.stats.setdefault(task, {"runs": 0})
+        stats.update(runs=stats["runs"] + 1, last_ms=elapsed_ms, last_result=result)
+        self._connect().execute("UPDATE maintenance SET duration_ms = ?, result = ? WHERE task = ?",
+                                (elapsed_ms, result, task))
+
+    def run_pending(self, background_backup=False):
+        """Run every task that is due (the thread calls this; `python maintenance.py` too).
+
+        A backup can take minutes on a large database (it also hashes every upload), so it
+        runs without the connection lock, which is only taken to claim and record it; with
+        `background_backup` it runs in a thread of its own and the checkpoints go on meanwhile.
+        """
+        with self._db_lock:
+            self._run_pending(self._connect())
+        if not self.backup_dir or (self._backup_thread is not None and self._backup_thread.is_alive()):
+            return
+        with self._db_lock:
+            if not self._claim("backup", self.periods["backup"]):
+                return
+        if background_backup:
+            self._backup_thread = threading.Thread(target=self._backup, name="sqlite-backup", daemon=True)
+            self._backup_thread.start()
+        else:
+            self._backup()
+
+    def _backup(self):
+        import backup
+        started = time.perf_counter()
+        try:
+            manifest = backup.create_snapshot(self.backup_dir, self.database, self.uploads_dir,
+                                              keep=self.backup_keep)
+            result = backup.summary(manifest)
+        except Exception as e:
+            logger.exception("Backup failed")
+            result = f"failed: {e}"
+        with self._db_lock:
+            self._record("backup", started, result)
+
+    def _run_pending(self, conn):
+        wal_bytes = self.wal_bytes()
+        if wal_bytes > self.checkpoint_bytes and self._claim("checkpoint", self.periods["checkpoint"]):
+            mode = "TRUNCATE" if wal_bytes > self.truncate_bytes else "PASSIVE"
+            started = time.perf_counter()
+            busy, log_frames, checkpointed = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+            self._record("checkpoint", started, f"{mode} wal={wal_bytes} busy={busy} "
+                                                f"frames={log_frames} checkpointed={checkpointed}")
+
+        has_stats = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'").fetchone()
+        if self._claim("analyze", 0 if not has_stats else self.periods["analyze"]):
+            started = time.perf_counter()
+            conn.execute("PRAGMA analysis_limit = 1000")  # sample big indexes instead of reading them
+            conn.execute("ANALYZE")
+            self._record("analyze", started, "ok")
+        elif self._claim("optimize", self.periods["optimize"]):
+            started = time.perf_counter()
+            conn.execute("PRAGMA analysis_limit = 1000")
+            conn.execute("PRAGMA optimize")
+            self._record("optimize", started, "ok")
+
+        if self._claim("vacuum", self.periods["vacuum"]):
+            started = time.perf_counter()
+            auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if auto_vacuum != 2:
+                result = f"skipped (auto_vacuum={auto_vacuum}) free={free_pages}"
+            elif free_pages < self.vacuum_free_pages:
+                result = f"skipped free={free_pages}"
+            else:
+                # A few small steps, so no write lock is held for long
+                while free_pages >= self.vacuum_free_pages and not self._stop.is_set():
+                    conn.execute(f"PRAGMA incremental_vacuum({self.vacuum_step})").fetchall()
+                    free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                result = f"free={free_pages}"
+            self._record("vacuum", started, result)
+
+        if self._claim("reset_tokens", self.periods["reset_tokens"]):
+            started = time.perf_counter()
+            deleted = reset_tokens.sweep_expired(conn, should_stop=self._stop.is_set)
+            self._record("reset_tokens", started, f"deleted={deleted}")
+
+
+    def report(self):
+        """Current gauges plus the last outcome of each task, for metrics and the CLI."""
+        with self._db_lock:
+            report = {"wal_bytes": self.wal_bytes(), **self.page_counts(), "tasks": {}}
+            for task, last_run, duration_ms, result in self._connect().execute(
+                    "SELECT task, last_run, duration_ms, result FROM maintenance ORDER BY task"):
+                report["tasks"][task] = {"last_run": last_run, "duration_ms": duration_ms, "result": result,
+                                         **self.stats.get(task, {})}
+        return report
+
+
+def init_maintenance(app):
+    maintenance = Maintenance(
+        app.config["DATABASE"],
+        interval=app.config.get("MAINTENANCE_INTERVAL", 30),
+        checkpoint_bytes=app.config.get("WAL_CHECKPOINT_BYTES", 4 * 1024 * 1024),
+        truncate_bytes=app.config.get("WAL_TRUNCATE_BYTES", 64 * 1024 * 1024),
+        optimize_interval=app.config.get("OPTIMIZE_INTERVAL", 3600),
+        analyze_interval=app.config.get("ANALYZE_INTERVAL", 86400),
+        reset_token_sweep_interval=app.config.get("RESET_TOKEN_SWEEP_INTERVAL", 600),
+        backup_dir=app.config.get("BACKUP_DIR"),
+        backup_interval=app.config.get("BACKUP_INTERVAL", 86400),
+        backup_keep=app.config.get("BACKUP_KEEP", 7),
+        uploads_dir=app.config.get("UPLOAD_FOLDER", "static/uploads"),
+    )
+    app.extensions["maintenance"] = maintenance
+    if app.config.get("MAINTENANCE", True):
+        @app.before_request
+        def start_maintenance():
+            maintenance.ensure_started()
+    return maintenance
+
+
+def enable_incremental_vacuum(database):
+    """Switch an existing database to auto_vacuum = INCREMENTAL.
+
+    Needs a full VACUUM (rewrites the file, blocks writers meanwhile), so run it offline.
+    Databases created by schema.bootstrap() already have it.
+    """
+    conn = sqlite3.connect(database, isolation_level=None)
+    try:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    # python maintenance.py [database]            run whatever is due (e.g. from cron with MAINTENANCE=0)
+    # python maintenance.py --enable-incremental-vacuum [database]
+    import sys
+
+    import schema
+    args = sys.argv[1:]
+    if args and args[0] == "--enable-incremental-vacuum":
+        database = args[1] if len(args) > 1 else schema.DATABASE
+        print("auto_vacuum = INCREMENTAL" if enable_incremental_vacuum(database) else "VACUUM failed")
+    else:
+        maintenance = Maintenance(args[0] if args else schema.DATABASE)
+        maintenance.run_pending()
+        for key, value in maintenance.report().items():
+            print(f"{key}: {value}")
@@ -0,0 +1,181 @@
+"""Opt-in memory instrumentation with tracemalloc (MEMORY_PROFILING=1).
+
+- Per route: how much a request allocates at its peak, and how much of it is still held
+  when it ends (retained, the thing that adds up to a leak). tracemalloc's peak is per
+  process, so only requests that ran alone in their worker are measured; requests that
+  overlapped another one are counted as such but not measured. Run with
+  GUNICORN_THREADS=1 while measuring to measure them all.
+- Every MEMORY_SNAPSHOT_INTERVAL seconds a thread in each worker takes a tracemalloc
+  snapshot. /debug/memory (with "Authorization: Bearer <MEMORY_TOKEN>") answers, for
+  the worker that serves it, with the route table and the biggest differences between the
+  last two snapshots, by source line. ?fresh=1 compares a snapshot taken now with the
+  last periodic one instead; ?group=traceback shows whole allocation stacks
+  (MEMORY_TRACE_FRAMES deep); ?limit=N sets the number of entries.
+
+RSS and garbage collector numbers are always in /metrics (metrics.py); with this module
+on, /metrics also reports the traced bytes.
+
+Tracing makes every Python allocation slower (roughly 2x in allocation-heavy code), so
+turn it on to hunt a leak or size a cache, not permanently.
+"""
+import hmac
+import os
+import threading
+import time
+import tracemalloc
+
+from flask import abort, current_app, g, jsonify, request
+
+from metrics import rss_bytes
+
+# Allocations made by the instrumentation itself
+IGNORED = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+class MemoryProfiler:
+    def __init__(self, frames=5, snapshot_interval=300):
+        self.frames = frames
+        self.snapshot_interval = snapshot_interval
+        self.routes = {}  # endpoint -> request counts and byte totals, see request_finished
+        self.snapshots = []  # the last two periodic (time, snapshot) pairs
+        self._lock = threading.Lock()
+        self._active = 0
+        self._starts = 0  # requests started so far: a request ran alone if nobody started after it
+        self._pid = None
+
+    def ensure_started(self):
+        """Start tracing and this process's snapshot thread (not inherited over a fork)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self.routes = {}
+                self.snapshots = []
+                self._active = 0
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(self.frames)
+                threading.Thread(target=self._run, name="memory-snapshots", daemon=True).start()
+
+    def _run(self):
+        while True:
+            self.take_snapshot()
+            time.sleep(self.snapshot_interval)
+
+    def take_snapshot(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces(IGNORED)
+        with self._lock:
+            self.snapshots = self.snapshots[-1:] + [(time.time(), snapshot)]
+        return snapshot
+
+    def request_started(self):
+        with self._lock:
+            self._active += 1
+            self._starts += 1
+            alone = self._active == 1
+            if alone:
+                tracemalloc.reset_peak()
+            return self._starts, alone, tracemalloc.get_traced_memory()[0]
+
+    def request_finished(self, endpoint, started):
+        starts, alone, before = started
+        with self._lock:
+            current, peak = tracemalloc.get_traced_memory()
+            self._active -= 1
+            route = self.routes.get(endpoint)
+            if route is None:
+                route = self.routes[endpoint] = {"requests": 0, "overlapped": 0, "measured": 0,
+                                                 "peak_max": 0, "peak_total": 0, "retained_total": 0}
+            route["requests"] += 1
+            if not (alone and starts == self._starts):
+                route["overlapped"] += 1
+                return
+            route["measured"] += 1
+            route["peak_max"] = max(route["peak_max"], peak - before)
+            route["peak_total"] += peak - before
+            route["retained_total"] += current - before
+
+    def route_table(self):
+        table = {}
+        with self._lock:
+            routes = {endpoint: dict(route) for endpoint, route in self.routes.items()}
+        for endpoint, route in sorted(routes.items()):
+            measured = route.pop("measured")
+            table[endpoint] = {
+                "requests": route["requests"],
+                "overlapped": route["overlapped"],
+                "peak_bytes_max": route["peak_max"],
+                "peak_bytes_mean": route["peak_total"] // measured if measured else None,
+                "retained_bytes_mean": route["retained_total"] // measured if measured else None,
+            }
+        return table
+
+    def diff(self, fresh=False, group="lineno", limit=20):
+        """Biggest differences between the last two snapshots (or the last one and now)."""
+        with self._lock:
+            snapshots = list(self.snapshots)
+        if fresh and snapshots:
+            snapshots = [snapshots[-1], (time.time(), self.take_snapshot())]
+        if len(snapshots) < 2:
+            return None
+        (older_time, older), (newer_time, newer) = snapshots
+        stats = newer.compare_to(older, group)
+        return {
+            "from": older_time,
+            "to": newer_time,
+            "size_diff_bytes": sum(stat.size_diff for stat in stats),
+            "top": [{
+                "where": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+                "size_bytes": stat.size,
+                "size_diff_bytes": stat.size_diff,
+                "count": stat.count,
+                "count_diff": stat.count_diff,
+            } for stat in stats[:limit]],
+        }
+
+
+def init_memory_profiling(app):
+    profiler = MemoryProfiler(frames=app.config["MEMORY_TRACE_FRAMES"],
+                              snapshot_interval=app.config["MEMORY_SNAPSHOT_INTERVAL"])
+    app.extensions["memory_profiler"] = profiler
+
+    @app.before_request
+    def start_memory_tracking():
+        profiler.ensure_started()
+        g.memory_started = profiler.request_started()
+
+    @app.teardown_request
+    def record_memory_tracking(exc):
+        started = g.pop("memory_started", None)
+        if started is not None:
+            profiler.request_finished(request.endpoint or "none", started)
+
+    if "metrics" in app.extensions:
+        app.extensions["metrics"].collectors.append(
+            lambda: [("tracemalloc_traced_bytes", (), tracemalloc.get_traced_memory()[0])])
+
+    def memory_report():
+        token = current_app.config.get("MEMORY_TOKEN")
+        if not token:
+            abort(403)
+        if not hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()):
+            return "Unauthorized\n", 401, {"WWW-Authenticate": "Bearer"}
+        group = request.args.get("group", "lineno")
+        if group not in ("lineno", "traceback", "filename"):
+            abort(400)
+        return jsonify({
+            "pid": os.getpid(),
+            "rss_bytes": rss_bytes(),
+            "traced_bytes": tracemalloc.get_traced_memory()[0],
+            "routes": profiler.route_table(),
+            "diff": profiler.diff(fresh=request.args.get("fresh") == "1", group=group,
+                                  limit=request.args.get("limit", 20, type=int)),
+        })
+
+    app.add_url_rule("/debug/memory", "memory_report", memory_report)
+    return profiler
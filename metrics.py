@@ -0,0 +1,326 @@
+"""Prometheus metrics, served in the text exposition format at /metrics.
+
+Recording is lock-free: each thread adds to its own shard (a dict no other thread
+writes), and a scrape adds the shards up. A request costs a few dict updates when it
+ends; everything else (cache statistics, file sizes) is read only when scraped.
+
+Under gunicorn each worker has its own numbers. With METRICS_DIR set, every worker
+writes its totals to METRICS_DIR/<pid>.json about once a second and /metrics merges
+the files of all workers. Files of workers that have exited (max_requests) are folded
+into dead.json, so counters keep going up instead of dropping with each recycled worker.
+"""
+import bisect
+import gc
+import hmac
+import json
+import os
+import threading
+import time
+
+from flask import abort, current_app, g, request
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name -> (type, help). Only counters and histograms survive a worker's exit.
+METRICS = {
+    "http_request_duration_seconds": (
+        "histogram", "Time to handle a request, by endpoint, method and status."),
+    "http_requests_in_flight": ("gauge", "Requests being handled right now."),
+    "db_queries_total": ("counter", "SQLite statements run by requests, by endpoint."),
+    "db_query_seconds_total": ("counter", "Time requests spent in SQLite statements and fetches, by endpoint."),
+    "operation_duration_seconds": (
+        "histogram", "Time a request spent in password hashing, image processing or the session store."),
+    "cache_hits_total": ("counter", "Lookups answered by an in-process cache."),
+    "cache_misses_total": ("counter", "Lookups an in-process cache could not answer."),
+    "cache_hit_ratio": ("gauge", "Hits / lookups of an in-process cache since the workers started."),
+    "cache_entries": ("gauge", "Entries held by an in-process cache."),
+    "cache_bytes": ("gauge", "Estimated size of a size-bounded in-process cache."),
+    "sqlite_file_bytes": ("gauge", "Size of the SQLite database files."),
+    "process_resident_memory_bytes": ("gauge", "Resident set size of the worker processes."),
+    "python_gc_objects": ("gauge", "Objects allocated since the last collection of each GC generation."),
+    "python_gc_collections_total": ("counter", "Garbage collections run, by generation."),
+    "python_gc_collected_objects_total": ("counter", "Objects freed by the garbage collector, by generation."),
+    "log_records_dropped_total": ("counter", "Log records dropped because the log queue was full."),
+    "log_records_suppressed_total": ("counter", "Log records held back by the rate limit on repeated messages."),
+    "tracemalloc_traced_bytes": ("gauge", "Memory held by Python allocations traced by tracemalloc (memory.py)."),
+}
+
+
+def series_name(name, labels):
+    """'name{a="x",b="y"}' for a name and a tuple of (label, value) pairs."""
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _merge(into, series, value):
+    """Add a counter/gauge value or a histogram's [bucket counts..., count, sum] into `into`."""
+    if isinstance(value, list):
+        current = into.get(series)
+        if current is None:
+            into[series] = list(value)
+        else:
+            for i, part in enumerate(value):
+                current[i] += part
+    else:
+        into[series] = into.get(series, 0) + value
+
+
+class Metrics:
+    def __init__(self, directory=None, write_interval=1.0):
+        self.directory = directory
+        self.write_interval = write_interval
+        self.collectors = []  # callables returning [(name, labels, value)], summed across workers
+        self.global_collectors = []  # the same, for values every worker would report alike
+        self.clear()
+
+    def clear(self):
+        """Start from zero (in a freshly forked worker)."""
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()  # only taken when a thread creates its shard
+        self._last_write = 0.0
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def inc(self, name, value=1, labels=()):
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        shard = self._shard()
+        key = (name, labels)
+        counts = shard.get(key)
+        if counts is None:
+            counts = shard[key] = [0] * (len(BUCKETS) + 2)
+        index = bisect.bisect_left(BUCKETS, value)
+        if index < len(BUCKETS):
+            counts[index] += 1
+        counts[-2] += 1
+        counts[-1] += value
+
+    def local_series(self):
+        """This process's numbers: {series name: value}."""
+        series = {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for (name, labels), value in list(shard.items()):
+                _merge(series, series_name(name, labels), value)
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                _merge(series, series_name(name, labels), value)
+        return series
+
+    def maybe_write(self):
+        if self.directory and time.monotonic() - self._last_write >= self.write_interval:
+            self.write()
+
+    def write(self, series=None):
+        """Save this worker's numbers to METRICS_DIR/<pid>.json."""
+        self._last_write = time.monotonic()
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(series if series is not None else self.local_series(), f)
+        os.replace(path + ".tmp", path)
+
+    def collect(self):
+        """Every worker's numbers added up, plus the global gauges and hit ratios."""
+        if self.directory:
+            series = self.local_series()
+            self.write(series)
+            series = self._merge_directory()
+        else:
+            series = self.local_series()
+        for collector in self.global_collectors:
+            for name, labels, value in collector():
+                series[series_name(name, labels)] = value
+        _add_hit_ratios(series)
+        return series
+
+    def _merge_directory(self):
+        import fcntl  # gunicorn (and so METRICS_DIR) is Unix-only
+        merged = {}
+        with open(os.path.join(self.directory, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            dead = _load(os.path.join(self.directory, "dead.json")) or {}
+            folded = False
+            for filename in os.listdir(self.directory):
+                pid, _, extension = filename.partition(".")
+                if extension != "json" or not pid.isdigit():
+                    continue
+                series = _load(os.path.join(self.directory, filename))
+                if series is None:
+                    continue
+                if _alive(int(pid)):
+                    for name, value in series.items():
+                        _merge(merged, name, value)
+                else:
+                    for name, value in series.items():
+                        if METRICS.get(name.partition("{")[0], ("gauge",))[0] != "gauge":
+                            _merge(dead, name, value)
+                    os.remove(os.path.join(self.directory, filename))
+                    folded = True
+            if folded:
+                with open(os.path.join(self.directory, "dead.json.tmp"), "w") as f:
+                    json.dump(dead, f)
+                os.replace(os.path.join(self.directory, "dead.json.tmp"), os.path.join(self.directory, "dead.json"))
+        for name, value in dead.items():
+            _merge(merged, name, value)
+        return merged
+
+
+def rss_bytes():
+    """Current resident set size (the peak where there is no /proc)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # KB on Linux
+
+
+def process_stats():
+    yield "process_resident_memory_bytes", (), rss_bytes()
+    for generation, (pending, stats) in enumerate(zip(gc.get_count(), gc.get_stats())):
+        labels = (("generation", str(generation)),)
+        yield "python_gc_objects", labels, pending
+        yield "python_gc_collections_total", labels, stats["collections"]
+        yield "python_gc_collected_objects_total", labels, stats["collected"]
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _add_hit_ratios(series):
+    for name, hits in list(series.items()):
+        if name.startswith("cache_hits_total{"):
+            labels = name[len("cache_hits_total"):]
+            lookups = hits + series.get("cache_misses_total" + labels, 0)
+            series["cache_hit_ratio" + labels] = hits / lookups if lookups else 0.0
+
+
+def render(series):
+    """Prometheus text format."""
+    by_name = {}
+    for name, value in series.items():
+        by_name.setdefault(name.partition("{")[0], []).append((name, value))
+    lines = []
+    for metric in sorted(by_name):
+        kind, help_text = METRICS.get(metric, ("untyped", ""))
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for name, value in sorted(by_name[metric]):
+            if kind != "histogram":
+                lines.append(f"{name} {value}")
+                continue
+            labels = name[len(metric) + 1:-1] if "{" in name else ""
+            prefix = labels + "," if labels else ""
+            cumulative = 0
+            for bound, count in zip(BUCKETS, value):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{{prefix}le="+Inf"}} {value[-2]}')
+            suffix = "{" + labels + "}" if labels else ""
+            lines.append(f"{metric}_count{suffix} {value[-2]}")
+            lines.append(f"{metric}_sum{suffix} {value[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+def init_metrics(app, caches=()):
+    """Time every request and serve /metrics. Call before the other init_* functions, so
+    the timer starts ahead of their before_request handlers."""
+    metrics = Metrics(app.config.get("METRICS_DIR"))
+    app.extensions["metrics"] = metrics
+
+    def cache_stats():
+        for cache in caches:
+            stats = app.extensions[cache].stats()
+            labels = (("cache", cache),)
+            yield "cache_hits_total", labels, stats["hits"]
+            yield "cache_misses_total", labels, stats["misses"]
+            yield "cache_entries", labels, stats["entries"]
+            if "bytes" in stats:
+                yield "cache_bytes", labels, stats["bytes"]
+
+    def file_sizes():
+        paths = {"database": app.config["DATABASE"], "sessions": app.config.get("SESSION_SQLITE_PATH")}
+        for name, path in paths.items():
+            for suffix in ("", "-wal"):
+                if path and os.path.exists(path + suffix):
+                    yield "sqlite_file_bytes", (("file", name + suffix),), os.path.getsize(path + suffix)
+
+    metrics.collectors.append(cache_stats)
+    metrics.collectors.append(process_stats)
+    metrics.global_collectors.append(file_sizes)
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        metrics.inc("http_requests_in_flight")
+
+    @app.after_request
+    def remember_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def record_request_metrics(exc):
+        started = g.pop("metrics_started", None)
+        if started is None:
+            return
+        metrics.inc("http_requests_in_flight", -1)
+        endpoint = request.endpoint or "none"
+        metrics.observe("http_request_duration_seconds", time.perf_counter() - started,
+                        (("endpoint", endpoint), ("method", request.method),
+                         ("status", str(g.get("metrics_status", 500)))))
+        timings = g.get("timings", {})
+        queries = g.get("counters", {}).get("db_queries")
+        if queries:
+            labels = (("endpoint", endpoint),)
+            metrics.inc("db_queries_total", queries, labels)
+            metrics.inc("db_query_seconds_total", timings.get("db", 0.0), labels)
+        for operation, seconds in timings.items():
+            if operation != "db":
+                metrics.observe("operation_duration_seconds", seconds, (("operation", operation),))
+        metrics.maybe_write()
+
+    def metrics_endpoint():
+        token = current_app.config.get("METRICS_TOKEN")
+        if not token:  # per-endpoint traffic, file sizes and memory aren't for everyone
+            abort(403)
+        if not hmac.compare_digest(request.headers.get("Authorization", "").encode(),
+                                             f"Bearer {token}".encode()):
+            return "Unauthorized\n", 401, {"WWW-Authenticate": "Bearer"}
+        return current_app.response_class(render(metrics.collect()),
+                                          content_type="text/plain; version=0.0.4; charset=utf-8")
+
+    app.add_url_rule("/metrics", "metrics", metrics_endpoint)
+    return metrics
@@ -0,0 +1,137 @@
+"""Schema migrations on top of schema.bootstrap().
+
+Usage: python migrate.py [upgrade|status] [database]
+
+bootstrap() creates a fresh database at schema.SCHEMA_VERSION. Every later change is a
+file in migrations/ named <version>_<description>.sql (0002_query_indexes.sql, ...),
+applied in version order and recorded in PRAGMA user_version.
+
+Migrations run while the app is serving: each file is one BEGIN IMMEDIATE transaction
+that also writes its version, so readers (WAL) keep going, writers wait at most a few
+seconds, and a failed or interrupted migration leaves nothing behind. Several workers
+starting at once are fine: whoever gets the lock first applies it, the rest see the
+new user_version and skip it. Keep each migration short (CREATE INDEX on a big table
+blocks writers while it builds), and never edit one that has been deployed.
+"""
+import logging
+import os
+import re
+import sqlite3
+import sys
+
+import schema
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+MIGRATION_RE = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+
+class MigrationError(Exception):
+    """A migration file is misnamed or failed to apply (it was rolled back)."""
+
+
+def migrations(directory=MIGRATIONS_DIR):
+    """[(version, path)] sorted by version."""
+    found = []
+    for name in os.listdir(directory):
+        match = MIGRATION_RE.match(name)
+        if match is None:
+            if name.endswith(".sql"):
+                raise MigrationError(f"{name}: expected <version>_<description>.sql")
+            continue
+        found.append((int(match.group(1)), os.path.join(directory, name)))
+    found.sort()
+    for (version, path), (next_version, next_path) in zip(found, found[1:]):
+        if version == next_version:
+            raise MigrationError(f"{os.path.basename(path)} and {os.path.basename(next_path)} share version {version}")
+    if found and found[0][0] <= schema.SCHEMA_VERSION:
+        raise MigrationError(f"{os.path.basename(found[0][1])}: versions up to "
+                             f"{schema.SCHEMA_VERSION} belong to schema.bootstrap()")
+    return found
+
+
+def split_statements(sql):
+    """Split a migration into statements (a trigger body's semicolons don't end it)."""
+    statements, current = [], ""
+    for line in sql.splitlines(keepends=True):
+        current += line
+        if sqlite3.complete_statement(current):
+            if current.strip():
+                statements.append(current.strip())
+            current = ""
+    if current.strip() and not all(line.strip().startswith("--") or not line.strip()
+                                   for line in current.splitlines()):
+        raise MigrationError(f"unterminated statement: {current.strip()[:60]}")
+    return statements
+
+
+def user_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def apply_migration(conn, version, path):
+    """Apply one migration unless another process already did; returns True if applied."""
+    with open(path, encoding="utf-8") as f:
+        statements = split_statements(f.read())
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if user_version(conn) >= version:
+            conn.execute("ROLLBACK")
+            return False
+        for statement in statements:
+            conn.execute(statement)
+        conn.execute(f"PRAGMA user_version = {version}")
+        conn.execute("COMMIT")
+    except sqlite3.Error as e:
+        conn.execute("ROLLBACK")
+        raise MigrationError(f"{os.path.basename(path)}: {e}") from e
+    logger.info("Applied migration %s", os.path.basename(path))
+    return True
+
+
+def upgrade(database=schema.DATABASE, directory=MIGRATIONS_DIR):
+    """Bootstrap the database if needed, then apply pending migrations.
+
+    Returns the versions applied. When the database is current this costs a directory
+    listing and one PRAGMA read, so create_app() calls it on every start.
+    """
+    pending = migrations(directory)
+    schema.bootstrap(database)
+    if not pending:
+        return []
+    # isolation_level=None: transactions are exactly the BEGIN/COMMIT issued above
+    conn = sqlite3.connect(database, timeout=30, isolation_level=None)
+    try:
+        current = user_version(conn)
+        applied = []
+        for version, path in pending:
+            if version > current and apply_migration(conn, version, path):
+                applied.append(version)
+        return applied
+    finally:
+        conn.close()
+
+
+def status(database=schema.DATABASE, directory=MIGRATIONS_DIR):
+    conn = sqlite3.connect(database)
+    try:
+        current = user_version(conn)
+    finally:
+        conn.close()
+    print(f"{database}: schema version {current}")
+    for version, path in migrations(directory):
+        print(f"  {'applied' if version <= current else 'pending'}  {os.path.basename(path)}")
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "upgrade"
+    database = sys.argv[2] if len(sys.argv) > 2 else schema.DATABASE
+    if command == "upgrade":
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+        applied = upgrade(database)
+        print(f"Applied {len(applied)} migration(s)." if applied else "Database is up to date.")
+    elif command == "status":
+        status(database)
+    else:
+        sys.exit(__doc__)
@@ -0,0 +1,16 @@
+-- Indexes recommended by index_advisor.py for the app's queries.
+
+-- delete_recipe (and ON DELETE CASCADE from recipes) looks favorites up by recipe
+CREATE INDEX IF NOT EXISTS idx_favorites_recipe_id ON favorites(recipe_id);
+
+-- my_recipes: WHERE user_id = ? ORDER BY title straight from the index, no sort.
+-- It also serves every lookup by user_id alone, so the old single-column index goes.
+CREATE INDEX IF NOT EXISTS idx_recipes_user_id_title ON recipes(user_id, title);
+DROP INDEX IF EXISTS idx_recipes_user_id;
+
+-- index with the "all recipes" filter: ORDER BY title without a sort
+CREATE INDEX IF NOT EXISTS idx_recipes_title ON recipes(title);
+
+-- forgot_password replaces a user's previous tokens; expired ones are swept by expires_at
+CREATE INDEX IF NOT EXISTS idx_password_reset_tokens_user_id ON password_reset_tokens(user_id);
+CREATE INDEX IF NOT EXISTS idx_password_reset_tokens_expires_at ON password_reset_tokens(expires_at);
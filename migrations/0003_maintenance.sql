@@ -0,0 +1,9 @@
+-- One row per background maintenance task (maintenance.py). last_run doubles as a lease:
+-- a worker runs a task only if its UPDATE moved last_run forward.
+CREATE TABLE IF NOT EXISTS maintenance (
+    task TEXT PRIMARY KEY,
+    last_run INTEGER NOT NULL DEFAULT 0, -- unix time
+    duration_ms REAL,
+    result TEXT
+);
+INSERT OR IGNORE INTO maintenance (task) VALUES ('checkpoint'), ('optimize'), ('analyze'), ('vacuum');
@@ -0,0 +1,2 @@
+-- Scheduled online backups (backup.py) run as a maintenance task
+INSERT OR IGNORE INTO maintenance (task) VALUES ('backup');
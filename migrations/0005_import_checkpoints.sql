@@ -0,0 +1,12 @@
+-- Progress of bulk imports (importer.py). Updated in the same transaction as each batch of
+-- recipes, so a resumed import neither repeats nor skips a record.
+CREATE TABLE IF NOT EXISTS import_checkpoints (
+    source TEXT NOT NULL, -- sha256 of the input file
+    user_id INTEGER NOT NULL,
+    records_read INTEGER NOT NULL DEFAULT 0, -- input records consumed, valid or not
+    recipes_imported INTEGER NOT NULL DEFAULT 0,
+    finished INTEGER NOT NULL DEFAULT 0,
+    updated_at INTEGER NOT NULL DEFAULT 0, -- unix time
+    PRIMARY KEY (source, user_id),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
@@ -0,0 +1,19 @@
+-- Password reset tokens are stored as HMAC-SHA256(SECRET_KEY, token) with an integer unix
+-- expiry (reset_tokens.py), so a leaked database holds no usable links and expiry is one
+-- integer comparison in the lookup itself. One row per user: a new link replaces the last.
+-- Outstanding links can't be carried over (only their raw token would hash to the new
+-- value, and they expire within minutes anyway), so they are dropped.
+CREATE TABLE password_reset_tokens_hashed (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL UNIQUE,
+    token_hash BLOB NOT NULL UNIQUE,
+    expires_at INTEGER NOT NULL, -- unix time
+    FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+DROP TABLE password_reset_tokens;
+ALTER TABLE password_reset_tokens_hashed RENAME TO password_reset_tokens;
+
+-- The maintenance sweep deletes expired rows oldest first, a batch at a time
+CREATE INDEX idx_password_reset_tokens_expires_at ON password_reset_tokens(expires_at);
+
+INSERT OR IGNORE INTO maintenance (task) VALUES ('reset_tokens');
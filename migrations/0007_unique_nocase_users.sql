@@ -0,0 +1,18 @@
+-- Usernames and emails are looked up case-insensitively (find_login_user), so "Bob" and
+-- "bob" must not both exist: the login would always resolve to one of them. The NOCASE
+-- indexes from schema.create_tables become UNIQUE, which also closes the race between
+-- two registrations that both passed the existence check.
+--
+-- Case-variant duplicates already in the database keep the oldest account as it is; the
+-- later ones get "#<id>" appended to the clashing username or email, so they can still log
+-- in (by username) and can be found with:
+--   SELECT id, username, email FROM users WHERE username GLOB '*#[0-9]*' OR email GLOB '*#[0-9]*';
+UPDATE users SET username = username || '#' || id
+WHERE EXISTS (SELECT 1 FROM users older WHERE older.username = users.username COLLATE NOCASE AND older.id < users.id);
+UPDATE users SET email = email || '#' || id
+WHERE EXISTS (SELECT 1 FROM users older WHERE older.email = users.email COLLATE NOCASE AND older.id < users.id);
+
+DROP INDEX IF EXISTS idx_users_username_nocase;
+DROP INDEX IF EXISTS idx_users_email_nocase;
+CREATE UNIQUE INDEX idx_users_username_nocase ON users(username COLLATE NOCASE);
+CREATE UNIQUE INDEX idx_users_email_nocase ON users(email COLLATE NOCASE);
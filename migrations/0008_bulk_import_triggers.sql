@@ -0,0 +1,59 @@
+-- Bulk imports (importer.py) write thousands of recipes, ingredients and category links per
+-- batch. Their INSERT triggers would bump catalog_version and append a change_log row for
+-- every one of those rows, and every worker would then replay all of them. While the
+-- importer's transaction holds the single row of bulk_writes, these triggers stand down
+-- and the importer does the same work once per batch: one catalog_version bump, stamped
+-- on the batch's recipes as they are inserted, and one change_log row for the batch's
+-- recipe ids, entity_id through through_id. No other connection ever sees the row: it is
+-- inserted and deleted inside that write transaction.
+CREATE TABLE bulk_writes (
+    id INTEGER PRIMARY KEY CHECK (id = 1)
+);
+
+-- Last id of a range of changed entities (entity_id .. through_id); NULL for a single one
+ALTER TABLE change_log ADD COLUMN through_id INTEGER;
+
+DROP TRIGGER IF EXISTS trg_recipes_insert;
+CREATE TRIGGER trg_recipes_insert AFTER INSERT ON recipes
+WHEN NOT EXISTS (SELECT 1 FROM bulk_writes) BEGIN
+    UPDATE catalog_version SET version = version + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = 1;
+    UPDATE recipes SET version = (SELECT version FROM catalog_version WHERE id = 1),
+                       updated_at = CAST(strftime('%s', 'now') AS INTEGER)
+    WHERE id = NEW.id;
+END;
+
+DROP TRIGGER IF EXISTS trg_ingredients_insert;
+CREATE TRIGGER trg_ingredients_insert AFTER INSERT ON ingredients
+WHEN NOT EXISTS (SELECT 1 FROM bulk_writes) BEGIN
+    UPDATE catalog_version SET version = version + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = 1;
+    UPDATE recipes SET version = (SELECT version FROM catalog_version WHERE id = 1),
+                       updated_at = CAST(strftime('%s', 'now') AS INTEGER)
+    WHERE id = NEW.recipe_id;
+END;
+
+DROP TRIGGER IF EXISTS trg_recipe_categories_insert;
+CREATE TRIGGER trg_recipe_categories_insert AFTER INSERT ON recipe_categories
+WHEN NOT EXISTS (SELECT 1 FROM bulk_writes) BEGIN
+    UPDATE catalog_version SET version = version + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = 1;
+    UPDATE recipes SET version = (SELECT version FROM catalog_version WHERE id = 1),
+                       updated_at = CAST(strftime('%s', 'now') AS INTEGER)
+    WHERE id = NEW.recipe_id;
+END;
+
+DROP TRIGGER IF EXISTS trg_change_log_recipes_insert;
+CREATE TRIGGER trg_change_log_recipes_insert AFTER INSERT ON recipes
+WHEN NOT EXISTS (SELECT 1 FROM bulk_writes) BEGIN
+    INSERT INTO change_log (entity, entity_id, op) VALUES ('recipes', NEW.id, 'insert');
+END;
+
+DROP TRIGGER IF EXISTS trg_change_log_ingredients_insert;
+CREATE TRIGGER trg_change_log_ingredients_insert AFTER INSERT ON ingredients
+WHEN NOT EXISTS (SELECT 1 FROM bulk_writes) BEGIN
+    INSERT INTO change_log (entity, entity_id, op) VALUES ('ingredients', NEW.recipe_id, 'insert');
+END;
+
+DROP TRIGGER IF EXISTS trg_change_log_recipe_categories_insert;
+CREATE TRIGGER trg_change_log_recipe_categories_insert AFTER INSERT ON recipe_categories
+WHEN NOT EXISTS (SELECT 1 FROM bulk_writes) BEGIN
+    INSERT INTO change_log (entity, entity_id, op) VALUES ('recipe_categories', NEW.recipe_id, 'insert');
+END;
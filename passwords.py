@@ -0,0 +1,108 @@
+import os
+import threading
+
+from flask import current_app
+
+from timing import timed
+
+
+class PasswordHashBusy(Exception):
+    """Raised when the hashing pool is saturated; the route should answer 503 right away."""
+
+
+_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+_slots = None
+
+
+def hash_method(app=None):
+    """Configured PASSWORD_HASH_METHOD with werkzeug's defaults spelled out.
+
+    "scrypt" -> "scrypt:32768:8:1", "pbkdf2" -> "pbkdf2:sha256:<iterations>", so it can be
+    compared with the prefix stored in front of each hash.
+    """
+    method = (app or current_app).config.get("PASSWORD_HASH_METHOD", "scrypt")
+    name, *args = method.split(":")
+    if name == "scrypt" and not args:
+        return "scrypt:32768:8:1"
+    if name == "pbkdf2" and len(args) < 2:
+        from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS
+        hash_name = args[0] if args else "sha256"
+        return f"pbkdf2:{hash_name}:{DEFAULT_PBKDF2_ITERATIONS}"
+    return method
+
+
+def needs_rehash(pwhash):
+    """True if the stored hash was made with other parameters than the configured ones."""
+    return pwhash.split("$", 1)[0] != hash_method()
+
+
+def _get_executor():
+    """Lazily start the pool; a forked worker (gunicorn) gets its own."""
+    global _executor, _executor_pid, _slots
+    workers = current_app.config.get("PASSWORD_HASH_WORKERS", 0)
+    if not workers:
+        return None, None
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            import multiprocessing  # slow to import
+            from concurrent.futures import ProcessPoolExecutor
+            # The pool starts its processes on demand, when threads (log writer, maintenance,
+            # ...) are already running; forking then could copy a lock some thread holds.
+            # forkserver forks them from a clean single-threaded process instead.
+            context = (multiprocessing.get_context("forkserver")
+                       if "forkserver" in multiprocessing.get_all_start_methods() else None)
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            _executor_pid = os.getpid()
+            # Hashes running + hashes waiting; anything beyond that is rejected immediately
+            _slots = threading.BoundedSemaphore(
+                workers + current_app.config.get("PASSWORD_HASH_QUEUE", workers * 2))
+        return _executor, _slots
+
+
+def start_pool():
+    """Start this process's pool now instead of on the first login (gunicorn post_fork)."""
+    _get_executor()
+
+
+def shutdown_pool():
+    """Stop this process's pool, e.g. when a worker is recycled after max_requests."""
+    global _executor
+    with _lock:
+        if _executor is not None and _executor_pid == os.getpid():
+            _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _run(fn, *args):
+    executor, slots = _get_executor()
+    with timed("hash"):
+        if executor is None:
+            return fn(*args)  # PASSWORD_HASH_WORKERS=0: hash on the request thread
+        from concurrent.futures import TimeoutError  # already imported with the pool
+        if not slots.acquire(blocking=False):
+            raise PasswordHashBusy()
+        try:
+            future = executor.submit(fn, *args)
+        except BaseException:
+            slots.release()
+            raise
+        # The slot is held until the hash is really done: after a timeout it may still be
+        # running in the pool (cancel() can't stop it), and it still counts against the limit
+        future.add_done_callback(lambda _: slots.release())
+        try:
+            return future.result(timeout=current_app.config.get("PASSWORD_HASH_TIMEOUT", 10))
+        except TimeoutError:
+            future.cancel()
+            raise PasswordHashBusy() from None
+
+
+def hash_password(password):
+    from werkzeug.security import generate_password_hash
+    return _run(generate_password_hash, password, hash_method())
+
+
+def verify_password(pwhash, password):
+    from werkzeug.security import check_password_hash
+    return _run(check_password_hash, pwhash, password)
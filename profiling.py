@@ -0,0 +1,166 @@
+"""On-demand sampling profiler for live requests.
+
+Off unless PROFILING=1. Then a request is profiled when it carries the header
+"X-Profile: <PROFILE_TOKEN>" or, at random, for a PROFILE_SAMPLE_RATE fraction of requests.
+While a profiled request runs, a helper thread reads the request thread's Python stack
+every PROFILE_INTERVAL_MS milliseconds (sys._current_frames(); the request thread itself
+runs unmodified, unlike under cProfile). The samples are written in the collapsed-stack
+format that flamegraph.pl, speedscope and inferno read:
+
+    PROFILE_DIR/main.index/20240101T120000Z-1234.0-87ms.folded
+        wsgi_app (app.py:1478);full_dispatch_request (app.py:872);index (app.py:402) 12
+
+One directory per route. At most PROFILE_MAX_FILES profiles and PROFILE_MAX_BYTES bytes
+are kept; the oldest go first. `python profiling.py <route>` adds up a route's profiles
+into one collapsed file, e.g. `python profiling.py main.index | flamegraph.pl > index.svg`.
+
+A profile covers the request up to its response object, so for streamed listings
+(STREAM_LISTINGS) it stops before the template renders. With PROFILING unset no handler
+is registered, so requests pay nothing.
+"""
+import collections
+import hmac
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+
+from flask import g, request
+
+HEADER = "X-Profile"
+
+_sequence = itertools.count()  # keeps names unique within a second
+
+
+class Sampler:
+    """Counts the stacks of one thread until stop()."""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.seconds = time.perf_counter() - self._started
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[_collapse(frame)] += 1
+
+
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def write_profile(directory, route, stacks, seconds):
+    """Save `stacks` as PROFILE_DIR/<route>/<time>-<pid>.<n>-<ms>ms.folded; returns the path."""
+    route_dir = os.path.join(directory, route.replace(os.sep, "_"))
+    os.makedirs(route_dir, exist_ok=True)
+    name = f"{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}-{os.getpid()}.{next(_sequence)}-{seconds * 1000:.0f}ms.folded"
+    path = os.path.join(route_dir, name)
+    with open(path + ".tmp", "w") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def prune(directory, max_files, max_bytes):
+    """Remove the oldest profiles until at most `max_files` totalling `max_bytes` are left."""
+    profiles = []
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.endswith(".folded"):
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:  # pruned by another worker
+                    continue
+                profiles.append((stat.st_mtime, stat.st_size, path))
+    profiles.sort(reverse=True)
+    kept_bytes = 0
+    for index, (_, size, path) in enumerate(profiles):
+        kept_bytes += size
+        if index >= max_files or kept_bytes > max_bytes:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def init_profiling(app):
+    """Profile requests picked by the X-Profile header or PROFILE_SAMPLE_RATE."""
+    directory = app.config["PROFILE_DIR"]
+    token = app.config.get("PROFILE_TOKEN")
+    sample_rate = app.config["PROFILE_SAMPLE_RATE"]
+    interval = app.config["PROFILE_INTERVAL_MS"] / 1000
+
+    @app.before_request
+    def start_profile():
+        requested = HEADER in request.headers
+        if requested:
+            if not (token and hmac.compare_digest(request.headers[HEADER].encode(), token.encode())):
+                return
+        elif not (sample_rate and random.random() < sample_rate):
+            return
+        g.profile = (Sampler(threading.get_ident(), interval).start(), requested)
+
+    def finish(response=None):
+        sampler, requested = g.pop("profile")
+        stacks = sampler.stop()
+        path = write_profile(directory, request.endpoint or "none", stacks, sampler.seconds)
+        prune(directory, app.config["PROFILE_MAX_FILES"], app.config["PROFILE_MAX_BYTES"])
+        if requested and response is not None:
+            response.headers[HEADER] = f"{os.path.relpath(path, directory)}; samples={sum(stacks.values())}"
+
+    @app.after_request
+    def finish_profile(response):
+        if "profile" in g:
+            finish(response)
+        return response
+
+    @app.teardown_request
+    def finish_failed_profile(exc):
+        # after_request is skipped when the view raised
+        if "profile" in g:
+            finish()
+
+
+def merge(directory, route):
+    """All of a route's profiles added up: {stack: samples}."""
+    stacks = collections.Counter()
+    route_dir = os.path.join(directory, route)
+    for filename in sorted(os.listdir(route_dir)):
+        if filename.endswith(".folded"):
+            with open(os.path.join(route_dir, filename)) as f:
+                for line in f:
+                    stack, _, count = line.rstrip("\n").rpartition(" ")
+                    stacks[stack] += int(count)
+    return stacks
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python profiling.py <route> [profile_dir]")
+    merged = merge(sys.argv[2] if len(sys.argv) > 2 else os.environ.get("PROFILE_DIR", "profiles"), sys.argv[1])
+    for stack, count in merged.most_common():
+        print(f"{stack} {count}")
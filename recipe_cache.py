@@ -0,0 +1,113 @@
+import sys
+from collections import namedtuple
+
+from flask import current_app
+
+from lru import SizedLRU
+
+
+Ingredient = namedtuple("Ingredient", "name quantity_unit")
+Category = namedtuple("Category", "id name")
+
+
+class RecipeAggregate:
+    """A recipe with its owner, ingredients and categories, as one immutable object.
+
+    Templates read it exactly like the old dict (recipe.title, recipe.ingredients[i].name).
+    """
+
+    __slots__ = ("id", "title", "description", "instructions", "prep_time", "cook_time",
+                 "user_id", "image_filename", "owner_username", "version",
+                 "ingredients", "categories")
+
+    def __init__(self, row, ingredients, categories):
+        for field in self.__slots__[:-2]:
+            object.__setattr__(self, field, row[field])
+        object.__setattr__(self, "ingredients", tuple(Ingredient(*i) for i in ingredients))
+        object.__setattr__(self, "categories", tuple(Category(*c) for c in categories))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RecipeAggregate is immutable")
+
+    def __getitem__(self, field):
+        # recipe["image_filename"] keeps working in the routes
+        return getattr(self, field)
+
+    def as_dict(self):
+        """Mutable copy for the edit form, which swaps in the submitted ingredients on errors."""
+        recipe = {field: getattr(self, field) for field in self.__slots__}
+        recipe["ingredients"] = list(self.ingredients)
+        return recipe
+
+    def estimated_size(self):
+        size = sys.getsizeof(self) + sys.getsizeof(self.ingredients) + sys.getsizeof(self.categories)
+        for field in self.__slots__[:-2]:
+            size += sys.getsizeof(getattr(self, field))
+        for ingredient in self.ingredients:
+            size += sys.getsizeof(ingredient) + sum(sys.getsizeof(value) for value in ingredient)
+        for category in self.categories:
+            size += sys.getsizeof(category) + sys.getsizeof(category.name)
+        return size
+
+
+def load_recipe(cursor, recipe_id):
+    """Build the aggregate from the database (three queries), or None if it doesn't exist."""
+    row = cursor.execute(
+        """
+        SELECT r.id, r.title, r.description, r.instructions, r.prep_time, r.cook_time,
+               r.user_id, r.image_filename, r.version, u.username AS owner_username
+        FROM recipes r
+        JOIN users u ON r.user_id = u.id
+        WHERE r.id = ?
+        """,
+        (recipe_id,)
+    ).fetchone()
+    if row is None:
+        return None
+
+    ingredients = cursor.execute(
+        "SELECT name, quantity_unit FROM ingredients WHERE recipe_id = ?",
+        (recipe_id,)
+    ).fetchall()
+    categories = cursor.execute(
+        """
+        SELECT c.id, c.name
+        FROM recipe_categories rc
+        JOIN categories c ON rc.category_id = c.id
+        WHERE rc.recipe_id = ?
+        ORDER BY c.name
+        """,
+        (recipe_id,)
+    ).fetchall()
+    return RecipeAggregate(row, ingredients, categories)
+
+
+def get_recipe(cursor, recipe_id, version=None):
+    """Read-through lookup: the cached aggregate if it is still current, or load and cache it.
+
+    An entry only counts if its version is the recipe's current one (`version`, when the
+    caller has just read it, or one primary key lookup). A request that loaded the old rows
+    just before a write can still put them in the cache after the writer's invalidation;
+    the version check keeps that entry from ever being served.
+    """
+    cache = current_app.extensions["recipe_cache"]
+    if version is None:
+        row = cursor.execute("SELECT version FROM recipes WHERE id = ?", (recipe_id,)).fetchone()
+        if row is None:
+            return None
+        version = row[0]
+    recipe = cache.get(recipe_id, valid=lambda cached: cached.version == version)
+    if recipe is None:
+        recipe = load_recipe(cursor, recipe_id)
+        if recipe is not None:
+            cache.put(recipe_id, recipe, recipe.estimated_size())
+    return recipe
+
+
+def invalidate_recipe(recipe_id):
+    """Call after committing any change to a recipe, its ingredients or its categories."""
+    current_app.extensions["recipe_cache"].invalidate(recipe_id)
+
+
+def init_recipe_cache(app):
+    app.extensions["recipe_cache"] = SizedLRU(app.config.get("RECIPE_CACHE_BYTES", 8 * 1024 * 1024))
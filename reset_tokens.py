@@ -0,0 +1,68 @@
+"""Password reset tokens, stored hashed (migration 0006).
+
+The link carries a random token; the database only has HMAC-SHA256(key, token), keyed
+with the app's SECRET_KEY, and the expiry as unix time. Checking a link is one lookup on
+the unique token_hash index with the expiry in the WHERE clause, and using it deletes the
+row in the same statement, so a link works once even if it is submitted twice at the same
+moment. Changing SECRET_KEY invalidates every outstanding link.
+
+Expired rows are removed by sweep_expired() from the maintenance thread, in small batches
+on the expires_at index.
+"""
+import hashlib
+import hmac
+import secrets
+import time
+
+SWEEP_BATCH = 500
+
+
+def token_hash(key, token):
+    if isinstance(key, str):
+        key = key.encode()
+    return hmac.new(key, token.encode(), hashlib.sha256).digest()
+
+
+def issue(conn, key, user_id, ttl=300):
+    """Store a new token for `user_id` (replacing any earlier one) and return it with its expiry."""
+    token = secrets.token_urlsafe(32)
+    expires_at = int(time.time()) + ttl
+    conn.execute("""
+        INSERT INTO password_reset_tokens (user_id, token_hash, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET token_hash = excluded.token_hash, expires_at = excluded.expires_at
+    """, (user_id, token_hash(key, token), expires_at))
+    return token, expires_at
+
+
+def lookup(conn, key, token):
+    """user_id of an unexpired token, or None."""
+    row = conn.execute("SELECT user_id FROM password_reset_tokens WHERE token_hash = ? AND expires_at > ?",
+                       (token_hash(key, token), int(time.time()))).fetchone()
+    return row[0] if row else None
+
+
+def consume(conn, key, token):
+    """Delete an unexpired token and return its user_id (None if it was invalid or expired)."""
+    row = conn.execute("DELETE FROM password_reset_tokens WHERE token_hash = ? AND expires_at > ? RETURNING user_id",
+                       (token_hash(key, token), int(time.time()))).fetchone()
+    return row[0] if row else None
+
+
+def sweep_expired(conn, batch=SWEEP_BATCH, should_stop=lambda: False):
+    """Delete expired tokens `batch` rows per statement; returns the number deleted.
+
+    `conn` must be in autocommit mode (isolation_level=None): each batch is its own short
+    write transaction, so requests waiting to write get in between batches.
+    """
+    now = int(time.time())
+    deleted = 0
+    while not should_stop():
+        count = conn.execute("""
+            DELETE FROM password_reset_tokens WHERE id IN (
+                SELECT id FROM password_reset_tokens WHERE expires_at <= ? ORDER BY expires_at LIMIT ?
+            )
+        """, (now, batch)).rowcount
+        deleted += count
+        if count < batch:
+            break
+    return deleted
@@ -1,45 +1,97 @@
+import logging
+import os
 import sqlite3
 
+import db
+
+logger = logging.getLogger(__name__)
+
 DATABASE = 'recipes.db'
 
+# Stored in PRAGMA user_version once bootstrap() has created and seeded the database.
+# Later versions are files in migrations/ (migrate.py); don't change the tables here.
+SCHEMA_VERSION = 1
+
+
+def get_db_connection(database=DATABASE):  # database connection logic into a function
+    return db.connect(database)  # rows behave like dictionaries; DB_PROFILE sets the PRAGMAs
+
 
-def get_db_connection():  # database connection logic into a function
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row  # rows behave like dictionaries
-    conn.execute("PRAGMA foreign_keys = ON")
-    conn.execute("PRAGMA journal_mode = WAL")
-    return conn
+def add_column_if_missing(cursor, table, column, definition):
+    # CREATE TABLE IF NOT EXISTS won't add new columns to a database created by an older version
+    columns = [row["name"] for row in cursor.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
 
 
-def create_tables():
-    conn = get_db_connection()
-    cursor = conn.cursor()  # ursor to execute SQL queries and fetch results
+def bootstrap(database=DATABASE):
+    """Create, upgrade and seed the database unless it is already at SCHEMA_VERSION.
 
+    Runs on every startup (create_app), so the common case is one PRAGMA read. Otherwise
+    everything happens in a single transaction, and the version stamp is written last.
+    Returns True if the database was changed.
+    """
+    if not os.path.exists(database) or os.path.getsize(database) == 0:
+        # auto_vacuum can only be set before the file is initialised (journal_mode = WAL does
+        # that); INCREMENTAL lets maintenance.py hand free pages back to the filesystem
+        fresh = sqlite3.connect(database)
+        fresh.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        fresh.execute("PRAGMA journal_mode = WAL")
+        fresh.close()
+    conn = get_db_connection(database)
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return False
+        conn.execute("BEGIN IMMEDIATE")
+        # Another worker may have finished the bootstrap while we waited for the lock
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            conn.rollback()
+            return False
+        cursor = conn.cursor()
+        system_user_id = create_tables(cursor)
+        populate_default_data(cursor, system_user_id)
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+        return True
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def create_tables(cursor):
+    """Create missing tables, columns, indexes and triggers; returns the system user's id."""
     # Create users table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT NOT NULL UNIQUE,
             hash TEXT NOT NULL,
-            email TEXT UNIQUE NOT NULL DEFAULT ''
+            email TEXT UNIQUE NOT NULL DEFAULT '',
+            auth_version INTEGER NOT NULL DEFAULT 1, -- bumped to log the user out everywhere
+            favorites_version INTEGER NOT NULL DEFAULT 1, -- bumped whenever the user's favorites change
+            favorites_updated_at INTEGER NOT NULL DEFAULT 0
         )
     ''')
+    add_column_if_missing(cursor, "users", "auth_version", "INTEGER NOT NULL DEFAULT 1")
+    add_column_if_missing(cursor, "users", "favorites_version", "INTEGER NOT NULL DEFAULT 1")
+    add_column_if_missing(cursor, "users", "favorites_updated_at", "INTEGER NOT NULL DEFAULT 0")
+    # Case-insensitive lookups for login (WHERE username = ? COLLATE NOCASE); migration 0007
+    # makes both indexes UNIQUE
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users(username COLLATE NOCASE)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_email_nocase ON users(email COLLATE NOCASE)")
 
     # Insert a special 'system_recipes' user
     # system_recipes user will own the default recipes. No hash as it won't log in
-    try:
+    row = cursor.execute("SELECT id FROM users WHERE username = 'system_recipes'").fetchone()
+    if row is None:
         cursor.execute("INSERT INTO users (username, hash) VALUES (?, ?)",
                        ('system_recipes', 'NO_LOGIN_HASH'))
-        conn.commit()
-        print("System recipes user created (if not already exists).")
-    except sqlite3.IntegrityError:
-        # system_recipes user already exists
-        pass
-
-    # Retrieve the ID of the system_recipes user
-    cursor.execute("SELECT id FROM users WHERE username = 'system_recipes'")
-    # put it into a variable for easy access
-    system_user_id = cursor.fetchone()['id']
+        system_user_id = cursor.lastrowid
+        logger.info("System recipes user created")
+    else:
+        system_user_id = row['id']
 
     # Create recipes table
     cursor.execute('''
@@ -52,9 +104,13 @@ def create_tables():
             prep_time TEXT,
             cook_time TEXT,
             image_filename TEXT,
+            version INTEGER NOT NULL DEFAULT 1, -- see create_version_triggers()
+            updated_at INTEGER NOT NULL DEFAULT 0, -- unix time of the last change
             FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
         )
     ''')
+    add_column_if_missing(cursor, "recipes", "version", "INTEGER NOT NULL DEFAULT 1")
+    add_column_if_missing(cursor, "recipes", "updated_at", "INTEGER NOT NULL DEFAULT 0")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_recipes_user_id ON recipes(user_id)")
 
 
@@ -114,33 +170,137 @@ def create_tables():
     ''')
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_favorites_user_id ON favorites(user_id)")
 
+    create_version_triggers(cursor)
+    create_change_log_triggers(cursor)
 
-    conn.commit()
-    conn.close()
-    print("Database tables created successfully!")
+    logger.info("Database tables created")
     return system_user_id
 
 
-def populate_default_data(system_user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+# SQL that bumps the global catalog version and stamps it on one recipe
+def _bump_recipe(recipe_id_expr):
+    return f'''
+        UPDATE catalog_version SET version = version + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = 1;
+        UPDATE recipes SET version = (SELECT version FROM catalog_version WHERE id = 1),
+                           updated_at = CAST(strftime('%s', 'now') AS INTEGER)
+        WHERE id = {recipe_id_expr};
+    '''
+
+
+def create_version_triggers(cursor):
+    """Keep recipes.version / catalog_version / users.favorites_version current.
+
+    Every change to a recipe, its ingredients or its categories takes the next value of a
+    single monotonically increasing catalog version and stores it on the recipe. That makes
+    "has anything changed?" one indexed lookup for both the detail page (recipes.version)
+    and the listings (catalog_version.version), which is what the ETags are built from.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO catalog_version (id, version, updated_at) "
+                   "VALUES (1, 1, CAST(strftime('%s', 'now') AS INTEGER))")
+
+    triggers = {
+        "trg_recipes_insert": f"AFTER INSERT ON recipes BEGIN {_bump_recipe('NEW.id')} END",
+        # Only content columns, so the version bump itself doesn't fire the trigger again
+        "trg_recipes_update": "AFTER UPDATE OF user_id, title, description, instructions, prep_time, cook_time, "
+                              f"image_filename ON recipes BEGIN {_bump_recipe('NEW.id')} END",
+        "trg_recipes_delete": '''AFTER DELETE ON recipes BEGIN
+            UPDATE catalog_version SET version = version + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = 1;
+        END''',
+        "trg_categories_update": '''AFTER UPDATE ON categories BEGIN
+            UPDATE catalog_version SET version = version + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = 1;
+            UPDATE recipes SET version = (SELECT version FROM catalog_version WHERE id = 1),
+                               updated_at = CAST(strftime('%s', 'now') AS INTEGER)
+            WHERE id IN (SELECT recipe_id FROM recipe_categories WHERE category_id = NEW.id);
+        END''',
+        "trg_categories_insert": '''AFTER INSERT ON categories BEGIN
+            UPDATE catalog_version SET version = version + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = 1;
+        END''',
+        "trg_favorites_insert": '''AFTER INSERT ON favorites BEGIN
+            UPDATE users SET favorites_version = favorites_version + 1,
+                             favorites_updated_at = CAST(strftime('%s', 'now') AS INTEGER)
+            WHERE id = NEW.user_id;
+        END''',
+        "trg_favorites_delete": '''AFTER DELETE ON favorites BEGIN
+            UPDATE users SET favorites_version = favorites_version + 1,
+                             favorites_updated_at = CAST(strftime('%s', 'now') AS INTEGER)
+            WHERE id = OLD.user_id;
+        END''',
+    }
+    # Ingredients and category links belong to a recipe: any change bumps that recipe
+    for table in ("ingredients", "recipe_categories"):
+        triggers[f"trg_{table}_insert"] = f"AFTER INSERT ON {table} BEGIN {_bump_recipe('NEW.recipe_id')} END"
+        triggers[f"trg_{table}_delete"] = f"AFTER DELETE ON {table} BEGIN {_bump_recipe('OLD.recipe_id')} END"
+        triggers[f"trg_{table}_update"] = (f"AFTER UPDATE ON {table} BEGIN {_bump_recipe('OLD.recipe_id')} "
+                                           f"{_bump_recipe('NEW.recipe_id')} END")
 
+    for name, body in triggers.items():
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+
+
+def create_change_log_triggers(cursor):
+    """Append one change_log row per changed row, for cross-worker cache invalidation.
+
+    entity_id is the key the caches use: the recipe id for recipes, ingredients and
+    recipe_categories, the category id for categories and the user id for favorites/users.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, -- AUTOINCREMENT: never reused, even after pruning
+            entity TEXT NOT NULL,
+            entity_id INTEGER NOT NULL,
+            op TEXT NOT NULL -- insert / update / delete
+        )
+    ''')
+
+    watched = {
+        # table: (key on insert/update, key on delete)
+        "recipes": ("NEW.id", "OLD.id"),
+        "ingredients": ("NEW.recipe_id", "OLD.recipe_id"),
+        "recipe_categories": ("NEW.recipe_id", "OLD.recipe_id"),
+        "categories": ("NEW.id", "OLD.id"),
+        "favorites": ("NEW.user_id", "OLD.user_id"),
+    }
+    # The version bumps made by create_version_triggers() are not changes of their own
+    update_of = {"recipes": "UPDATE OF user_id, title, description, instructions, prep_time, cook_time, image_filename"}
+    for table, (new_key, old_key) in watched.items():
+        for op, key in (("insert", new_key), ("update", new_key), ("delete", old_key)):
+            event = update_of.get(table, "UPDATE") if op == "update" else op.upper()
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_change_log_{table}_{op} AFTER {event} ON {table} BEGIN
+                    INSERT INTO change_log (entity, entity_id, op) VALUES ('{table}', {key}, '{op}');
+                END
+            ''')
+
+    # Only the columns login_required caches, so revocations reach every worker right away
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_change_log_users_update AFTER UPDATE OF username, auth_version ON users BEGIN
+            INSERT INTO change_log (entity, entity_id, op) VALUES ('users', NEW.id, 'update');
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_change_log_users_delete AFTER DELETE ON users BEGIN
+            INSERT INTO change_log (entity, entity_id, op) VALUES ('users', OLD.id, 'delete');
+        END
+    ''')
+
+
+def populate_default_data(cursor, system_user_id):
+    """Insert the default categories and recipes, unless the system user already has recipes."""
     # --- Add Default Categories --- into categories table
     default_categories = ["Breakfast", "Lunch", "Dinner", "Dessert", "Appetizer", "Main Course",
                           "Side Dish", "Snack", "Italian", "Mexican", "Asian", "Vegetarian", "Vegan", "Quick & Easy", "Seafood", "Baking", "Comfort Food", "Soups", "Salads",
                           "Smoothies", "Grilling", "Mediterranean"]
-    category_ids = {}
-
-    for category_name in default_categories:
-        try:
-            cursor.execute("INSERT INTO categories (name) VALUES (?)", (category_name,))
-            category_ids[category_name] = cursor.lastrowid
-        except sqlite3.IntegrityError:
-            # category already exists, just fetch its ID
-            cursor.execute("SELECT id FROM categories WHERE name = ?", (category_name,))
-            category_ids[category_name] = cursor.fetchone()["id"]
-        conn.commit()
-    print("Default categories populated.")
+    cursor.executemany("INSERT OR IGNORE INTO categories (name) VALUES (?)",
+                       [(category_name,) for category_name in default_categories])
+    category_ids = dict(cursor.execute("SELECT name, id FROM categories").fetchall())
+    logger.info("Default categories populated")
 
     # --- Add Default Recipes ---
     # list of dictionaries, each represents a default recipe
@@ -334,49 +494,41 @@ def populate_default_data(system_user_id):
         }
     ]
 
-    # Add recipes data into recipe table
+    # A database seeded before user_version was stamped already has them
+    if cursor.execute("SELECT 1 FROM recipes WHERE user_id = ? LIMIT 1", (system_user_id,)).fetchone():
+        return
+
+    # Add recipes data into recipe table, then look the new ids up by title
+    cursor.executemany(
+        "INSERT INTO recipes (user_id, title, description, instructions, prep_time, cook_time, image_filename) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(system_user_id, recipe_data["title"], recipe_data["description"], recipe_data["instructions"],
+          recipe_data["prep_time"], recipe_data["cook_time"], recipe_data["image_filename"])
+         for recipe_data in default_recipes]
+    )
+    recipe_ids = dict(cursor.execute("SELECT title, id FROM recipes WHERE user_id = ?", (system_user_id,)).fetchall())
+
+    # Add default ingredients for the default recipes into table
+    cursor.executemany(
+        "INSERT INTO ingredients (recipe_id, name, quantity_unit) VALUES (?, ?, ?)",
+        [(recipe_ids[recipe_data["title"]], ingredient["name"], ingredient["quantity_unit"])
+         for recipe_data in default_recipes for ingredient in recipe_data["ingredients"]]
+    )
+
+    # Link categories to the recipes in the recipe_categories junction table
+    links = []
     for recipe_data in default_recipes:
-        try:
-            cursor.execute(
-                "INSERT INTO recipes (user_id, title, description, instructions, prep_time, cook_time, image_filename) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (system_user_id, recipe_data["title"], recipe_data["description"],
-                 recipe_data["instructions"], recipe_data["prep_time"], recipe_data["cook_time"], recipe_data["image_filename"])
-            )
-            recipe_id = cursor.lastrowid
-
-            # Add default ingredients for the default recipe into table
-            for ingredient in recipe_data["ingredients"]:
-                cursor.execute(
-                    "INSERT INTO ingredients (recipe_id, name, quantity_unit) VALUES (?, ?, ?)",
-                    (recipe_id, ingredient["name"], ingredient["quantity_unit"])
-                )
-
-            # Link categories to the recipe and Add recipe_id and category_id to recipe_categories Junction table
-            for category_name in recipe_data["categories"]:
-                if category_name in category_ids:
-                    cursor.execute(
-                        "INSERT INTO recipe_categories (recipe_id, category_id) VALUES (?, ?)",
-                        (recipe_id, category_ids[category_name])
-                    )
-                else:
-                    print(
-                        f"Warning: Category '{category_name}' not found for recipe '{recipe_data['title']}'.")
-
-        except sqlite3.IntegrityError as e:
-            print(f"Skipping duplicate default recipe: {recipe_data['title']} (Error: {e})")
-            # This ensures i don't try to insert the same default recipe multiple times
-            pass
-
-    conn.commit()
-    conn.close()
-    print("Default recipe populated")
+        for category_name in recipe_data["categories"]:
+            if category_name in category_ids:
+                links.append((recipe_ids[recipe_data["title"]], category_ids[category_name]))
+            else:
+                logger.warning("Category %r not found for default recipe %r", category_name, recipe_data["title"])
+    cursor.executemany("INSERT INTO recipe_categories (recipe_id, category_id) VALUES (?, ?)", links)
+    logger.info("Default recipes populated")
 
 
 if __name__ == '__main__':
-    # First create tables and get the system_user_id
-    sys_user_id = create_tables()
-    # Then populate default data using that ID
-    if sys_user_id:
-        populate_default_data(sys_user_id)
-    else:
-        print("Could not retrieve system user ID, skipping default data population.")
+    # Create the tables and the default data, then apply migrations/ (see migrate.py)
+    import migrate
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    migrate.upgrade()
+    print("Database is up to date.")
@@ -0,0 +1,193 @@
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+from timing import timed
+
+
+# SESSION_BACKEND values:
+#   "sqlite"     - server-side sessions in a small WAL-mode SQLite database (default)
+#   "cookie"     - Flask's signed cookie; fits the tiny user_id/username payload, no storage at all
+#   "filesystem" - the original Flask-Session pickle files
+SESSION_BACKENDS = ("sqlite", "cookie", "filesystem")
+
+
+class SQLiteSession(CallbackDict, SessionMixin):
+    """Session dict that remembers its id, expiry and whether it was changed."""
+
+    def __init__(self, initial=None, sid=None, expires_at=0, new=False):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.new = new
+        self.modified = False
+        self.accessed = False
+
+
+class SQLiteSessionInterface(SessionInterface):
+    """Server-side sessions stored in SQLite.
+
+    Unmodified sessions are never written back; the expiry is only pushed forward once
+    less than half of the lifetime is left. Expired rows are deleted in bounded batches
+    at most once every `sweep_interval` seconds per worker.
+    """
+
+    serializer = session_json_serializer
+
+    def __init__(self, path, sweep_interval=60, sweep_batch=500):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self._local = threading.local()
+        self._last_sweep = time.monotonic()
+        self._sweep_lock = threading.Lock()
+        self._connect()  # create the table up front
+
+    def _connect(self):
+        # sqlite3 connections can't be shared between threads, so keep one per thread;
+        # a forked worker must not reuse the one its parent opened in __init__
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")  # losing the last session write on power loss is fine
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    expires_at INTEGER NOT NULL
+                ) WITHOUT ROWID
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions(expires_at)")
+            conn.commit()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt="sqlite-session")
+
+    def _lifetime(self, app):
+        return int(app.permanent_session_lifetime.total_seconds())
+
+    def open_session(self, app, request):
+        with timed("session"):
+            return self._open_session(app, request)
+
+    def save_session(self, app, session, response):
+        with timed("session"):
+            self._save_session(app, session, response)
+
+    def _open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                # Forged or stale-key cookies are rejected without touching the database
+                sid = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            if sid:
+                row = self._connect().execute(
+                    "SELECT data, expires_at FROM sessions WHERE id = ?", (sid,)).fetchone()
+                if row and row[1] > time.time():
+                    return SQLiteSession(self.serializer.loads(row[0]), sid=sid, expires_at=row[1])
+        return SQLiteSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def _save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        conn = self._connect()
+        now = int(time.time())
+
+        # Emptied session (logout, session.clear()): drop the row and the cookie
+        if not session:
+            if session.modified and not session.new:
+                conn.execute("DELETE FROM sessions WHERE id = ?", (session.sid,))
+                conn.commit()
+                response.delete_cookie(name, domain=domain, path=path)
+                response.vary.add("Cookie")
+            return
+
+        lifetime = self._lifetime(app)
+        needs_touch = session.expires_at - now < lifetime // 2
+        if session.new or session.modified or needs_touch:
+            session.expires_at = now + lifetime
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)",
+                (session.sid, self.serializer.dumps(dict(session)), session.expires_at))
+            conn.commit()
+            self._maybe_sweep(conn)
+
+        if session.new or needs_touch or self.should_set_cookie(app, session):
+            response.set_cookie(
+                name,
+                self._signer(app).sign(session.sid).decode(),
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+            response.vary.add("Cookie")
+
+    def _maybe_sweep(self, conn):
+        if time.monotonic() - self._last_sweep < self.sweep_interval:
+            return
+        if not self._sweep_lock.acquire(blocking=False):
+            return  # another thread is already sweeping
+        try:
+            self._last_sweep = time.monotonic()
+            self.sweep(conn)
+        finally:
+            self._sweep_lock.release()
+
+    def sweep(self, conn=None):
+        """Delete expired sessions in small batches so writers are never blocked for long."""
+        conn = conn or self._connect()
+        now = int(time.time())
+        deleted = 0
+        while True:
+            cursor = conn.execute(
+                "DELETE FROM sessions WHERE id IN "
+                "(SELECT id FROM sessions WHERE expires_at <= ? LIMIT ?)",
+                (now, self.sweep_batch))
+            conn.commit()
+            deleted += cursor.rowcount
+            if cursor.rowcount < self.sweep_batch:
+                return deleted
+
+
+def init_session(app):
+    """Install the session backend selected by SESSION_BACKEND."""
+    backend = app.config.get("SESSION_BACKEND", "sqlite")
+    if backend not in SESSION_BACKENDS:
+        raise ValueError(f"Unknown SESSION_BACKEND {backend!r}, expected one of {SESSION_BACKENDS}")
+
+    if backend == "sqlite":
+        app.session_interface = SQLiteSessionInterface(
+            app.config.get("SESSION_SQLITE_PATH", "sessions.db"),
+            sweep_interval=app.config.get("SESSION_SWEEP_INTERVAL", 60),
+        )
+    elif backend == "filesystem":
+        from flask_session import Session
+
+        app.config["SESSION_TYPE"] = "filesystem"
+        Session(app)
+    # "cookie": Flask's default SecureCookieSessionInterface already skips unmodified sessions
+    return backend
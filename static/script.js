@@ -79,6 +79,42 @@ document.addEventListener('DOMContentLoaded', () => {
 
   if (ingredientsContainer) updateIngredientNames();
 
+  // --- Favorite toggles on recipe cards ---
+  // Without JavaScript the form posts to /toggle_favorite; here it becomes a JSON call
+  // that returns the new state, so the page doesn't have to reload. Both send the state
+  // the click asks for (the hidden "favorited" input) rather than "flip it", so falling
+  // back to the form after a request that did reach the server can't undo it.
+  document.addEventListener('submit', async (e) => {
+    const form = e.target.closest('.favorite-form');
+    if (!form || !form.dataset.toggleUrl) return;
+    e.preventDefault();
+
+    const button = form.querySelector('.favorite-toggle');
+    const wanted = form.querySelector('input[name="favorited"]');
+    if (button) button.disabled = true;
+    try {
+      const response = await fetch(form.dataset.toggleUrl, {
+        method: 'POST',
+        headers: { 'Accept': 'application/json', 'Content-Type': 'application/json' },
+        credentials: 'same-origin',
+        body: wanted ? JSON.stringify({ favorited: wanted.value === 'true' }) : undefined,
+      });
+      if (!response.ok) throw new Error(`HTTP ${response.status}`);
+      const { favorited } = await response.json();
+      if (wanted) wanted.value = String(!favorited);
+      if (button) {
+        button.classList.toggle('favorited', favorited);
+        button.setAttribute('aria-pressed', String(favorited));
+        button.title = favorited ? 'Remove from favorites' : 'Add to favorites';
+        button.innerHTML = favorited ? '&#9733; Favorited' : '&#9734; Favorite';
+      }
+    } catch (err) {
+      form.submit();  // fall back to the regular form post
+    } finally {
+      if (button) button.disabled = false;
+    }
+  });
+
   // --- Mobile Navigation Toggle ---
   const btn   = document.querySelector('.nav-toggle');
   const links = document.getElementById('site-links'); 
@@ -0,0 +1,106 @@
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+
+
+def record(name, seconds):
+    """Add `seconds` to the named timer of the current request (nothing outside one)."""
+    if not has_app_context():
+        return
+    timings = g.setdefault("timings", {})
+    timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def timed(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that adds the time spent in execute and fetch calls to the "db" timer."""
+
+    def _add(self, start, queries):
+        connection = self.connection
+        connection.timings["db"] = connection.timings.get("db", 0.0) + time.perf_counter() - start
+        connection.counters["db_queries"] += queries
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._add(start, 1)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._add(start, 1)
+
+    # A SELECT does most of its work while its rows are fetched; those calls add to the
+    # timer without counting as more queries
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._add(start, 0)
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(size if size is not None else self.arraysize)
+        finally:
+            self._add(start, 0)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._add(start, 0)
+
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection factory whose statements feed the "db" timer and query counter.
+
+    The current request's dicts are looked up once, when the connection is opened (the
+    app opens one per request); outside a request the numbers go nowhere.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if has_app_context():
+            self.timings = g.setdefault("timings", {})
+            self.counters = g.setdefault("counters", {"db_queries": 0})
+        else:
+            self.timings, self.counters = {}, {"db_queries": 0}
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # The built-in shortcuts would run the statement without going through the cursor's execute()
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def init_timing(app):
+    """Report per-request timers (db, hash, ...) in a Server-Timing header."""
+
+    @app.after_request
+    def add_server_timing(response):
+        timings = g.get("timings")
+        if timings:
+            response.headers["Server-Timing"] = ", ".join(
+                f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+        return response
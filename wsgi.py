@@ -0,0 +1,8 @@
+"""Production entry point: gunicorn -c gunicorn.conf.py wsgi:app"""
+from app import create_app, preload_lazy_modules
+
+app = create_app()
+
+# The app defers Pillow and Flask-Moment to first use; under preload_app import them once
+# in the master so every forked worker shares them instead of importing its own copy
+preload_lazy_modules()